@@ -0,0 +1,42 @@
+from models.model_operations.uncertainty_operations import upsert_video_uncertainty
+from models.model_operations.uncertainty_operations import get_video_ids_by_file_names
+import json
+import sys
+from app.app import app
+
+
+def to_uncertainty(d):
+    """
+    Get the uncertainty score of a video prediction.
+
+    Use the "score" field if it exists.
+    Otherwise, compute the score from the predicted probability in the "prob" field,
+    ...where the score is 1 when the probability is 0.5, and 0 when the probability is 0 or 1.
+    """
+    if "score" in d:
+        return float(d["score"])
+    return 1 - 2*abs(float(d["prob"]) - 0.5)
+
+
+def main(argv):
+    if len(argv) > 1:
+        with open(argv[1]) as f:
+            data = json.load(f)
+        with app.app_context():
+            file_name_to_id = get_video_ids_by_file_names([d["file_name"] for d in data])
+            scores = {}
+            for d in data:
+                if d["file_name"] not in file_name_to_id:
+                    print("Video not found: %s" % d["file_name"])
+                    continue
+                scores[file_name_to_id[d["file_name"]]] = to_uncertainty(d)
+            n = upsert_video_uncertainty(scores)
+            print("Upsert %d video uncertainty scores" % n)
+    else:
+        print("Usage: python add_uncertainty.py [prediction_json_path]")
+        print("The json file has a list of objects with the file_name field, and either the score or prob field")
+        print("Example: python add_uncertainty.py ../data/video_uncertainty.json")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
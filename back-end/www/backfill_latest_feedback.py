@@ -0,0 +1,19 @@
+from models.model_operations.segmentationFeedback_operations import backfill_latest_feedback
+import sys
+from app.app import app
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "confirm":
+        with app.app_context():
+            n = backfill_latest_feedback()
+            print("Add or update %d rows of the latest researcher feedback of segmentation masks" % n)
+    else:
+        print("Usage: python backfill_latest_feedback.py confirm")
+        print("Fill the segmentation_latest_feedback table from the existing researcher feedback")
+        print("The database migration already does this, so only run it to repair the table")
+        print("(it is safe to run this again, because only newer feedback replaces the existing rows)")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -41,6 +41,112 @@ class Config(object):
     # And we want 20% of the videos to be unlabeled
     PARTIAL_LABEL_RATIO = 1
 
+    # Set the sampling mode for selecting videos for citizens to label
+    # "random" => sort the candidate videos randomly in the database for each request (with anti-joins for exclusions)
+    # "pool" => draw videos uniformly from pre-shuffled candidate pools cached in each worker process
+    # "weighted" => same as "pool", but videos with higher priority are drawn more often
+    # "uncertainty" => give the videos that the model is most uncertain about (scores in the video_uncertainty table)
+    VIDEO_SAMPLING_MODE = "pool"
+
+    # For the "uncertainty" sampling mode, the videos in a batch are chosen randomly from the top uncertain candidates
+    # This sets the number of candidates, as a multiple of the number of videos needed
+    UNCERTAINTY_CANDIDATE_FACTOR = 4
+
+    # Set the sampling mode for selecting videos or segmentation masks for the admin researcher to label
+    # "random" => sort all the candidates randomly in the database for each request
+    # "tablesample" => sort only the candidates in a block sample of the table (TABLESAMPLE SYSTEM)
+    # ...and fall back to the "random" mode when the sample has too few candidates
+    # ...(this is faster on large tables, but the rows that are stored in the same blocks tend to come together)
+    ADMIN_SAMPLING_MODE = "random"
+
+    # For the "tablesample" mode, sample ADMIN_TABLESAMPLE_OVERSAMPLE times the rows needed in a batch
+    # The sample grows (up to ADMIN_TABLESAMPLE_MAX_TRIES times) when it has too few candidates
+    # Use the "random" mode when the sample needs more than ADMIN_TABLESAMPLE_MAX_PERCENT percent of the table
+    ADMIN_TABLESAMPLE_OVERSAMPLE = 50
+    ADMIN_TABLESAMPLE_MAX_TRIES = 3
+    ADMIN_TABLESAMPLE_MAX_PERCENT = 10
+
+    # Set the sampling mode for selecting segmentation masks for citizens to label (same options as above)
+    SEGMENTATION_SAMPLING_MODE = "random"
+
+    # For the "weighted" sampling mode, each candidate is drawn with probability proportional to priority**exponent
+    # 0 means uniform sampling, and larger numbers give more preference to high priority candidates
+    PRIORITY_WEIGHT_EXPONENT = 2
+
+    # Pre-assemble batches in a background thread of each worker process, so that getting a batch only pops a queue
+    # Each mode (admin/citizen and video/segmentation) has its own queue
+    # The queue is refilled up to BATCH_QUEUE_DEPTH batches when it has fewer than BATCH_QUEUE_REFILL_THRESHOLD batches
+    # The queue is also checked every BATCH_QUEUE_REFILL_INTERVAL seconds
+    # This starts a background thread in each worker process (uwsgi needs enable-threads), so it is disabled by default
+    BATCH_QUEUE_ENABLED = False
+    BATCH_QUEUE_DEPTH = 20
+    BATCH_QUEUE_REFILL_THRESHOLD = 5
+    BATCH_QUEUE_REFILL_INTERVAL = 30
+
+    # The duration (in seconds) to reserve the partially labeled items in a batch for the citizen who got the batch
+    # Other citizens do not get the reserved items, so that they do not label the same items at the same time
+    # Expired reservations are ignored, and they are cleared every RESERVATION_SWEEP_INTERVAL seconds
+    # ...by a background thread of each worker process (started with the first reservation, even without the batch queues)
+    RESERVATION_DURATION = 600
+    RESERVATION_SWEEP_INTERVAL = 300
+
+    # Reuse the connection of a user (with the same client type) that was created in the last CONNECTION_REUSE_WINDOW seconds
+    # This prevents adding a connection each time the client gets or refreshes the user token (0 means always adding one)
+    # The recent connections are cached in each worker process, with at most CONNECTION_CACHE_SIZE users
+    CONNECTION_REUSE_WINDOW = 1800
+    CONNECTION_CACHE_SIZE = 10000
+
+    # Buffer the views of the gallery pages in memory and write them in bulk in a background thread
+    # The buffer of each worker process is written when it has VIEW_BUFFER_SIZE views, or every VIEW_FLUSH_INTERVAL seconds
+    # The buffered views are lost if the worker process is killed, so this is disabled by default
+    # When VIEW_BUFFER_ENABLED is False, the views of each gallery page are written in the request with one INSERT
+    VIEW_BUFFER_ENABLED = False
+    VIEW_BUFFER_SIZE = 5000
+    VIEW_FLUSH_INTERVAL = 10
+
+    # Set the mode for recording the views of the gallery pages
+    # "raw" => add a row for each view in the view and segmentation_view tables
+    # "aggregated" => only count the views per item, query type, and day in the view_count and segmentation_view_count tables
+    VIEW_RECORDING_MODE = "raw"
+
+    # The number of days to keep the rows in the view and segmentation_view tables
+    # Older rows are compacted into the view count tables by the rollup_views.py script (None means keeping all rows)
+    VIEW_RAW_RETENTION_DAYS = None
+
+    # The max number and the duration (in seconds) to remember the consumed batch tokens in each worker process
+    # A replayed batch submission gets the remembered score response, without being processed again
+    REPLAY_CACHE_SIZE = 10000
+    REPLAY_CACHE_TTL = 3600
+
+    # The label events (labels and segmentation feedback) are projected to the label states by project_label_states.py
+    # Only the events older than PROJECTION_LAG seconds move the checkpoint of the projection forward
+    PROJECTION_LAG = 60
+
+    # The max number of times to retry a label state transition when concurrent labels changed the state first
+    LABEL_STATE_MAX_RETRIES = 5
+
+    # The number of labels that a bulk relabeling job of the admin researcher processes in one transaction
+    ADMIN_RELABEL_CHUNK_SIZE = 500
+    # A running job that has not updated its progress for ADMIN_RELABEL_STALE_TIMEOUT seconds can be retried
+    # ...(e.g., when the worker process that ran the job was restarted)
+    ADMIN_RELABEL_STALE_TIMEOUT = 600
+
+    # The duration (in seconds) before the candidate pools are reloaded from the database
+    # The pools are updated in place when labels are added, but only in the worker process that received the labels
+    CANDIDATE_POOL_TTL = 600
+
+    # The duration (in seconds) before the gold standard registry is reloaded from the database
+    # The registry is also reloaded when a researcher changes gold standards in the same worker process
+    GOLD_STANDARD_CACHE_TTL = 300
+
+    # The max number of users to cache the IDs of their labeled videos or segmentation masks
+    LABELED_ID_CACHE_SIZE = 2000
+
+    # The max number of gallery queries to cache the total number of items (for the paginated responses)
+    # The totals are counted again after GALLERY_TOTAL_CACHE_TTL seconds, or when labels are added in the same worker process
+    GALLERY_TOTAL_CACHE_SIZE = 1000
+    GALLERY_TOTAL_CACHE_TTL = 60
+
     # The max page size allowed for getting videos
     MAX_PAGE_SIZE = 1000
 
@@ -19,16 +19,18 @@ from util.util import InvalidUsage
 from util.util import encode_jwt
 from util.util import decode_jwt
 from util.util import get_current_time
+from util.keyset import KeysetPage
+from util.keyset import decode_cursor
 from config.config import config
 
 from models.model_operations.user_operations import get_user_by_client_id
 from models.model_operations.user_operations import create_user
 from models.model_operations.user_operations import get_user_by_id
 from models.model_operations.user_operations import update_best_tutorial_action_by_user_id
-from models.model_operations.connection_operations import create_connection
+from models.model_operations.connection_operations import get_or_create_connection
 from models.model_operations.batch_operations import create_batch
 
-from models.model_operations.video_operations import query_video_batch
+from models.model_operations.batch_queue_operations import pop_video_batch
 from models.model_operations.video_operations import get_video_query
 from models.model_operations.video_operations import get_all_videos
 from models.model_operations.video_operations import get_pos_video_query_by_user_id
@@ -36,13 +38,18 @@ from models.model_operations.video_operations import get_statistics
 from models.model_operations.label_operations import update_labels
 from models.model_operations.view_operations import create_views_from_video_batch
 from models.model_operations.tutorial_operations import create_tutorial
+from models.model_operations.replay_operations import get_replayed_score
+from models.model_operations.replay_operations import remember_consumed_token
+from models.model_operations.relabel_operations import create_relabel_job
+from models.model_operations.relabel_operations import start_relabel_job
+from models.model_operations.relabel_operations import retry_relabel_job
+from models.model_operations.relabel_operations import get_relabel_job
 
 from models.model_operations.segmentationBatch_operations import create_segmentation_batch
-from models.model_operations.segmentationMask_operations import query_segmentation_batch
+from models.model_operations.batch_queue_operations import pop_segmentation_batch
 from models.model_operations.segmentationMask_operations import get_segmentation_query
 from models.model_operations.segmentationMask_operations import get_all_segmentations
 from models.model_operations.segmentationMask_operations import get_pos_segmentation_query_by_user_id
-from models.model_operations.segmentationMask_operations import segmentatio_mask_join_video_table
 from models.model_operations.segmentationMask_operations import only_latest_researcher_feedback
 from models.model_operations.segmentationMask_operations import filter_feedback_by_user_id
 from models.model_operations.segmentationMask_operations import get_statistics_seg
@@ -57,6 +64,7 @@ from models.schema import segmentations_schema_is_admin
 from models.schema import segmentations_schema_with_detail
 from models.schema import segmentations_schema
 
+from models.model import db
 import models.model as m
 
 
@@ -139,9 +147,9 @@ def create_user_token(user):
     client_type = user.client_type
     user_score = user.score
     user_raw_score = user.raw_score
-    connection = create_connection(user_id, client_type)
-    ct = connection.time
-    cid = connection.id
+    # Reuse the recent connection of the user, so that refreshing the token does not add a connection each time
+    cid, _ = get_or_create_connection(user_id, client_type)
+    ct = get_current_time()
     if client_type == -1:
         return (None, None) # a banned user does not get the token
     else:
@@ -260,9 +268,9 @@ def get_batch():
     """For the client to get a batch of video clips."""
     request_json = request.get_json()
     user_jwt = batch_check_request(request_json)
-    # Query videos (active learning or random sampling)
+    # Get videos from the pre-assembled batches (or query them by active learning or random sampling)
     is_admin = True if user_jwt["client_type"] == 0 else False
-    video_batch = query_video_batch(user_jwt["user_id"], use_admin_label_state=is_admin)
+    video_batch = pop_video_batch(user_jwt["user_id"], use_admin_label_state=is_admin)
     if video_batch is None or len(video_batch) < config.BATCH_SIZE:
         return make_response("", 204)
     else:
@@ -270,15 +278,21 @@ def get_batch():
             batch = create_batch(
                 num_gold_standard=0,
                 num_unlabeled=config.BATCH_SIZE,
-                connection_id=user_jwt["connection_id"]
+                connection_id=user_jwt["connection_id"],
+                commit=False
             ) # no gold standard videos for admin
         else:
             batch = create_batch(
                 num_gold_standard=config.GOLD_STANDARD_IN_BATCH,
                 num_unlabeled=config.BATCH_SIZE-config.GOLD_STANDARD_IN_BATCH,
-                connection_id=user_jwt["connection_id"]
+                connection_id=user_jwt["connection_id"],
+                commit=False
             )
-        return jsonify_data(video_batch, sign=True, batch_id=batch.id, user_id=user_jwt["user_id"])
+        # Serialize the videos before committing, so that they do not need to be loaded again
+        response = jsonify_data(video_batch, sign=True, batch_id=batch.id, user_id=user_jwt["user_id"])
+        # Commit the batch and the reservations of the videos in the batch
+        db.session.commit()
+        return response
 
 
 @bp.route("/get_segment_batch", methods=["POST"])
@@ -287,7 +301,7 @@ def get_segment_batch():
     request_json = request.get_json()
     user_jwt = batch_check_request(request_json)
     is_admin = True if user_jwt["client_type"] == 0 else False
-    segmentation_batch = query_segmentation_batch(user_jwt["user_id"], use_admin_label_state=is_admin)
+    segmentation_batch = pop_segmentation_batch(user_jwt["user_id"], use_admin_label_state=is_admin)
     if segmentation_batch is None or len(segmentation_batch) < config.BATCH_SIZE_SEG:
         return make_response("", 204)
     else:
@@ -295,18 +309,24 @@ def get_segment_batch():
             batch = create_segmentation_batch(
                 num_gold_standard=0,
                 num_unlabeled=config.BATCH_SIZE_SEG,
-                connection_id=user_jwt["connection_id"]
+                connection_id=user_jwt["connection_id"],
+                commit=False
             ) # no gold standard videos for admin
         else:
             batch = create_segmentation_batch(
                 num_gold_standard=config.GOLD_STANDARD_IN_BATCH_SEG,
                 num_unlabeled=config.BATCH_SIZE_SEG-config.GOLD_STANDARD_IN_BATCH_SEG,
-                connection_id=user_jwt["connection_id"]
+                connection_id=user_jwt["connection_id"],
+                commit=False
             )
-        return jsonify_data(segmentation_batch, sign=True, batch_id=batch.id, user_id=user_jwt["user_id"], is_video=False)
+        # Serialize the segmentation masks before committing, so that they do not need to be loaded again
+        response = jsonify_data(segmentation_batch, sign=True, batch_id=batch.id, user_id=user_jwt["user_id"], is_video=False)
+        # Commit the batch and the reservations of the segmentation masks in the batch
+        db.session.commit()
+        return response
 
 
-def jsonify_data(data, sign=False, batch_id=None, total=None, is_admin=False, user_id=None, with_detail=False, is_video=True):
+def jsonify_data(data, sign=False, batch_id=None, total=None, is_admin=False, user_id=None, with_detail=False, is_video=True, next_cursor=None):
     """
     Convert video objects to json.
 
@@ -329,6 +349,8 @@ def jsonify_data(data, sign=False, batch_id=None, total=None, is_admin=False, us
     with_detail : bool
         For the normal front-end user, display details of the data or not.
         Check the VideoSchemaWithDetail class for an example.
+    next_cursor : str
+        The cursor of the next page for the keyset pagination (None if there is no next page).
 
     Returns
     -------
@@ -358,6 +380,8 @@ def jsonify_data(data, sign=False, batch_id=None, total=None, is_admin=False, us
         return_json["video_token"] = encode_video_jwt(video_id_list=data_id_list, batch_id=batch_id, user_id=user_id)
     if total is not None:
         return_json["total"] = total
+    if next_cursor is not None:
+        return_json["next_cursor"] = next_cursor
     return jsonify(return_json)
 
 
@@ -400,9 +424,15 @@ def send_batch():
     returned_v = [v["video_id"] for v in labels]
     if Counter(original_v) != Counter(returned_v) or video_jwt["user_id"] != user_jwt["user_id"]:
         raise InvalidUsage("Signature of the video batch is not valid", status_code=401)
+    # Return the same score for a replayed batch without processing the batch again
+    jti = video_jwt.get("jti")
+    score = get_replayed_score(jti)
+    if score is not None:
+        return jsonify({"data": {"score": score}})
     # Update database
     try:
-        score = update_labels(labels, user_jwt["user_id"], user_jwt["connection_id"], video_jwt["batch_id"], user_jwt["client_type"])
+        score = update_labels(labels, user_jwt["user_id"], user_jwt["connection_id"], video_jwt["batch_id"], user_jwt["client_type"], jti=jti)
+        remember_consumed_token(jti, score)
         return_json = {"data": {"score": score}}
         return jsonify(return_json)
     except Exception as ex:
@@ -434,9 +464,15 @@ def send_segmentation_batch():
     returned_v = [v["id"] for v in labels]
     if Counter(original_v) != Counter(returned_v) or video_jwt["user_id"] != user_jwt["user_id"]:
         raise InvalidUsage("Signature of the segmentation batch is not valid", status_code=401)
+    # Return the same score for a replayed batch without processing the batch again
+    jti = video_jwt.get("jti")
+    score = get_replayed_score(jti)
+    if score is not None:
+        return jsonify({"data": {"score": score}})
     # Update database
     try:
-        score = update_segmentation_labels(labels, user_jwt["user_id"], user_jwt["connection_id"], video_jwt["batch_id"], user_jwt["client_type"])
+        score = update_segmentation_labels(labels, user_jwt["user_id"], user_jwt["connection_id"], video_jwt["batch_id"], user_jwt["client_type"], jti=jti)
+        remember_consumed_token(jti, score)
         return_json = {"data": {"score": score}}
         return jsonify(return_json)
     except Exception as ex:
@@ -505,6 +541,91 @@ def set_segmentation_label_state():
         raise InvalidUsage(ex.args[0], status_code=400)
 
 
+def relabel_check_request(request_json):
+    """Decode the user token of a bulk relabeling call and verify that the user is a researcher."""
+    user_jwt = batch_check_request(request_json)
+    if user_jwt["client_type"] != 0:
+        raise InvalidUsage("Permission denied", status_code=403)
+    return user_jwt
+
+
+def bulk_set_label_state_by_type(data_type):
+    """Create a bulk relabeling job for the data type, and return the job ID."""
+    request_json = request.get_json()
+    user_jwt = relabel_check_request(request_json)
+    if "data" not in request_json:
+        raise InvalidUsage("Missing field: data", status_code=400)
+    try:
+        job = create_relabel_job(data_type, user_jwt["user_id"], request_json["data"])
+    except Exception as ex:
+        raise InvalidUsage(ex.args[0], status_code=400)
+    start_relabel_job(job.id)
+    return make_response(jsonify({"data": {"job_id": job.id}}), 202)
+
+
+@bp.route("/bulk_set_label_state", methods=["POST"])
+def bulk_set_label_state():
+    """
+    Set a large number of video labels in the background (same data as the set_label_state call).
+    The labels are processed in chunks, and the progress can be polled with the get_relabel_job call.
+    Only admin (client type 0) can use this call.
+    """
+    return bulk_set_label_state_by_type("video")
+
+
+@bp.route("/bulk_set_segmentation_label_state", methods=["POST"])
+def bulk_set_segmentation_label_state():
+    """
+    Set a large number of segmentation labels in the background (same data as the set_segmentation_label_state call).
+    The labels are processed in chunks, and the progress can be polled with the get_relabel_job call.
+    Only admin (client type 0) can use this call.
+    """
+    return bulk_set_label_state_by_type("segmentation")
+
+
+@bp.route("/retry_relabel_job", methods=["POST"])
+def retry_failed_relabel_job():
+    """
+    Run a failed bulk relabeling job again from the labels that were not processed.
+    A running job that has not updated its progress for a while (e.g., after a server restart) can also be retried.
+    The optional data field replaces the labels that were not processed (e.g., to fix the failed chunk).
+    Only admin (client type 0) can use this call.
+    """
+    request_json = request.get_json()
+    relabel_check_request(request_json)
+    if "job_id" not in request_json:
+        raise InvalidUsage("Missing field: job_id", status_code=400)
+    try:
+        job = retry_relabel_job(request_json["job_id"], request_json.get("data"))
+    except Exception as ex:
+        raise InvalidUsage(ex.args[0], status_code=400)
+    start_relabel_job(job.id)
+    return make_response(jsonify({"data": {"job_id": job.id}}), 202)
+
+
+@bp.route("/get_relabel_job", methods=["POST"])
+def get_relabel_job_status():
+    """
+    Get the progress of a bulk relabeling job.
+    Only admin (client type 0) can use this call.
+    """
+    request_json = request.get_json()
+    relabel_check_request(request_json)
+    if "job_id" not in request_json:
+        raise InvalidUsage("Missing field: job_id", status_code=400)
+    job = get_relabel_job(request_json["job_id"])
+    if job is None:
+        raise InvalidUsage("Job not found", status_code=404)
+    return jsonify({"data": {
+        "job_id": job.id,
+        "data_type": job.data_type,
+        "status": job.status,
+        "num_total": job.num_total,
+        "num_done": job.num_done,
+        "error": job.error
+    }})
+
+
 @bp.route("/get_pos_labels", methods=["GET", "POST"])
 def get_pos_labels():
     """
@@ -625,6 +746,20 @@ def get_all_labels():
     return get_video_labels(None, only_admin=True)
 
 
+def check_cursor(cursor):
+    """Verify the cursor of the keyset pagination (None means using the page number)."""
+    if cursor is None: return
+    try:
+        decode_cursor(cursor)
+    except Exception as ex:
+        raise InvalidUsage(ex.args[0], status_code=400)
+
+
+def get_next_cursor(q):
+    """Get the cursor of the next page (only the keyset pagination has it)."""
+    return q.next_cursor if isinstance(q, KeysetPage) else None
+
+
 def get_video_labels(labels, allow_user_id=False, only_admin=False, use_admin_label_state=False):
     """
     Return a list of videos with specific type of labels.
@@ -650,6 +785,8 @@ def get_video_labels(labels, allow_user_id=False, only_admin=False, use_admin_la
     user_id = request.args.get("user_id") if allow_user_id else None
     page_number = request.args.get("pageNumber", 1, type=int)
     page_size = request.args.get("pageSize", 16, type=int)
+    # If the cursor is given, use the keyset pagination instead of the page number
+    cursor = request.args.get("cursor")
     user_jwt = None
     data = request.get_data()
     if data is not None:
@@ -666,6 +803,8 @@ def get_video_labels(labels, allow_user_id=False, only_admin=False, use_admin_la
             page_number = int(qs["pageNumber"][0])
         if "pageSize" in qs:
             page_size = int(qs["pageSize"][0])
+        if "cursor" in qs:
+            cursor = qs["cursor"][0]
     if only_admin:
         # Verify if user_token is returned
         if user_jwt is None:
@@ -673,22 +812,27 @@ def get_video_labels(labels, allow_user_id=False, only_admin=False, use_admin_la
         # Verify if the user is researcher or expert (they are considered admins in this case)
         if user_jwt["client_type"] != 0 and user_jwt["client_type"] != 1:
             raise InvalidUsage("Permission denied", status_code=403)
+    check_cursor(cursor)
     is_admin = True if user_jwt is not None and (user_jwt["client_type"] == 0 or user_jwt["client_type"] == 1) else False
     is_researcher = True if user_jwt is not None and user_jwt["client_type"] == 0 else False
     if user_id is None:
         if labels is None and is_admin:
             return jsonify_data(get_all_videos(), is_admin=True)
         else:
-            q = get_video_query(labels, page_number, page_size, use_admin_label_state=use_admin_label_state)
+            q = get_video_query(labels, page_number, page_size,
+                use_admin_label_state=use_admin_label_state, cursor=cursor)
+            # Serialize the videos before recording the views, because writing the views can commit and expire them
+            response = jsonify_data(q.items, total=q.total, is_admin=is_admin, with_detail=True, next_cursor=get_next_cursor(q))
             if not is_researcher: # ignore researcher
                 create_views_from_video_batch(q.items, user_jwt, query_type=0)
-            return jsonify_data(q.items, total=q.total, is_admin=is_admin, with_detail=True)
+            return response
     else:
-        q = get_pos_video_query_by_user_id(user_id, page_number, page_size, is_researcher)
+        q = get_pos_video_query_by_user_id(user_id, page_number, page_size, is_researcher, cursor=cursor)
+        # We need to set is_admin to True here because we want to show user agreements in the data
+        response = jsonify_data(q.items, total=q.total, is_admin=True, next_cursor=get_next_cursor(q))
         if not is_researcher: # ignore researcher
             create_views_from_video_batch(q.items, user_jwt, query_type=1)
-        # We need to set is_admin to True here because we want to show user agreements in the data
-        return jsonify_data(q.items, total=q.total, is_admin=True)
+        return response
 
 
 @bp.route("/get_label_statistics", methods=["GET"])
@@ -882,6 +1026,8 @@ def get_segmentation_masks(labels, allow_user_id=False, only_admin=False, use_ad
     user_id = request.args.get("user_id", None, type=int) if allow_user_id else None
     page_number = request.args.get("pageNumber", 1, type=int)
     page_size = request.args.get("pageSize", 16, type=int)
+    # If the cursor is given, use the keyset pagination instead of the page number
+    cursor = request.args.get("cursor")
     user_jwt = None
     data = request.get_data()
     if data is not None:
@@ -898,6 +1044,8 @@ def get_segmentation_masks(labels, allow_user_id=False, only_admin=False, use_ad
             page_number = int(qs["pageNumber"][0])
         if "pageSize" in qs:
             page_size = int(qs["pageSize"][0])
+        if "cursor" in qs:
+            cursor = qs["cursor"][0]
     if only_admin:
         # Verify if user_token is returned
         if user_jwt is None:
@@ -905,24 +1053,30 @@ def get_segmentation_masks(labels, allow_user_id=False, only_admin=False, use_ad
         # Verify if the user is researcher or expert (they are considered admins in this case)
         if user_jwt["client_type"] != 0 and user_jwt["client_type"] != 1:
             raise InvalidUsage("Permission denied", status_code=403)
+    check_cursor(cursor)
     is_admin = True if user_jwt is not None and (user_jwt["client_type"] == 0 or user_jwt["client_type"] == 1) else False
     is_researcher = True if user_jwt is not None and user_jwt["client_type"] == 0 else False
     if user_id is None:
         if labels is None and is_admin:
             return jsonify_data(get_all_segmentations(), is_admin=True, is_video=False)
         else:
-            q = get_segmentation_query(labels, page_number, page_size, use_admin_label_state=use_admin_label_state)
+            q = get_segmentation_query(labels, page_number, page_size,
+                use_admin_label_state=use_admin_label_state, cursor=cursor)
             filtered_q = only_latest_researcher_feedback(q.items)
+            # Serialize the segmentation masks before recording the views, because writing the views can commit and expire them
+            response = jsonify_data(filtered_q, total=q.total, is_admin=is_admin, with_detail=True, is_video=False,
+                next_cursor=get_next_cursor(q))
             if not is_researcher: # ignore researcher
                 create_segmentation_views_from_segmentation_batch(filtered_q, user_jwt, query_type=0)
-            return jsonify_data(filtered_q, total=q.total, is_admin=is_admin, with_detail=True, is_video=False)
+            return response
     else:
-        q = get_pos_segmentation_query_by_user_id(user_id, page_number, page_size, is_researcher)
+        q = get_pos_segmentation_query_by_user_id(user_id, page_number, page_size, is_researcher, cursor=cursor)
         filtered_q = filter_feedback_by_user_id(q.items, user_id)
+        # We need to set is_admin to True here because we want to show user agreements in the data
+        response = jsonify_data(filtered_q, total=q.total, is_admin=True, is_video=False, next_cursor=get_next_cursor(q))
         if not is_researcher: # ignore researcher
             create_segmentation_views_from_segmentation_batch(filtered_q, user_jwt, query_type=1)
-        # We need to set is_admin to True here because we want to show user agreements in the data
-        return jsonify_data(filtered_q, total=q.total, is_admin=True, is_video=False)
+        return response
 
 
 def ensure_cache_directory(file_path):
@@ -42,6 +42,39 @@ discorded_labels_seg = [7, 8]
 bad_labels_seg = [-2]
 partial_labels_seg = maybe_pos_labels_seg + maybe_neg_labels_seg + discorded_labels_seg
 
+# Feedback codes for segmentation masks that are provided by researchers
+# Check the bbox_to_feedback_code function in `segmentationFeedback_operations.py` for details
+researcher_feedback_codes_seg = [3, 4, 5, 16, 17, 18, -1, -2]
+
+
+def aggregated_label_clause(label_state, label_state_admin, labels, full_labels, excluded_labels):
+    """
+    Get the SQL clause of the aggregated (citizen and researcher) label for the gallery queries.
+
+    Researcher labels override citizen labels.
+    The same clause is used in the partial indexes, so that the planner can match the queries with the indexes.
+
+    Parameters
+    ----------
+    label_state : sqlalchemy.Column
+        The label_state column.
+    label_state_admin : sqlalchemy.Column
+        The label_state_admin column.
+    labels : list of int
+        The label states to get (e.g., the positive labels).
+    full_labels : list of int
+        The label states that the researcher decided (i.e., the positive and negative labels).
+    excluded_labels : list of int
+        The label states to exclude (i.e., the gold standards and bad labels).
+    """
+    return db.and_(
+        label_state_admin.notin_(excluded_labels),
+        db.or_(
+            label_state_admin.in_(labels),
+            db.and_(
+                label_state_admin.notin_(full_labels),
+                label_state.in_(labels))))
+
 
 class User(db.Model):
     """
@@ -143,6 +176,15 @@ class Video(db.Model):
         The priority of the video.
         Higher priority indicates that the mask should get feedback faster.
         Larger number means higher priority (e.g., 5 has higher priority than 4)
+    reserved_until : int
+        The epochtime (in seconds) until which the video is reserved for a citizen who got it in a batch.
+        Reserved videos are not given to other citizens, to prevent duplicate labeling work.
+        Null or a time in the past means that the video is not reserved.
+
+    label_version : int
+        The number of times that the label states (label_state or label_state_admin) have been moved.
+        Each label that moves the states records the version it produces (see the Label table),
+        ...so that the states can be rebuilt by replaying the labels in order (see `projection_operations.py`).
     """
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String(255), unique=True, nullable=False)
@@ -155,9 +197,28 @@ class Video(db.Model):
     view_id = db.Column(db.Integer, nullable=False, default=-1)
     camera_id = db.Column(db.Integer, nullable=False, default=-1)
     priority = db.Column(db.Integer, nullable=False, default=1)
+    reserved_until = db.Column(db.Integer, index=True)
+    label_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     # Relationships
     label = db.relationship("Label", backref=db.backref("video", lazy=True), lazy=True)
     view = db.relationship("View", backref=db.backref("video", lazy=True), lazy=True)
+    # Indexes
+    # (for the gallery queries that filter one type of label state, in the order of the label update time)
+    __table_args__ = (
+        db.Index("ix_video_label_state_label_update_time",
+            label_state, label_update_time.desc().nulls_last(), id.desc()),
+        db.Index("ix_video_label_state_admin_label_update_time",
+            label_state_admin, label_update_time.desc().nulls_last(), id.desc()),
+        # (for the gallery queries of the aggregated positive and negative labels, see the get_video_query function)
+        db.Index("ix_video_pos_label_update_time",
+            label_update_time.desc().nulls_last(), id.desc(),
+            postgresql_where=aggregated_label_clause(label_state, label_state_admin,
+                pos_labels, pos_labels + neg_labels, gold_labels + bad_labels)),
+        db.Index("ix_video_neg_label_update_time",
+            label_update_time.desc().nulls_last(), id.desc(),
+            postgresql_where=aggregated_label_clause(label_state, label_state_admin,
+                neg_labels, pos_labels + neg_labels, gold_labels + bad_labels)),
+    )
 
     def __repr__(self):
         return (
@@ -192,6 +253,14 @@ class Label(db.Model):
     batch_id : int
         The batch ID in the Batch table (foreign key).
         A null batch ID means that an admin changed the label and created a record.
+    client_type : int
+        The type of the user when the label was added (see the User table).
+        This decides which label state the label moves (label_state_admin for client type 0).
+    version : int
+        The label version of the video (Video.label_version) after adding the label.
+        Labels that did not move the label states have the version that they were checked against.
+        The labels are an append-only event log, and the label states of the videos are its projection,
+        ...which can be rebuilt by replaying the labels of each video ordered by version and ID.
     """
     id = db.Column(db.Integer, primary_key=True)
     video_id = db.Column(db.Integer, db.ForeignKey("video.id"), nullable=False)
@@ -199,6 +268,17 @@ class Label(db.Model):
     time = db.Column(db.Integer, nullable=False, default=get_current_time)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
     batch_id = db.Column(db.Integer, db.ForeignKey("batch.id"))
+    client_type = db.Column(db.Integer)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Indexes
+    # (for reading the video IDs labeled by a user, and only the labels added after a known label ID)
+    __table_args__ = (
+        db.Index("ix_label_user_id_id", "user_id", "id", postgresql_include=["video_id"]),
+        # (for excluding the videos labeled by a user with an anti-join when sampling batches)
+        db.Index("ix_label_user_id_video_id", "user_id", "video_id"),
+        # (for replaying the labels of videos in order when rebuilding the label states)
+        db.Index("ix_label_video_id_version_id", "video_id", "version", "id"),
+    )
 
     def __repr__(self):
         return (
@@ -232,6 +312,11 @@ class Connection(db.Model):
     # Relationships
     batch = db.relationship("Batch", backref=db.backref("connection", lazy=True), lazy=True)
     view = db.relationship("View", backref=db.backref("connection", lazy=True), lazy=True)
+    # Indexes
+    # (for finding the recent connection of a user to reuse when issuing or refreshing tokens)
+    __table_args__ = (
+        db.Index("ix_connection_user_id_client_type_time", "user_id", "client_type", "time"),
+    )
 
     def __repr__(self):
         return (
@@ -266,6 +351,9 @@ class Batch(db.Model):
         Current score of the user (User.score).
     user_raw_score : int
         Current raw score of the user (User.raw_score).
+    jti : str
+        The unique ID of the batch token (JWT ID) that the client returned with the labels.
+        A token can only be consumed once, so that the same batch is not processed twice.
     """
     id = db.Column(db.Integer, primary_key=True)
     request_time = db.Column(db.Integer, nullable=False, default=get_current_time)
@@ -276,6 +364,7 @@ class Batch(db.Model):
     num_gold_standard = db.Column(db.Integer, nullable=False, default=0)
     user_score = db.Column(db.Integer)
     user_raw_score = db.Column(db.Integer)
+    jti = db.Column(db.String(32), unique=True)
     # Relationships
     label = db.relationship("Label", backref=db.backref("batch", lazy=True), lazy=True)
 
@@ -414,6 +503,15 @@ class SegmentationMask(db.Model):
         The format should be epoch time in seconds.
     video_id : int
         The corresponding video ID (can be null if no video is linked to this mask)
+    reserved_until : int
+        The epochtime (in seconds) until which the mask is reserved for a citizen who got it in a batch.
+        Reserved masks are not given to other citizens, to prevent duplicate labeling work.
+        Null or a time in the past means that the mask is not reserved.
+
+    label_version : int
+        The number of times that the label states (label_state or label_state_admin) have been moved.
+        Each label that moves the states records the version it produces (see the Label table),
+        ...so that the states can be rebuilt by replaying the labels in order (see `projection_operations.py`).
     """
     id = db.Column(db.Integer, primary_key=True)
     mask_file_name = db.Column(db.String(255), unique=False, nullable=False)
@@ -432,9 +530,29 @@ class SegmentationMask(db.Model):
     frame_number = db.Column(db.Integer, nullable=True)
     frame_timestamp = db.Column(db.Integer, nullable=True)
     video_id = db.Column(db.Integer, db.ForeignKey("video.id"))
+    reserved_until = db.Column(db.Integer, index=True)
+    label_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     # Relationships
     feedback = db.relationship("SegmentationFeedback", backref=db.backref("segmentation_mask", lazy=True), lazy=True)
     video = db.relationship("Video", backref=db.backref("segmentation_mask", lazy=True), lazy=True)
+    latest_feedback = db.relationship("SegmentationLatestFeedback", backref=db.backref("segmentation_mask", lazy=True), lazy=True)
+    # Indexes
+    # (for the gallery queries that filter one type of label state, in the order of the label update time)
+    __table_args__ = (
+        db.Index("ix_segmentation_mask_label_state_label_update_time",
+            label_state, label_update_time.desc().nulls_last(), id.desc()),
+        db.Index("ix_segmentation_mask_label_state_admin_label_update_time",
+            label_state_admin, label_update_time.desc().nulls_last(), id.desc()),
+        # (for the gallery queries of the aggregated positive and negative labels, see the get_segmentation_query function)
+        db.Index("ix_segmentation_mask_pos_label_update_time",
+            label_update_time.desc().nulls_last(), id.desc(),
+            postgresql_where=aggregated_label_clause(label_state, label_state_admin,
+                pos_labels_seg, pos_labels_seg + neg_labels_seg, bad_labels_seg + gold_labels_seg)),
+        db.Index("ix_segmentation_mask_neg_label_update_time",
+            label_update_time.desc().nulls_last(), id.desc(),
+            postgresql_where=aggregated_label_clause(label_state, label_state_admin,
+                neg_labels_seg, pos_labels_seg + neg_labels_seg, bad_labels_seg + gold_labels_seg)),
+    )
 
     def __repr__(self):
         return (
@@ -485,6 +603,12 @@ class SegmentationFeedback(db.Model):
     batch_id : int
         The batch ID in the Batch table (foreign key).
         A null batch ID means that an admin changed the label and created a record.
+    client_type : int
+        The type of the user when the feedback was added (see the User table).
+        This decides which label state the feedback moves (label_state_admin for client type 0).
+    version : int
+        The label version of the segmentation mask (SegmentationMask.label_version) after adding the feedback.
+        Same as the version in the Label table, the feedback is the event log of the segmentation label states.
     """
     id = db.Column(db.Integer, primary_key=True)
     segmentation_id = db.Column(db.Integer, db.ForeignKey("segmentation_mask.id"), nullable=False)
@@ -497,6 +621,17 @@ class SegmentationFeedback(db.Model):
     time = db.Column(db.Integer, nullable=False, default=get_current_time)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     batch_id = db.Column(db.Integer, db.ForeignKey("segmentation_batch.id"))
+    client_type = db.Column(db.Integer)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # Indexes
+    # (for reading the segmentation IDs labeled by a user, and only the feedback added after a known feedback ID)
+    __table_args__ = (
+        db.Index("ix_segmentation_feedback_user_id_id", "user_id", "id", postgresql_include=["segmentation_id"]),
+        # (for excluding the segmentation masks labeled by a user with an anti-join when sampling batches)
+        db.Index("ix_segmentation_feedback_user_id_segmentation_id", "user_id", "segmentation_id"),
+        # (for replaying the feedback of segmentation masks in order when rebuilding the label states)
+        db.Index("ix_segmentation_feedback_segmentation_id_version_id", "segmentation_id", "version", "id"),
+    )
 
     def __repr__(self):
         return (
@@ -509,6 +644,41 @@ class SegmentationFeedback(db.Model):
         )
 
 
+class SegmentationLatestFeedback(db.Model):
+    """
+    Class representing the latest researcher feedback of a segmentation mask for each feedback code.
+
+    The rows are kept up to date when feedback is added (see the update_segmentation_labels function),
+    ...so that the gallery and the gold standard scoring do not need to scan all feedback of the masks.
+    Use the `backfill_latest_feedback.py` script to fill the table from the existing feedback.
+
+    Attributes
+    ----------
+    segmentation_id : int
+        The segmentation ID in the SegmentationMask table (foreign key, part of the primary key).
+    feedback_code : int
+        The researcher feedback code (part of the primary key).
+        See the researcher_feedback_codes_seg list at the top of this file.
+    feedback_id : int
+        The ID of the latest feedback in the SegmentationFeedback table (foreign key).
+    time : int
+        The epochtime (in seconds) when the latest feedback was created.
+    """
+    segmentation_id = db.Column(db.Integer, db.ForeignKey("segmentation_mask.id"), primary_key=True)
+    feedback_code = db.Column(db.Integer, primary_key=True)
+    feedback_id = db.Column(db.Integer, db.ForeignKey("segmentation_feedback.id", ondelete="CASCADE"), nullable=False)
+    time = db.Column(db.Integer, nullable=False)
+    # Relationships
+    feedback = db.relationship("SegmentationFeedback", lazy=True)
+
+    def __repr__(self):
+        return (
+            "<SegmentationLatestFeedback segmentation_id=%r feedback_code=%r feedback_id=%r time=%r>"
+        ) % (
+            self.segmentation_id, self.feedback_code, self.feedback_id, self.time
+        )
+
+
 class SegmentationBatch(db.Model):
     """
     Class
@@ -537,6 +707,9 @@ class SegmentationBatch(db.Model):
     user_raw_score : int
         Current raw score of the user (User.raw_score).
         This means how many segmentation masks that the user already provided feedback.
+    jti : str
+        The unique ID of the batch token (JWT ID) that the client returned with the feedback.
+        A token can only be consumed once, so that the same batch is not processed twice.
     """
 
     id = db.Column(db.Integer, primary_key=True)
@@ -548,6 +721,7 @@ class SegmentationBatch(db.Model):
     num_gold_standard = db.Column(db.Integer, nullable=False, default=0)
     user_score = db.Column(db.Integer)
     user_raw_score = db.Column(db.Integer)
+    jti = db.Column(db.String(32), unique=True)
     # Relationships
     feedback = db.relationship("SegmentationFeedback", backref=db.backref("segmentation_batch", lazy=True), lazy=True)
 
@@ -593,4 +767,180 @@ class SegmentationView(db.Model):
             "<SegmentationView id=%r connection_id=%r segmentation_id=%r query_type=%r time=%r>"
         ) % (
             self.id, self.connection_id, self.segmentation_id, self.query_type, self.time
-        )
\ No newline at end of file
+        )
+
+
+class RelabelJob(db.Model):
+    """
+    Class representing a bulk relabeling job by the admin researcher (processed in chunks in the background).
+
+    Attributes
+    ----------
+    id : int
+        Unique identifier (primary key).
+    data_type : str
+        The type of data to relabel, "video" or "segmentation".
+    user_id : int
+        The user ID in the User table (foreign key), the researcher who created the job.
+    status : str
+        The status of the job.
+        "queued" => the job is created but not started yet.
+        "running" => the chunks are being processed.
+        "done" => all chunks are processed.
+        "failed" => a chunk could not be processed (the chunks before it are kept).
+    data : list of dict
+        The labels to set, same as the data field of the set_label_state or set_segmentation_label_state call.
+    num_total : int
+        The number of labels in the job.
+    num_done : int
+        The number of labels that have been processed (updated in the same transaction as each chunk).
+    error : str
+        The error message if the job failed.
+    create_time : int
+        The epochtime (in seconds) when the job is created.
+    update_time : int
+        The epochtime (in seconds) when the job is updated.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    data_type = db.Column(db.String(32), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    status = db.Column(db.String(32), nullable=False, default="queued")
+    data = db.Column(db.JSON, nullable=False)
+    num_total = db.Column(db.Integer, nullable=False, default=0)
+    num_done = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    create_time = db.Column(db.Integer, nullable=False, default=get_current_time)
+    update_time = db.Column(db.Integer, nullable=False, default=get_current_time)
+
+    def __repr__(self):
+        return (
+            "<RelabelJob id=%r data_type=%r user_id=%r status=%r num_total=%r num_done=%r "
+            "error=%r create_time=%r update_time=%r>"
+        ) % (
+            self.id, self.data_type, self.user_id, self.status, self.num_total, self.num_done,
+            self.error, self.create_time, self.update_time
+        )
+
+
+class ProjectionCheckpoint(db.Model):
+    """
+    Class representing how far the label events have been projected to the label states.
+
+    The label states are maintained when labels are added,
+    ...and the projector in `projection_operations.py` replays the events after the checkpoint to keep them consistent.
+
+    Attributes
+    ----------
+    name : str
+        The name of the projection (primary key), "video" or "segmentation".
+    event_id : int
+        The ID of the last event (in the Label or SegmentationFeedback table) that has been projected.
+    update_time : int
+        The epochtime (in seconds) when the checkpoint is updated.
+    """
+    name = db.Column(db.String(32), primary_key=True)
+    event_id = db.Column(db.Integer, nullable=False, default=0)
+    update_time = db.Column(db.Integer, nullable=False, default=get_current_time)
+
+    def __repr__(self):
+        return (
+            "<ProjectionCheckpoint name=%r event_id=%r update_time=%r>"
+        ) % (
+            self.name, self.event_id, self.update_time
+        )
+
+
+class ViewCount(db.Model):
+    """
+    Class representing the number of views of a video in a day (for the aggregated view recording mode).
+
+    The counters replace the rows in the View table when config.VIEW_RECORDING_MODE is "aggregated",
+    ...and the `rollup_views.py` script compacts old rows in the View table into the counters.
+    The counters do not keep the connection of each view.
+
+    Attributes
+    ----------
+    video_id : int
+        The video ID in the Video table (foreign key, part of the primary key).
+    query_type : int
+        The query type about how the client requested the video (part of the primary key).
+        See the View table for definition.
+    day : int
+        The epochtime (in seconds) at the start of the day (in UTC) of the views (part of the primary key).
+    count : int
+        The number of views.
+    """
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id"), primary_key=True)
+    query_type = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return (
+            "<ViewCount video_id=%r query_type=%r day=%r count=%r>"
+        ) % (
+            self.video_id, self.query_type, self.day, self.count
+        )
+
+
+class SegmentationViewCount(db.Model):
+    """
+    Class representing the number of views of a segmentation mask in a day (for the aggregated view recording mode).
+
+    Attributes
+    ----------
+    segmentation_id : int
+        The segmentation mask ID in the SegmentationMask table (foreign key, part of the primary key).
+    query_type : int
+        The query type about how the client requested the segmentation mask (part of the primary key).
+        See the SegmentationView table for definition.
+    day : int
+        The epochtime (in seconds) at the start of the day (in UTC) of the views (part of the primary key).
+    count : int
+        The number of views.
+    """
+    segmentation_id = db.Column(db.Integer, db.ForeignKey("segmentation_mask.id"), primary_key=True)
+    query_type = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return (
+            "<SegmentationViewCount segmentation_id=%r query_type=%r day=%r count=%r>"
+        ) % (
+            self.segmentation_id, self.query_type, self.day, self.count
+        )
+
+
+class VideoUncertainty(db.Model):
+    """
+    Class representing the model uncertainty of a video (for active learning).
+
+    The scores are computed offline (e.g., from the predictions of the deep-smoke-machine repository)
+    ...and loaded in bulk by the `add_uncertainty.py` script.
+
+    Attributes
+    ----------
+    video_id : int
+        The video ID in the Video table (primary key and foreign key).
+    score : float
+        The uncertainty score of the model prediction for the video.
+        Larger number means that the model is less certain (e.g., the prediction is close to 0.5).
+    update_time : int
+        The epochtime (in seconds) when the score is updated.
+    """
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id"), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    update_time = db.Column(db.Integer, nullable=False, default=get_current_time)
+    # Indexes
+    # (for scanning the most uncertain videos in order, without sorting the table)
+    __table_args__ = (
+        db.Index("ix_video_uncertainty_score", score.desc()),
+    )
+
+    def __repr__(self):
+        return (
+            "<VideoUncertainty video_id=%r score=%r update_time=%r>"
+        ) % (
+            self.video_id, self.score, self.update_time
+        )
@@ -5,15 +5,24 @@ from models.model import Batch
 from app.app import app
 
 
-def create_batch(num_gold_standard, num_unlabeled, connection_id):
-    """Create a batch."""
+def create_batch(num_gold_standard, num_unlabeled, connection_id, commit=True):
+    """
+    Create a batch.
+
+    Set commit to False to only flush the batch (to get its ID),
+    ...so that the objects loaded in the session are not expired before they are serialized.
+    The caller then needs to commit the session.
+    """
     batch = Batch(
         num_gold_standard=num_gold_standard,
         num_unlabeled=num_unlabeled,
         connection_id=connection_id
     )
     db.session.add(batch)
-    db.session.commit()
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
     app.logger.info("Create batch: %r" % batch)
     return batch
 
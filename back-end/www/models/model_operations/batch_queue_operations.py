@@ -0,0 +1,230 @@
+"""Functions to pre-assemble batches in the background and hand them out to users."""
+
+import threading
+from collections import deque
+from random import shuffle
+from models.model import db
+from models.model_operations.video_operations import query_video_batch
+from models.model_operations.video_operations import get_video_id_set_labeled_by_user
+from models.model_operations.segmentationMask_operations import query_segmentation_batch
+from models.model_operations.segmentationMask_operations import get_segmentation_id_set_labeled_by_user
+from models.model_operations.sampling_operations import gold_standard_types
+from models.model_operations.sampling_operations import pool_bucket
+from models.model_operations.sampling_operations import is_admin_candidate
+from models.model_operations.sampling_operations import draw_candidate_batch
+from models.model_operations.sampling_operations import load_items
+from models.model_operations.sampling_operations import reserve_items
+from util.id_set import id_set_contains
+from util.id_set import id_set_union
+from app.app import app
+from config.config import config
+
+
+# The modes of the batch queues, which map to the type of data and whether the batch is for the admin researcher
+BATCH_QUEUE_MODES = {
+    "video_citizen": ("video", False),
+    "video_admin": ("video", True),
+    "segmentation_citizen": ("segmentation", False),
+    "segmentation_admin": ("segmentation", True)
+}
+
+# The pre-assembled batches of this worker process (keyed by mode)
+# Each batch is a dictionary with the IDs of the gold standards and the IDs of other items
+# Only IDs are kept, so the batches are loaded and validated again when they are handed out
+batch_queues = {mode: deque() for mode in BATCH_QUEUE_MODES}
+
+# The background thread that refills the queues, and the event to wake it up
+batch_queue_worker = {"thread": None}
+batch_queue_worker_lock = threading.Lock()
+refill_event = threading.Event()
+
+
+def start_batch_queue_worker():
+    """Start the background thread that refills the batch queues (if it is not running yet)."""
+    t = batch_queue_worker["thread"]
+    if t is not None and t.is_alive(): return
+    with batch_queue_worker_lock:
+        t = batch_queue_worker["thread"]
+        if t is not None and t.is_alive(): return
+        t = threading.Thread(target=run_batch_queue_worker, name="batch-queue", daemon=True)
+        t.start()
+        batch_queue_worker["thread"] = t
+    app.logger.info("Start the batch queue worker")
+
+
+def run_batch_queue_worker():
+    """Refill the batch queues when they are short, or every config.BATCH_QUEUE_REFILL_INTERVAL seconds."""
+    with app.app_context():
+        while True:
+            try:
+                refill_batch_queues()
+            except Exception as ex:
+                app.logger.error("Error when refilling the batch queues: %r" % ex)
+            finally:
+                # Do not keep the database session (and the loaded objects) between rounds
+                db.session.remove()
+            refill_event.wait(timeout=config.BATCH_QUEUE_REFILL_INTERVAL)
+            refill_event.clear()
+
+
+def refill_batch_queues():
+    """Fill the batch queues that are below config.BATCH_QUEUE_REFILL_THRESHOLD up to config.BATCH_QUEUE_DEPTH."""
+    for mode in BATCH_QUEUE_MODES:
+        q = batch_queues[mode]
+        if len(q) >= config.BATCH_QUEUE_REFILL_THRESHOLD: continue
+        while len(q) < config.BATCH_QUEUE_DEPTH:
+            batch = assemble_batch(mode)
+            if batch is None: break
+            q.append(batch)
+
+
+def assemble_batch(mode):
+    """
+    Assemble a batch that does not depend on a specific user.
+
+    Parameters
+    ----------
+    mode : str
+        The mode of the batch queue (see BATCH_QUEUE_MODES).
+
+    Returns
+    -------
+    dict
+        The batch with the following keys:
+        - "gold" : list of int, the IDs of the gold standards.
+        - "items" : list of int, the IDs of other items.
+        Return None if there are not enough items.
+    """
+    data_type, is_admin = BATCH_QUEUE_MODES[mode]
+    if data_type == "video":
+        batch = query_video_batch(None, use_admin_label_state=is_admin)
+        batch_size = config.BATCH_SIZE
+    else:
+        batch = query_segmentation_batch(None, use_admin_label_state=is_admin)
+        batch_size = config.BATCH_SIZE_SEG
+    if batch is None or len(batch) < batch_size: return None
+    _, pos_labels, neg_labels = gold_standard_types[data_type]
+    gold_labels = pos_labels + neg_labels
+    return {
+        "gold": [o.id for o in batch if not is_admin and o.label_state_admin in gold_labels],
+        "items": [o.id for o in batch if is_admin or o.label_state_admin not in gold_labels]
+    }
+
+
+def is_valid_item(data_type, is_admin, o):
+    """Check if an item from a pre-assembled batch can still be given out."""
+    if is_admin:
+        return is_admin_candidate(data_type, o.label_state_admin)
+    return pool_bucket(data_type, o.label_state, o.label_state_admin) is not None
+
+
+def pop_batch(data_type, user_id, is_admin):
+    """
+    Pop a pre-assembled batch from the queue for the user.
+
+    The items labeled by the user before, and the items whose label states were changed, are filtered out.
+    For citizens, the partially labeled items are reserved for the user (see the reserve_items function),
+    ...and the items reserved by other citizens are also filtered out.
+    For citizens, the filtered items are replaced by drawing from the candidate pools.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    user_id : int
+        The ID in the User table.
+    is_admin : bool
+        Whether the batch is for the admin researcher.
+
+    Returns
+    -------
+    list of Video or SegmentationMask
+        The batch, or None if the queue is empty or the batch cannot be completed.
+    """
+    mode = "%s_%s" % (data_type, "admin" if is_admin else "citizen")
+    start_batch_queue_worker()
+    q = batch_queues[mode]
+    try:
+        batch = q.popleft()
+    except IndexError:
+        batch = None
+    if len(q) < config.BATCH_QUEUE_REFILL_THRESHOLD:
+        refill_event.set()
+    if batch is None: return None
+    if data_type == "video":
+        labeled = get_video_id_set_labeled_by_user(user_id)
+        batch_size = config.BATCH_SIZE
+        sampling_mode = config.VIDEO_SAMPLING_MODE
+    else:
+        labeled = get_segmentation_id_set_labeled_by_user(user_id)
+        batch_size = config.BATCH_SIZE_SEG
+        sampling_mode = config.SEGMENTATION_SAMPLING_MODE
+    # Load all items in one query and validate them
+    objects = load_items(data_type, batch["gold"] + batch["items"])
+    objects_hashed = {o.id: o for o in objects}
+    _, pos_labels, neg_labels = gold_standard_types[data_type]
+    gold = [objects_hashed[i] for i in batch["gold"] if i in objects_hashed and objects_hashed[i].label_state_admin in pos_labels + neg_labels]
+    if len(gold) < len(batch["gold"]): return None
+    is_labeled = id_set_contains(labeled, batch["items"])
+    items = [objects_hashed[i] for i, b in zip(batch["items"], is_labeled) if not b and i in objects_hashed and is_valid_item(data_type, is_admin, objects_hashed[i])]
+    if not is_admin:
+        # Reserve the partially labeled items for this user, and drop the ones reserved by other citizens
+        partial_ids = [o.id for o in items if pool_bucket(data_type, o.label_state, o.label_state_admin) == "partial"]
+        reserved = set(reserve_items(data_type, partial_ids))
+        items = [o for o in items if o.id in reserved or o.id not in partial_ids]
+    # Replace the filtered items
+    num_short = batch_size - len(gold) - len(items)
+    if num_short > 0:
+        if is_admin or sampling_mode not in ["pool", "weighted"]: return None
+        excluded = id_set_union(labeled, [o.id for o in items])
+        num_partially_labeled = int(num_short*config.PARTIAL_LABEL_RATIO)
+        selected = draw_candidate_batch(data_type, num_partially_labeled, num_short, excluded, weighted=sampling_mode=="weighted", reserve=True)
+        items += selected["unlabeled"] + selected["partial"]
+        if len(gold) + len(items) < batch_size: return None
+    batch = gold + items
+    shuffle(batch)
+    return batch
+
+
+def pop_video_batch(user_id, use_admin_label_state=False):
+    """
+    Get a batch of videos from the batch queue, or query one if the queue cannot give a batch.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    use_admin_label_state : bool
+        Whether the batch is for the admin researcher.
+
+    Returns
+    -------
+    list of Video
+        The video object is defined in the Video model.
+    """
+    if config.BATCH_QUEUE_ENABLED:
+        batch = pop_batch("video", user_id, use_admin_label_state)
+        if batch is not None: return batch
+    return query_video_batch(user_id, use_admin_label_state=use_admin_label_state)
+
+
+def pop_segmentation_batch(user_id, use_admin_label_state=False):
+    """
+    Get a batch of segmentation masks from the batch queue, or query one if the queue cannot give a batch.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    use_admin_label_state : bool
+        Whether the batch is for the admin researcher.
+
+    Returns
+    -------
+    list of SegmentationMask
+        The segmentation object is defined in the SegmentationMask model.
+    """
+    if config.BATCH_QUEUE_ENABLED:
+        batch = pop_batch("segmentation", user_id, use_admin_label_state)
+        if batch is not None: return batch
+    return query_segmentation_batch(user_id, use_admin_label_state=use_admin_label_state)
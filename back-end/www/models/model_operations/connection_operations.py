@@ -1,8 +1,20 @@
 """Functions to operate the connection table."""
 
+from sqlalchemy import select
 from models.model import db
 from models.model import Connection
+from util.cache import create_cache
+from util.cache import cache_get
+from util.cache import cache_set
+from util.cache import cache_delete
+from util.util import get_current_time
 from app.app import app
+from config.config import config
+
+
+# The recent connection of each user in this worker process, keyed by (user_id, client_type)
+# Each value is a tuple of the connection ID and the time when the connection was created
+recent_connection_cache = create_cache(config.CONNECTION_CACHE_SIZE, ttl=config.CONNECTION_REUSE_WINDOW)
 
 
 def create_connection(user_id, client_type):
@@ -14,11 +26,56 @@ def create_connection(user_id, client_type):
     return connection
 
 
+def get_or_create_connection(user_id, client_type):
+    """
+    Reuse the recent connection of a user, or create a connection if there is no recent one.
+
+    A connection is recent if it was created in the last config.CONNECTION_REUSE_WINDOW seconds.
+    The recent connection is served from the cache of this worker process,
+    ...and a cache miss costs one lookup on the (user_id, client_type, time) index.
+
+    Parameters
+    ----------
+    user_id : int
+        The user ID in the User table.
+    client_type : int
+        The current client type of the user.
+
+    Returns
+    -------
+    connection_id : int
+        The connection ID in the Connection table.
+    connection_time : int
+        The epochtime (in seconds) when the connection was created.
+    """
+    window = config.CONNECTION_REUSE_WINDOW
+    if window <= 0:
+        connection = create_connection(user_id, client_type)
+        return (connection.id, connection.time)
+    key = (user_id, client_type)
+    t = get_current_time()
+    recent = cache_get(recent_connection_cache, key)
+    if recent is None or t - recent[1] > window:
+        q = (select(Connection.id, Connection.time)
+            .where(Connection.user_id==user_id, Connection.client_type==client_type, Connection.time>=t-window)
+            .order_by(Connection.time.desc())
+            .limit(1))
+        recent = db.session.execute(q).first()
+        if recent is None:
+            connection = create_connection(user_id, client_type)
+            recent = (connection.id, connection.time)
+        else:
+            recent = (recent[0], recent[1])
+        cache_set(recent_connection_cache, key, recent)
+    return recent
+
+
 def remove_connection(connection_id):
     """Remove a connection."""
     connection = Connection.query.filter_by(id=connection_id).first()
     app.logger.info("Remove connection: %r" % connection)
     if connection is None:
         raise Exception("No connection found in the database to delete.")
+    cache_delete(recent_connection_cache, (connection.user_id, connection.client_type))
     db.session.delete(connection)
     db.session.commit()
@@ -0,0 +1,69 @@
+"""Functions to cache the total number of items in the gallery queries (for the paginated responses)."""
+
+from util.cache import create_cache
+from util.cache import cache_get
+from util.cache import cache_set
+from util.cache import cache_delete
+from util.cache import cache_clear
+from config.config import config
+
+
+# The totals of the gallery queries in this worker process, for each type of data
+# The keys are ("labels", labels, use_admin_label_state) or ("user", user_id, is_researcher)
+gallery_total_caches = {
+    "video": create_cache(config.GALLERY_TOTAL_CACHE_SIZE, ttl=config.GALLERY_TOTAL_CACHE_TTL),
+    "segmentation": create_cache(config.GALLERY_TOTAL_CACHE_SIZE, ttl=config.GALLERY_TOTAL_CACHE_TTL)
+}
+
+
+def get_labels_total_key(labels, use_admin_label_state):
+    """Get the cache key of a gallery query by the type of labels."""
+    labels = tuple(labels) if type(labels) == list else labels
+    return ("labels", labels, use_admin_label_state)
+
+
+def get_user_total_key(user_id, is_researcher):
+    """Get the cache key of a gallery query by user id."""
+    return ("user", int(user_id), is_researcher)
+
+
+def get_gallery_total(data_type, key, q):
+    """
+    Get the total number of items of a gallery query, and count them only on a cache miss.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    key : tuple
+        The cache key (see the get_labels_total_key and get_user_total_key functions).
+    q : flask_sqlalchemy.query.Query
+        The gallery query.
+
+    Returns
+    -------
+    int
+        The total number of items.
+    """
+    cache = gallery_total_caches[data_type]
+    total = cache_get(cache, key)
+    if total is None:
+        total = q.order_by(None).count()
+        cache_set(cache, key, total)
+    return total
+
+
+def invalidate_gallery_totals(data_type, user_id=None):
+    """
+    Remove the cached totals after writing labels.
+
+    If the label states have changed, all totals of the data type are removed (user_id is None).
+    Otherwise, only the totals of the queries by the user who added the labels are removed.
+    Other worker processes count again after config.GALLERY_TOTAL_CACHE_TTL seconds.
+    """
+    cache = gallery_total_caches[data_type]
+    if user_id is None:
+        cache_clear(cache)
+    else:
+        for is_researcher in [True, False]:
+            cache_delete(cache, get_user_total_key(user_id, is_researcher))
@@ -1,10 +1,23 @@
 """Functions to operate the label table."""
 
+from sqlalchemy import insert
+from sqlalchemy import update
+from sqlalchemy import select
+from sqlalchemy import func
 from models.model import db
 from models.model import Label
 from models.model import Video
-from models.model import User
 from models.model import Batch
+from models.model_operations.sampling_operations import update_candidate_pools
+from models.model_operations.sampling_operations import release_items
+from models.model_operations.sampling_operations import invalidate_gold_standards
+from models.model_operations.sampling_operations import is_gold_standard_change
+from models.model_operations.video_operations import add_video_ids_labeled_by_user
+from models.model_operations.user_operations import increment_user_scores
+from models.model_operations.replay_operations import claim_batch
+from models.model_operations.replay_operations import get_batch_score
+from models.model_operations.label_state_operations import transition_label_state
+from models.model_operations.gallery_total_operations import invalidate_gallery_totals
 from app.app import app
 from util.util import get_current_time
 from config.config import config
@@ -24,6 +37,25 @@ def create_label(video_id, y, user_id, batch_id):
     return label
 
 
+def create_labels(rows):
+    """
+    Create labels in bulk with one multi-row INSERT, without committing.
+
+    Parameters
+    ----------
+    rows : list of dict
+        The column values of the Label rows.
+
+    Returns
+    -------
+    list of int
+        The IDs of the created labels.
+    """
+    label_ids = db.session.execute(insert(Label).returning(Label.id), rows).scalars().all()
+    app.logger.info("Create %d labels" % len(label_ids))
+    return label_ids
+
+
 def remove_label(label_id):
     """Remove a label."""
     label = Label.query.filter_by(id=label_id).first()
@@ -34,7 +66,7 @@ def remove_label(label_id):
     db.session.commit()
 
 
-def update_labels(labels, user_id, connection_id, batch_id, client_type):
+def update_labels(labels, user_id, connection_id, batch_id, client_type, jti=None):
     """
     Update the Video table when a new label is added, return the score of the batch.
 
@@ -52,6 +84,10 @@ def update_labels(labels, user_id, connection_id, batch_id, client_type):
         The video batch id (defined in the batch table).
     client_type : int
         The type of user (defined in the user table).
+    jti : str
+        The unique ID of the batch token (JWT ID), which can only be consumed once.
+        If the batch was already returned, the batch is not processed again,
+        ...and the scores that were given to the batch are returned.
 
     Returns
     -------
@@ -65,54 +101,83 @@ def update_labels(labels, user_id, connection_id, batch_id, client_type):
     video_batch_hashed = {}
     for video in video_batch:
         video_batch_hashed[video.id] = video
-    # Find the user
-    user = User.query.filter(User.id==user_id).first()
-    # Update batch data
+    # Update batch data and user scores
     batch_score = None
+    user_score = None
+    user_raw_score = None
     if batch_id is not None and connection_id is not None:
-        batch = Batch.query.filter(Batch.id==batch_id).first()
-        batch.return_time = get_current_time()
-        batch.connection_id = connection_id
+        # Claim the batch first, so that a replayed or concurrent duplicate submission is not processed again
+        if not claim_batch(Batch, batch_id, jti, connection_id):
+            db.session.rollback()
+            return get_batch_score(Batch, batch_id)
         if client_type != 0: # do not update the score for reseacher
             batch_score = compute_video_batch_score(video_batch_hashed, labels)
-            batch.score = batch_score
-            batch.user_score = user.score
-            batch.user_raw_score = user.raw_score
-        app.logger.info("Update batch: %r" % batch)
+            # Add the scores in the database (the raw score is the number of unlabeled videos in the batch)
+            num_unlabeled = select(Batch.num_unlabeled).where(Batch.id==batch_id).scalar_subquery()
+            user_score, user_raw_score = increment_user_scores(user_id, batch_score, func.coalesce(num_unlabeled, 0))
+            # The batch keeps the user scores before adding this batch
+            stmt = (update(Batch)
+                .where(Batch.id==batch_id)
+                .values(score=batch_score, user_score=user_score - batch_score, user_raw_score=user_raw_score - func.coalesce(Batch.num_unlabeled, 0))
+                .execution_options(synchronize_session=False))
+            db.session.execute(stmt)
+        app.logger.info("Update batch %r: score=%r" % (batch_id, batch_score))
     # Add labeling history and update the video label state
     # If the batch score is 0, do not update the label history since this batch is not reliable
-    user_score = None
-    user_raw_score = None
-    if batch_score is not None:
-        user_raw_score = user.raw_score + batch.num_unlabeled
-        user.raw_score = user_raw_score
-        # Update user score
-        if client_type != 0: # do not update the score for reseacher
-            user_score = user.score + batch_score
-            user.score = user_score
-        app.logger.info("Update user: %r" % user)
+    state_changes = []
+    label_ids = []
     if batch_score != 0: # batch_score can be None if from the dashboard when updating labels
-        # Update labels
-        for v in labels:
-            label = create_label(v["video_id"], v["label"], user_id, batch_id)
+        # Move the label states with conditional updates, so that concurrent batches do not overwrite each other
+        # (in the order of the video IDs to prevent deadlocks)
+        t = get_current_time()
+        label_rows = []
+        for v in sorted(labels, key=lambda v: v["video_id"]):
             video = video_batch_hashed[v["video_id"]]
-            video.label_update_time = label.time
             if client_type == 0: # admin researcher
-                next_s = label_state_machine(video.label_state_admin, v["label"], client_type)
+                # Researchers should not override the labels provided by normal users
+                # Because we need to compare the reliability of the labels provided by normal users
+                column_name, s = "label_state_admin", video.label_state_admin
             else: # normal user
-                next_s = label_state_machine(video.label_state, v["label"], client_type)
-            if next_s is not None:
-                if client_type == 0: # admin researcher
-                    # Researchers should not override the labels provided by normal users
-                    # Because we need to compare the reliability of the labels provided by normal users
-                    video.label_state_admin = next_s
-                else: # normal user
-                    video.label_state = next_s
-                app.logger.info("Update video: %r" % video)
+                column_name, s = "label_state", video.label_state
+            version, change = transition_label_state(Video, video.id, column_name, s, video.label_version,
+                lambda s: label_state_machine(s, v["label"], client_type), t)
+            # The labels are the event log of the label states, so keep the version to replay them in order
+            label_rows.append({
+                "video_id": v["video_id"],
+                "label": v["label"],
+                "time": t,
+                "user_id": user_id,
+                "batch_id": batch_id,
+                "client_type": client_type,
+                "version": version
+            })
+            if change is not None:
+                state_changes.append((video.id, change[0], change[1], video.priority))
+                app.logger.info("Update video %r from state %r to %r" % (video.id, change[0], change[1]))
             else:
+                video.label_update_time = t
                 app.logger.warning("No next state for video: %r" % video)
-    # Update database
+        # Add all labels with one multi-row INSERT, in the same transaction as the video label states
+        label_ids = create_labels(label_rows)
+    # Release the reservations of the videos in this batch, so that other citizens can label them
+    if client_type != 0:
+        release_items("video", [v["video_id"] for v in labels])
+    # Update database (this is the only commit for the batch)
     db.session.commit()
+    # Move the videos to the correct candidate pools for sampling
+    for video_id, old_state, new_state, priority in state_changes:
+        update_candidate_pools("video", video_id, old_state, new_state, priority)
+    # Reload the gold standards at the next draw if the researcher added or removed some
+    if any(is_gold_standard_change("video", old[1], new[1]) for _, old, new, _ in state_changes):
+        invalidate_gold_standards("video")
+    # Remember the videos labeled by the user for batch selection
+    if len(label_ids) > 0:
+        add_video_ids_labeled_by_user(user_id, [v["video_id"] for v in labels])
+    # Count the gallery totals again if the label states or the labels of the user have changed
+    if len(state_changes) > 0:
+        invalidate_gallery_totals("video")
+    elif len(label_ids) > 0:
+        invalidate_gallery_totals("video", user_id=user_id)
     return {"batch": batch_score, "user": user_score, "raw": user_raw_score}
 
 
@@ -0,0 +1,65 @@
+"""Functions to move the label states of videos and segmentation masks safely under concurrent labeling."""
+
+from sqlalchemy import update
+from sqlalchemy import select
+from models.model import db
+from app.app import app
+from config.config import config
+
+
+def transition_label_state(model, item_id, column_name, s, version, next_state, t):
+    """
+    Move the label state of an item with an atomic conditional UPDATE (without committing).
+
+    The UPDATE only matches when the state in the database is still the state that the next state was computed from,
+    ...so that a concurrent transition of the same item (e.g., by another citizen) is never overwritten.
+    If another transaction moved the state first, the committed state is read again and the transition is retried.
+    Each transition also increases the label version of the item by one,
+    ...which orders the label events of the item when replaying them (see `projection_operations.py`).
+    The row stays locked until the transaction ends, so callers should move items in the order of their IDs
+    ...to prevent deadlocks between concurrent batches.
+
+    Parameters
+    ----------
+    model : Video or SegmentationMask
+        The model of the item.
+    item_id : int
+        The ID of the item.
+    column_name : str
+        The label state column to move ("label_state" or "label_state_admin").
+    s : int
+        The current state that the caller read.
+    version : int
+        The current label version that the caller read.
+    next_state : function
+        The function that maps a state to the next state (or None if there is no next state).
+    t : int
+        The epochtime (in seconds) to set for the label_update_time column.
+
+    Returns
+    -------
+    version : int
+        The label version of the item after the transition,
+        ...or the version that the state was checked against if there is no next state.
+    change : tuple of tuple
+        The old and new states of the item, both in (label_state, label_state_admin) format.
+        None if there is no next state.
+    """
+    column = getattr(model, column_name)
+    for _ in range(config.LABEL_STATE_MAX_RETRIES):
+        next_s = next_state(s)
+        if next_s is None: return (version, None)
+        stmt = (update(model)
+            .where(model.id==item_id, column==s)
+            .values({column_name: next_s, "label_update_time": t, "label_version": model.label_version + 1})
+            .returning(model.label_state, model.label_state_admin, model.label_version)
+            .execution_options(synchronize_session=False))
+        row = db.session.execute(stmt).first()
+        if row is not None:
+            ls, lsa, version = row
+            old_state = (s, lsa) if column_name == "label_state" else (ls, s)
+            return (version, (old_state, (ls, lsa)))
+        # Another transaction changed the state first, so read the committed state and try again
+        s, version = db.session.execute(select(column, model.label_version).where(model.id==item_id)).first()
+        app.logger.info("Retry the %s transition of %s %r from state %r" % (column_name, model.__tablename__, item_id, s))
+    raise Exception("Too many concurrent label state changes for %s %r" % (model.__tablename__, item_id))
@@ -0,0 +1,212 @@
+"""Functions to project the label events (labels and segmentation feedback) to the label states."""
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy import bindparam
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from models.model import db
+from models.model import Video
+from models.model import Label
+from models.model import SegmentationMask
+from models.model import SegmentationFeedback
+from models.model import ProjectionCheckpoint
+from models.model_operations.label_operations import label_state_machine as video_label_state_machine
+from models.model_operations.segmentationFeedback_operations import label_state_machine as segmentation_label_state_machine
+from models.model_operations.sampling_operations import reset_candidate_pools
+from models.model_operations.sampling_operations import invalidate_gold_standards
+from models.model_operations.gallery_total_operations import invalidate_gallery_totals
+from util.state_replay import replay_states
+from util.util import get_current_time
+from app.app import app
+from config.config import config
+
+
+# The types of projections, which map to the models of the items and events, and the label state machine
+projection_types = {
+    "video": {
+        "model": Video,
+        "event": Label,
+        "item_column": "video_id",
+        "input_column": "label",
+        "machine": video_label_state_machine
+    },
+    "segmentation": {
+        "model": SegmentationMask,
+        "event": SegmentationFeedback,
+        "item_column": "segmentation_id",
+        "input_column": "feedback_code",
+        "machine": segmentation_label_state_machine
+    }
+}
+
+
+def load_events(data_type, item_ids=None):
+    """
+    Load the label events in the order to replay them (by item, version, and ID).
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    item_ids : list of int
+        The IDs of the items to load events for (None means all items).
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The item IDs, client types, and inputs (labels or feedback codes) of the events.
+    """
+    p = projection_types[data_type]
+    event = p["event"]
+    item = getattr(event, p["item_column"])
+    # Events without the client type are from citizens (client type 3) who labeled before the client type was logged
+    q = select(item, func.coalesce(event.client_type, 3), getattr(event, p["input_column"]))
+    if item_ids is not None:
+        q = q.where(item.in_(item_ids))
+    rows = db.session.execute(q.order_by(item, event.version, event.id)).all()
+    if len(rows) == 0:
+        return tuple(np.array([], dtype=np.int64) for _ in range(3))
+    return tuple(np.array(c, dtype=np.int64) for c in zip(*rows))
+
+
+def project_label_states(data_type, item_ids=None, apply=True):
+    """
+    Replay the label events of items and write the label states that differ from the replayed ones.
+
+    Only the items that have events are projected.
+    The states are written with conditional updates on the label version (without changing it),
+    ...so that a transition added by a concurrent request is not overwritten.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    item_ids : list of int
+        The IDs of the items to project (None means all items).
+    apply : bool
+        Whether to write the states (False only counts the items whose states differ).
+
+    Returns
+    -------
+    int
+        The number of items whose label states differ from the replayed states.
+    """
+    p = projection_types[data_type]
+    model = p["model"]
+    items, client_types, inputs = load_events(data_type, item_ids)
+    replayed_ids, ls, lsa = replay_states(p["machine"], items, client_types, inputs)
+    if len(replayed_ids) == 0: return 0
+    # Compare with the current states
+    q = select(model.id, model.label_state, model.label_state_admin, model.label_version)
+    if item_ids is not None:
+        q = q.where(model.id.in_(replayed_ids.tolist()))
+    current = np.array(db.session.execute(q.order_by(model.id)).all(), dtype=np.int64).reshape(-1, 4)
+    k = np.searchsorted(current[:, 0], replayed_ids)
+    current = current[k]
+    is_different = (current[:, 1] != ls) | (current[:, 2] != lsa)
+    num_different = int(is_different.sum())
+    app.logger.info("Found %d %s label states that differ from the events" % (num_different, data_type))
+    if not apply or num_different == 0: return num_different
+    table = model.__table__
+    stmt = (update(table)
+        .where(table.c.id==bindparam("b_id"), table.c.label_version==bindparam("b_version"))
+        .values(label_state=bindparam("b_label_state"), label_state_admin=bindparam("b_label_state_admin")))
+    rows = [{
+        "b_id": int(r[0]),
+        "b_version": int(r[3]),
+        "b_label_state": int(s),
+        "b_label_state_admin": int(sa)
+    } for r, s, sa in zip(current[is_different], ls[is_different], lsa[is_different])]
+    db.session.execute(stmt, rows)
+    db.session.commit()
+    # The candidate pools, gold standards, and gallery totals of this process depend on the label states
+    # (other worker processes reload them after their TTLs in the config)
+    reset_candidate_pools(data_type)
+    invalidate_gold_standards(data_type)
+    invalidate_gallery_totals(data_type)
+    return num_different
+
+
+def get_checkpoint(data_type):
+    """Get the ID of the last event that has been projected (0 if there is no checkpoint)."""
+    event_id = db.session.execute(select(ProjectionCheckpoint.event_id).where(ProjectionCheckpoint.name==data_type)).scalar()
+    return 0 if event_id is None else event_id
+
+
+def set_checkpoint(data_type, event_id):
+    """Set the ID of the last event that has been projected, and commit."""
+    stmt = insert(ProjectionCheckpoint).values(name=data_type, event_id=event_id, update_time=get_current_time())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProjectionCheckpoint.name],
+        set_={"event_id": stmt.excluded.event_id, "update_time": stmt.excluded.update_time}
+    )
+    db.session.execute(stmt)
+    db.session.commit()
+
+
+def get_settled_event_id(data_type, after_id=0):
+    """
+    Get the ID of the last event that is older than config.PROJECTION_LAG seconds.
+
+    Events are committed shortly after they get their IDs,
+    ...so events older than the lag are not expected to appear with smaller IDs later.
+    """
+    event = projection_types[data_type]["event"]
+    q = select(func.max(event.id)).where(event.id > after_id, event.time <= get_current_time() - config.PROJECTION_LAG)
+    return db.session.execute(q).scalar()
+
+
+def project_new_events(data_type):
+    """
+    Project the label events that were added after the checkpoint.
+
+    The full history of each item that has new events is replayed, so projecting the same events again is harmless.
+    The label states are normally already moved when the labels are added,
+    ...so this only repairs the states that do not match the events.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+
+    Returns
+    -------
+    int
+        The number of items whose label states are repaired.
+    """
+    p = projection_types[data_type]
+    event = p["event"]
+    item = getattr(event, p["item_column"])
+    checkpoint = get_checkpoint(data_type)
+    settled_id = get_settled_event_id(data_type, after_id=checkpoint)
+    item_ids = db.session.execute(select(item).where(event.id > checkpoint).distinct()).scalars().all()
+    num_different = project_label_states(data_type, item_ids=item_ids, apply=True) if len(item_ids) > 0 else 0
+    if settled_id is not None:
+        set_checkpoint(data_type, settled_id)
+    app.logger.info("Project %s label events after ID %r (%d items repaired)" % (data_type, checkpoint, num_different))
+    return num_different
+
+
+def rebuild_label_states(data_type, apply=True):
+    """
+    Rebuild the label states of all items from scratch by replaying all label events in one vectorized pass.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    apply : bool
+        Whether to write the states (False only audits the states).
+
+    Returns
+    -------
+    int
+        The number of items whose label states differ from the replayed states.
+    """
+    settled_id = get_settled_event_id(data_type)
+    num_different = project_label_states(data_type, apply=apply)
+    if apply and settled_id is not None:
+        set_checkpoint(data_type, settled_id)
+    return num_different
@@ -0,0 +1,205 @@
+"""Functions to operate the bulk relabeling jobs of the admin researcher."""
+
+import threading
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy import or_
+from sqlalchemy import and_
+from models.model import db
+from models.model import Video
+from models.model import SegmentationMask
+from models.model import RelabelJob
+from models.model_operations.label_operations import update_labels
+from models.model_operations.segmentationFeedback_operations import update_segmentation_labels
+from util.util import get_current_time
+from app.app import app
+from config.config import config
+
+
+# The functions to set the labels of each type of data (same as the set_label_state calls)
+relabel_functions = {
+    "video": update_labels,
+    "segmentation": update_segmentation_labels
+}
+
+# The models and the ID fields of the labels of each type of data
+relabel_id_fields = {
+    "video": (Video, "video_id"),
+    "segmentation": (SegmentationMask, "id")
+}
+
+
+def check_relabel_ids(data_type, data):
+    """
+    Check that all the labels of a bulk relabeling job have IDs of existing videos or segmentation masks.
+
+    Raises
+    ------
+    exception : Exception
+        When a label has no ID or the ID does not exist.
+    """
+    model, id_field = relabel_id_fields[data_type]
+    if not all(isinstance(d, dict) and id_field in d for d in data):
+        raise Exception("Missing field: %s" % id_field)
+    ids = set(d[id_field] for d in data)
+    if len(ids) == 0: return
+    existing = set(r[0] for r in db.session.query(model.id).filter(model.id.in_(ids)).all())
+    unknown = sorted(ids - existing, key=str)
+    if len(unknown) > 0:
+        raise Exception("Unknown %s IDs: %r" % (data_type, unknown[:10]))
+
+
+def create_relabel_job(data_type, user_id, data):
+    """
+    Create a bulk relabeling job and commit (the job is not started).
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data to relabel ("video" or "segmentation").
+    user_id : int
+        The ID of the researcher in the User table.
+    data : list of dict
+        The labels to set, same as the data field of the set_label_state or set_segmentation_label_state call.
+
+    Returns
+    -------
+    RelabelJob
+        The created job.
+
+    Raises
+    ------
+    exception : Exception
+        When the data type is not supported, the data is not a list, or the data has unknown IDs.
+    """
+    if data_type not in relabel_functions:
+        raise Exception("Data type not supported")
+    if not isinstance(data, list):
+        raise Exception("Data needs to be a list")
+    check_relabel_ids(data_type, data)
+    job = RelabelJob(data_type=data_type, user_id=user_id, data=data, num_total=len(data))
+    db.session.add(job)
+    db.session.commit()
+    app.logger.info("Create relabel job: %r" % job)
+    return job
+
+
+def get_relabel_job(job_id):
+    """Get a bulk relabeling job by its ID (return None if it does not exist)."""
+    return RelabelJob.query.filter(RelabelJob.id==job_id).first()
+
+
+def retry_relabel_job(job_id, data=None):
+    """
+    Queue a failed or stale bulk relabeling job again and commit (the job is not started).
+
+    A running job is stale when it has not updated its progress for config.ADMIN_RELABEL_STALE_TIMEOUT seconds
+    ...(e.g., the worker process that ran the job was restarted), so the retry takes over the job.
+    The job continues from num_done when it runs again, so the labels that were set are not set twice.
+
+    Parameters
+    ----------
+    job_id : int
+        The ID of the job.
+    data : list of dict
+        The labels to replace the ones that were not processed (i.e., after num_done), e.g., to fix the failed chunk.
+        None means keeping the labels of the job.
+
+    Returns
+    -------
+    RelabelJob
+        The queued job.
+
+    Raises
+    ------
+    exception : Exception
+        When the job does not exist, the job has not failed and is not stale, or the data is not valid.
+    """
+    job = get_relabel_job(job_id)
+    if job is None:
+        raise Exception("Relabel job not found")
+    if data is not None:
+        if not isinstance(data, list):
+            raise Exception("Data needs to be a list")
+        check_relabel_ids(job.data_type, data)
+    now = get_current_time()
+    values = {"status": "queued", "error": None, "update_time": now}
+    if data is not None:
+        values["data"] = job.data[:job.num_done] + data
+        values["num_total"] = len(values["data"])
+    # Use a conditional update so that concurrent retries do not start the same job twice
+    is_stale = and_(RelabelJob.status=="running", RelabelJob.update_time < now - config.ADMIN_RELABEL_STALE_TIMEOUT)
+    result = db.session.execute(
+        update(RelabelJob)
+        .where(RelabelJob.id==job_id, or_(RelabelJob.status=="failed", is_stale), RelabelJob.num_done==job.num_done)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.rollback()
+        raise Exception("Only failed or stale jobs can be retried")
+    db.session.commit()
+    app.logger.info("Retry relabel job %d from %d labels done" % (job_id, job.num_done))
+    return get_relabel_job(job_id)
+
+
+def start_relabel_job(job_id):
+    """Process a committed bulk relabeling job in a background thread, so that the request can return the job ID."""
+    # Use the application of the request, which has the database settings
+    flask_app = current_app._get_current_object()
+    t = threading.Thread(target=run_relabel_job_in_app, args=(flask_app, job_id), name="relabel-%d" % job_id, daemon=True)
+    t.start()
+    return t
+
+
+def run_relabel_job_in_app(flask_app, job_id):
+    """Process a bulk relabeling job in the application context (for the background thread)."""
+    with flask_app.app_context():
+        try:
+            run_relabel_job(job_id)
+        finally:
+            db.session.remove()
+
+
+def run_relabel_job(job_id):
+    """
+    Process a bulk relabeling job in chunks of config.ADMIN_RELABEL_CHUNK_SIZE labels.
+
+    Each chunk is one transaction, which is committed by update_labels or update_segmentation_labels.
+    The progress (num_done) is updated in the same transaction as the chunk,
+    ...so a failed job keeps the chunks before the failure, and num_done tells exactly which labels are set.
+    The job starts from num_done, so running a failed job again does not set the processed labels twice.
+    """
+    try:
+        job = get_relabel_job(job_id)
+        if job is None:
+            raise Exception("Relabel job not found")
+        data, num_done = job.data, job.num_done
+        data_type, user_id = job.data_type, job.user_id
+        set_labels = relabel_functions[data_type]
+        job.status = "running"
+        job.error = None
+        job.update_time = get_current_time()
+        db.session.commit()
+        chunk_size = config.ADMIN_RELABEL_CHUNK_SIZE
+        for i in range(num_done, len(data), chunk_size):
+            chunk = data[i:i+chunk_size]
+            stmt = (update(RelabelJob)
+                .where(RelabelJob.id==job_id)
+                .values(num_done=i+len(chunk), update_time=get_current_time()))
+            db.session.execute(stmt)
+            # Only the admin researcher (client type 0) can create the jobs
+            set_labels(chunk, user_id, None, None, 0)
+            app.logger.info("Relabel job %d: %d/%d labels done" % (job_id, i + len(chunk), len(data)))
+        job = get_relabel_job(job_id)
+        job.status = "done"
+        job.update_time = get_current_time()
+        db.session.commit()
+    except Exception as ex:
+        db.session.rollback()
+        app.logger.error("Error when running relabel job %d: %r" % (job_id, ex))
+        stmt = (update(RelabelJob)
+            .where(RelabelJob.id==job_id)
+            .values(status="failed", error=repr(ex), update_time=get_current_time()))
+        db.session.execute(stmt)
+        db.session.commit()
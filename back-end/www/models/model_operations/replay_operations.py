@@ -0,0 +1,88 @@
+"""Functions to detect replayed batch submissions (by the unique ID of the batch token)."""
+
+from sqlalchemy import update
+from models.model import db
+from util.cache import create_cache
+from util.cache import cache_get
+from util.cache import cache_set
+from util.util import get_current_time
+from app.app import app
+from config.config import config
+
+
+# The score responses of the batch tokens that were consumed in this worker process (keyed by the JWT ID)
+# This only makes replays cheap, and the unique jti column in the batch tables is the source of truth
+consumed_token_cache = create_cache(config.REPLAY_CACHE_SIZE, ttl=config.REPLAY_CACHE_TTL)
+
+
+def get_replayed_score(jti):
+    """Get the score response of a consumed batch token (return None if the token is not known as consumed)."""
+    if jti is None: return None
+    return cache_get(consumed_token_cache, jti)
+
+
+def remember_consumed_token(jti, score):
+    """Remember the score response of a consumed batch token, so that a replay can get the same response."""
+    if jti is None or score is None: return
+    cache_set(consumed_token_cache, jti, score)
+
+
+def claim_batch(model, batch_id, jti, connection_id):
+    """
+    Mark a batch as returned by the client with one conditional UPDATE (without committing).
+
+    The UPDATE only matches when the batch has not been returned with a token yet,
+    ...so a replayed or concurrent duplicate submission of the same batch cannot claim it again.
+    A concurrent duplicate waits for the row lock, and then sees that the batch is already claimed.
+
+    Parameters
+    ----------
+    model : Batch or SegmentationBatch
+        The model of the batch.
+    batch_id : int
+        The ID of the batch.
+    jti : str
+        The unique ID of the batch token (JWT ID).
+    connection_id : int
+        The connection ID in the Connection table.
+
+    Returns
+    -------
+    bool
+        Whether the batch is claimed.
+    """
+    stmt = (update(model)
+        .where(model.id==batch_id, model.jti==None)
+        .values(jti=jti, return_time=get_current_time(), connection_id=connection_id)
+        .returning(model.id)
+        .execution_options(synchronize_session=False))
+    return db.session.execute(stmt).first() is not None
+
+
+def get_batch_score(model, batch_id):
+    """
+    Get the score response of a returned batch from the batch table (for replays that are not in the cache).
+
+    Parameters
+    ----------
+    model : Batch or SegmentationBatch
+        The model of the batch.
+    batch_id : int
+        The ID of the batch.
+
+    Returns
+    -------
+    dict
+        The same dictionary as the one returned by the update_labels function.
+    """
+    batch = model.query.filter(model.id==batch_id).first()
+    if batch is None:
+        raise Exception("No batch found in the database to update.")
+    app.logger.warning("Replayed batch: %r" % batch)
+    if batch.score is None:
+        return {"batch": None, "user": None, "raw": None}
+    return {
+        "batch": batch.score,
+        "user": batch.user_score + batch.score,
+        "raw": batch.user_raw_score + batch.num_unlabeled
+    }
@@ -0,0 +1,655 @@
+"""Functions to sample videos and segmentation masks for labeling from in-memory caches."""
+
+import time
+import threading
+import numpy as np
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy import update
+from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy import tablesample
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import aliased
+from models.model import db
+from models.model import Video
+from models.model import SegmentationMask
+from util.util import get_current_time
+from util.candidate_pool import create_pool
+from util.candidate_pool import pool_size
+from util.candidate_pool import pool_add
+from util.candidate_pool import pool_remove
+from util.candidate_pool import pool_draw_weighted
+from util.id_set import create_id_set
+from util.id_set import id_set_union
+from util.cache import create_cache
+from util.cache import cache_get
+from util.cache import cache_set
+from app.app import app
+from config.config import config
+import models.model as m
+
+
+# The label-state buckets of the candidate pools
+# (gold standards are sampled from the gold standard registry instead)
+POOL_BUCKETS = ["partial", "unlabeled"]
+
+# The models and label states of the candidates (keyed by the type of data)
+# "terminal" means the researcher label states that remove an item from the citizen labeling process
+# ...(gold standards, researcher-verified labels, and discarded items)
+# "partial" means the citizen label states that still need more labels
+# "admin" means the researcher label states of the items that can be given to the admin researcher
+# "join" means the relationship that is loaded together with the items for giving them to the front-end
+# ...(the segmentation masks are loaded together with their videos in one query with an inner join)
+candidate_types = {
+    "video": {
+        "model": Video,
+        "join": None,
+        "terminal": m.gold_labels + m.pos_labels + m.neg_labels + m.bad_labels,
+        "partial": m.maybe_pos_labels + m.maybe_neg_labels + m.discorded_labels,
+        "admin": [-1] + m.discorded_labels + m.maybe_neg_labels + m.maybe_pos_labels
+    },
+    "segmentation": {
+        "model": SegmentationMask,
+        "join": SegmentationMask.video,
+        "terminal": m.gold_labels_seg + m.pos_labels_seg + m.neg_labels_seg + m.bad_labels_seg,
+        "partial": m.partial_labels_seg,
+        "admin": [-1]
+    }
+}
+
+# The candidate pools of this worker process (keyed by the type of data)
+# The pools of each type are keyed by bucket name and then by priority
+# The pools are loaded lazily and reloaded after config.CANDIDATE_POOL_TTL seconds
+candidate_pools = {
+    "video": {"pools": None, "load_time": 0},
+    "segmentation": {"pools": None, "load_time": 0}
+}
+candidate_pools_lock = threading.RLock()
+
+# Max number of rounds to draw again when some drawn items turn out to be outdated
+MAX_DRAW_ROUNDS = 3
+
+# The models and the positive/negative label states of the gold standards (keyed by the type of data)
+gold_standard_types = {
+    "video": (Video, m.pos_gold_labels, m.neg_gold_labels),
+    "segmentation": (SegmentationMask, m.pos_gold_labels_seg, m.neg_gold_labels_seg)
+}
+
+# The gold standard registry of this worker process (keyed by the type of data)
+# Each item has the arrays of positive and negative gold standard IDs, and the time when they were loaded
+# The registry is loaded lazily and reloaded after config.GOLD_STANDARD_CACHE_TTL seconds
+gold_standard_registry = {"video": None, "segmentation": None}
+gold_standard_registry_lock = threading.Lock()
+
+# The random number generator for sampling gold standards
+rng = np.random.default_rng()
+
+# The estimated number of rows of each table (keyed by table name), read from the statistics of the query planner
+table_row_estimate_cache = create_cache(16, ttl=config.CANDIDATE_POOL_TTL)
+
+# The background thread that clears expired reservations every config.RESERVATION_SWEEP_INTERVAL seconds
+# The thread is started with the first reservation of this worker process, so it does not depend on the batch queues
+reservation_sweep_worker = {"thread": None}
+reservation_sweep_worker_lock = threading.Lock()
+
+
+def pool_bucket(data_type, label_state, label_state_admin):
+    """
+    Get the candidate pool bucket of a video or segmentation mask by its label states.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    label_state : int
+        The citizen label state.
+    label_state_admin : int
+        The researcher label state.
+
+    Returns
+    -------
+    str or None
+        The bucket name (see POOL_BUCKETS).
+        None means that the item should not be given to citizens for labeling.
+    """
+    t = candidate_types[data_type]
+    if label_state_admin in t["terminal"]: return None
+    if label_state in t["partial"]: return "partial"
+    if label_state == -1: return "unlabeled"
+    return None
+
+
+def admin_candidate_clause(data_type, item):
+    """
+    Get the SQL clause that checks if videos or segmentation masks can be given to the admin researcher.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    item : Video or SegmentationMask or sqlalchemy.orm.util.AliasedClass
+        The entity in the query (e.g., an alias of a sampled table).
+
+    Returns
+    -------
+    sqlalchemy.sql.expression.BinaryExpression
+        The clause that can be used in the filter function of a query.
+    """
+    return item.label_state_admin.in_(candidate_types[data_type]["admin"])
+
+
+def is_admin_candidate(data_type, label_state_admin):
+    """Check if a video or segmentation mask can be given to the admin researcher (see the admin_candidate_clause function)."""
+    return label_state_admin in candidate_types[data_type]["admin"]
+
+
+def load_candidate_pools(data_type):
+    """
+    Load the candidate pools from the database (only IDs, label states, and priorities).
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    """
+    t = candidate_types[data_type]
+    model = t["model"]
+    rows = (
+        db.session.query(model.id, model.label_state, model.label_state_admin, model.priority)
+        .filter(and_(
+            model.label_state_admin.notin_(t["terminal"]),
+            model.label_state.in_(t["partial"] + [-1])))
+    ).all()
+    ids = {b: {} for b in POOL_BUCKETS}
+    for item_id, s, s_admin, priority in rows:
+        b = pool_bucket(data_type, s, s_admin)
+        if b is not None:
+            ids[b].setdefault(priority, []).append(item_id)
+    with candidate_pools_lock:
+        candidate_pools[data_type]["pools"] = {b: {p: create_pool(ids[b][p]) for p in ids[b]} for b in POOL_BUCKETS}
+        candidate_pools[data_type]["load_time"] = get_current_time()
+    sizes = {b: {p: len(ids[b][p]) for p in ids[b]} for b in POOL_BUCKETS}
+    app.logger.info("Load %s candidate pools: %r" % (data_type, sizes))
+
+
+def get_candidate_pools(data_type):
+    """Get the candidate pools, and reload them if they are missing or expired."""
+    c = candidate_pools[data_type]
+    if c["pools"] is None or get_current_time() - c["load_time"] > config.CANDIDATE_POOL_TTL:
+        load_candidate_pools(data_type)
+    return c["pools"]
+
+
+def reset_candidate_pools(data_type):
+    """Drop the candidate pools so that they are reloaded at the next draw."""
+    with candidate_pools_lock:
+        candidate_pools[data_type]["pools"] = None
+        candidate_pools[data_type]["load_time"] = 0
+
+
+def move_in_candidate_pools(pools, item_id, old_key, new_key):
+    """Move an ID between the candidate pools (the keys are bucket-priority tuples or None)."""
+    with candidate_pools_lock:
+        if old_key is not None and old_key[1] in pools[old_key[0]]:
+            pool_remove(pools[old_key[0]][old_key[1]], item_id)
+        if new_key is not None:
+            if new_key[1] not in pools[new_key[0]]:
+                pools[new_key[0]][new_key[1]] = create_pool([])
+            pool_add(pools[new_key[0]][new_key[1]], item_id)
+
+
+def update_candidate_pools(data_type, item_id, old_state, new_state, priority):
+    """
+    Move a video or segmentation mask between candidate pool buckets when its label states change.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    item_id : int
+        The ID of the video or segmentation mask.
+    old_state : tuple of int
+        The (label_state, label_state_admin) before the change.
+    new_state : tuple of int
+        The (label_state, label_state_admin) after the change.
+    priority : int
+        The priority of the video or segmentation mask.
+    """
+    pools = candidate_pools[data_type]["pools"]
+    if pools is None: return
+    old_b = pool_bucket(data_type, *old_state)
+    new_b = pool_bucket(data_type, *new_state)
+    if old_b == new_b: return
+    move_in_candidate_pools(
+        pools, item_id,
+        None if old_b is None else (old_b, priority),
+        None if new_b is None else (new_b, priority))
+
+
+def priority_weights(pools, exponent):
+    """
+    Compute the weight of drawing from the pool of each priority.
+
+    The weight is the pool size multiplied by the priority to the power of the exponent,
+    ...so that each candidate is drawn with a probability proportional to priority**exponent.
+    Priorities smaller than 1 are treated as 1.
+
+    Parameters
+    ----------
+    pools : dict
+        The candidate pools of one bucket (keyed by priority).
+    exponent : float
+        The exponent of the priority (0 means uniform sampling over all candidates).
+
+    Returns
+    -------
+    dict
+        The weight of each pool (keyed by priority).
+    """
+    return {p: pool_size(pools[p]) * float(max(p, 1))**exponent for p in pools}
+
+
+def load_items(data_type, item_ids):
+    """
+    Load videos or segmentation masks by their IDs in one query.
+
+    The relationships that are needed for giving the items to the front-end are loaded in the same query.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    item_ids : list of int
+        The IDs of the videos or segmentation masks.
+
+    Returns
+    -------
+    list of Video or SegmentationMask
+        The loaded items (in no particular order).
+    """
+    if len(item_ids) == 0: return []
+    t = candidate_types[data_type]
+    model = t["model"]
+    q = model.query
+    if t["join"] is not None:
+        # Use an inner join (not an outer join) so that items without the related row are skipped
+        q = q.join(t["join"]).options(contains_eager(t["join"]))
+    return q.filter(model.id.in_(item_ids)).all()
+
+
+def draw_candidate_batch(data_type, num_partial, num_unlabeled, excluded, weighted=False, reserve=False):
+    """
+    Draw a batch of videos or segmentation masks (without gold standards) from the candidate pools.
+
+    The drawn items are loaded from the database by their primary keys in one query.
+    Items whose label states were changed by other worker processes are moved to the correct pool,
+    ...and then replacements are drawn again.
+    Partially labeled items that are reserved by other citizens are skipped (see the reserve_items function).
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    num_partial : int
+        The max number of partially labeled items.
+    num_unlabeled : int
+        The total number of partially labeled and unlabeled items.
+        If there are not enough partially labeled items, unlabeled items fill the rest.
+    excluded : numpy.ndarray
+        An ID set (see `id_set.py`) of IDs that should not be drawn.
+    weighted : bool
+        Draw the items with probabilities proportional to priority**config.PRIORITY_WEIGHT_EXPONENT.
+        Otherwise, draw the items uniformly.
+    reserve : bool
+        Reserve the partially labeled items for the user who gets the batch.
+
+    Returns
+    -------
+    dict
+        Lists of Video or SegmentationMask objects for each bucket (see POOL_BUCKETS).
+    """
+    exponent = config.PRIORITY_WEIGHT_EXPONENT if weighted else 0
+    selected = {b: [] for b in POOL_BUCKETS}
+    unavailable = []
+    for _ in range(MAX_DRAW_ROUNDS):
+        with candidate_pools_lock:
+            pools = get_candidate_pools(data_type)
+            selected_ids = create_id_set([o.id for b in selected for o in selected[b]] + unavailable)
+            skip = id_set_union(excluded, selected_ids)
+            drawn = {}
+            n = min(num_partial - len(selected["partial"]), num_unlabeled - len(selected["partial"]) - len(selected["unlabeled"]))
+            drawn["partial"] = pool_draw_weighted(pools["partial"], priority_weights(pools["partial"], exponent), n, skip)
+            n = num_unlabeled - len(selected["partial"]) - sum(map(len, drawn["partial"].values())) - len(selected["unlabeled"])
+            drawn["unlabeled"] = pool_draw_weighted(pools["unlabeled"], priority_weights(pools["unlabeled"], exponent), n, skip)
+        drawn_ids = [i for b in drawn for p in drawn[b] for i in drawn[b][p]]
+        if len(drawn_ids) == 0: break
+        # Load the items and check if the label states and priorities are still the same as in the pools
+        objects = load_items(data_type, drawn_ids)
+        objects_hashed = {o.id: o for o in objects}
+        num_outdated = 0
+        valid = {b: [] for b in POOL_BUCKETS}
+        for b in drawn:
+            for p in drawn[b]:
+                for i in drawn[b][p]:
+                    o = objects_hashed.get(i)
+                    actual_b = None if o is None else pool_bucket(data_type, o.label_state, o.label_state_admin)
+                    if actual_b == b and o.priority == p:
+                        valid[b].append(o)
+                    else:
+                        num_outdated += 1
+                        move_in_candidate_pools(pools, i, (b, p), None if actual_b is None else (actual_b, o.priority))
+        # Skip the partially labeled items that are reserved by other citizens (but keep them in the pools)
+        if reserve:
+            available = set(reserve_items(data_type, [o.id for o in valid["partial"]]))
+        else:
+            now = get_current_time()
+            available = set(o.id for o in valid["partial"] if not is_reserved(o, now))
+        for o in valid["partial"]:
+            if o.id not in available:
+                num_outdated += 1
+                unavailable.append(o.id)
+        valid["partial"] = [o for o in valid["partial"] if o.id in available]
+        for b in POOL_BUCKETS:
+            selected[b] += valid[b]
+        if num_outdated == 0: break
+    return selected
+
+
+def is_reserved(o, now):
+    """Check if a video or segmentation mask is reserved at the epochtime (see the reserve_items function)."""
+    return o.reserved_until is not None and o.reserved_until > now
+
+
+def not_reserved(model, now):
+    """Get the SQL clause that checks if a video or segmentation mask is not reserved at the epochtime."""
+    return or_(model.reserved_until == None, model.reserved_until <= now)
+
+
+def reserve_items(data_type, item_ids):
+    """
+    Reserve videos or segmentation masks for config.RESERVATION_DURATION seconds.
+
+    Reserved items are not given to other citizens until the reservation expires or the items are labeled.
+    This prevents that concurrent citizens label the same partially labeled items,
+    ...where only the first label can move the item to the next label state.
+    The reservation is done with one conditional update, so only one of the concurrent requests can get an item.
+    The reservations are committed with the next commit of the session (i.e., when the batch is created),
+    ...and they are rolled back if the batch is not given out.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    item_ids : list of int
+        The IDs of the videos or segmentation masks.
+
+    Returns
+    -------
+    list of int
+        The IDs that are reserved successfully.
+    """
+    if len(item_ids) == 0: return []
+    start_reservation_sweep_worker()
+    model = candidate_types[data_type]["model"]
+    now = get_current_time()
+    rows = db.session.execute(
+        update(model)
+        .where(and_(model.id.in_(item_ids), not_reserved(model, now)))
+        .values(reserved_until=now + config.RESERVATION_DURATION)
+        .returning(model.id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    return [r[0] for r in rows]
+
+
+def release_items(data_type, item_ids):
+    """Release the reservations of videos or segmentation masks (e.g., after they are labeled)."""
+    if len(item_ids) == 0: return
+    model = candidate_types[data_type]["model"]
+    db.session.execute(
+        update(model)
+        .where(and_(model.id.in_(item_ids), model.reserved_until != None))
+        .values(reserved_until=None)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def sweep_expired_reservations():
+    """Clear the expired reservations of videos and segmentation masks, and commit the changes."""
+    now = get_current_time()
+    for data_type in candidate_types:
+        model = candidate_types[data_type]["model"]
+        result = db.session.execute(
+            update(model)
+            .where(model.reserved_until <= now)
+            .values(reserved_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount > 0:
+            app.logger.info("Clear %d expired %s reservations" % (result.rowcount, data_type))
+    db.session.commit()
+
+
+def start_reservation_sweep_worker():
+    """Start the background thread that clears expired reservations (if it is not running yet)."""
+    t = reservation_sweep_worker["thread"]
+    if t is not None and t.is_alive(): return
+    with reservation_sweep_worker_lock:
+        t = reservation_sweep_worker["thread"]
+        if t is not None and t.is_alive(): return
+        t = threading.Thread(target=run_reservation_sweep_worker, name="reservation-sweep", daemon=True)
+        t.start()
+        reservation_sweep_worker["thread"] = t
+    app.logger.info("Start the reservation sweep worker")
+
+
+def run_reservation_sweep_worker():
+    """Clear expired reservations every config.RESERVATION_SWEEP_INTERVAL seconds."""
+    with app.app_context():
+        while True:
+            time.sleep(config.RESERVATION_SWEEP_INTERVAL)
+            try:
+                sweep_expired_reservations()
+            except Exception as ex:
+                db.session.rollback()
+                app.logger.error("Error when clearing expired reservations: %r" % ex)
+            finally:
+                db.session.remove()
+
+
+def load_gold_standards(data_type):
+    """
+    Load the IDs of the gold standards into the registry.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+
+    Returns
+    -------
+    dict
+        The registry item with the following keys:
+        - "pos" : numpy.ndarray, the IDs of the positive gold standards.
+        - "neg" : numpy.ndarray, the IDs of the negative gold standards.
+        - "load_time" : int, the epochtime when the IDs were loaded.
+    """
+    model, pos_labels, neg_labels = gold_standard_types[data_type]
+    rows = (
+        db.session.query(model.id, model.label_state_admin)
+        .filter(model.label_state_admin.in_(pos_labels + neg_labels))
+    ).all()
+    registry = {
+        "pos": np.array([r[0] for r in rows if r[1] in pos_labels], dtype=np.int64),
+        "neg": np.array([r[0] for r in rows if r[1] in neg_labels], dtype=np.int64),
+        "load_time": get_current_time()
+    }
+    with gold_standard_registry_lock:
+        gold_standard_registry[data_type] = registry
+    app.logger.info("Load %s gold standards: pos=%d, neg=%d" % (data_type, len(registry["pos"]), len(registry["neg"])))
+    return registry
+
+
+def get_gold_standards(data_type):
+    """Get the gold standard registry, and reload it if it is missing or expired."""
+    registry = gold_standard_registry[data_type]
+    if registry is None or get_current_time() - registry["load_time"] > config.GOLD_STANDARD_CACHE_TTL:
+        registry = load_gold_standards(data_type)
+    return registry
+
+
+def invalidate_gold_standards(data_type):
+    """
+    Drop the gold standard registry so that it is reloaded at the next draw.
+
+    Other worker processes reload their registries after config.GOLD_STANDARD_CACHE_TTL seconds,
+    ...or earlier when they draw a gold standard that is no longer valid.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    """
+    with gold_standard_registry_lock:
+        gold_standard_registry[data_type] = None
+
+
+def is_gold_standard_change(data_type, old_label_state_admin, new_label_state_admin):
+    """Check if a change of the researcher label state adds or removes a gold standard."""
+    _, pos_labels, neg_labels = gold_standard_types[data_type]
+    gold = pos_labels + neg_labels
+    if old_label_state_admin == new_label_state_admin: return False
+    return old_label_state_admin in gold or new_label_state_admin in gold
+
+
+def draw_gold_standards(data_type, num_pos, num_neg):
+    """
+    Draw positive and negative gold standards randomly from the registry.
+
+    The drawn gold standards are loaded from the database by their primary keys in one query.
+    If some of them are no longer gold standards (changed by other worker processes),
+    ...the registry is reloaded and the gold standards are drawn again.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+    num_pos : int
+        The number of positive gold standards.
+    num_neg : int
+        The number of negative gold standards.
+
+    Returns
+    -------
+    list of Video or SegmentationMask
+        The gold standards (positive ones first, then negative ones).
+        Return None if there are not enough gold standards.
+    """
+    _, pos_labels, neg_labels = gold_standard_types[data_type]
+    for _ in range(2):
+        registry = get_gold_standards(data_type)
+        if len(registry["pos"]) < num_pos or len(registry["neg"]) < num_neg:
+            return None
+        with gold_standard_registry_lock:
+            # The random number generator is not thread-safe (batches are also assembled in the background)
+            pos_ids = rng.choice(registry["pos"], num_pos, replace=False).tolist()
+            neg_ids = rng.choice(registry["neg"], num_neg, replace=False).tolist()
+        objects = load_items(data_type, pos_ids + neg_ids)
+        objects_hashed = {o.id: o for o in objects}
+        pos = [objects_hashed[i] for i in pos_ids if i in objects_hashed and objects_hashed[i].label_state_admin in pos_labels]
+        neg = [objects_hashed[i] for i in neg_ids if i in objects_hashed and objects_hashed[i].label_state_admin in neg_labels]
+        if len(pos) == num_pos and len(neg) == num_neg:
+            return pos + neg
+        invalidate_gold_standards(data_type)
+    return None
+
+
+def draw_batch_gold_standards(data_type):
+    """
+    Draw the gold standards of a batch for citizens from the registry.
+
+    The batch has config.GOLD_STANDARD_IN_BATCH (videos) or config.GOLD_STANDARD_IN_BATCH_SEG (segmentation masks) gold standards,
+    ...with at least one positive and one negative gold standard to prevent spamming.
+    Spamming patterns include ignoring or selecting all items.
+
+    Parameters
+    ----------
+    data_type : str
+        The type of data ("video" or "segmentation").
+
+    Returns
+    -------
+    list of Video or SegmentationMask
+        The gold standards (an empty list if the batch has no gold standards).
+        Return None if there are not enough gold standards.
+    """
+    num_gold = config.GOLD_STANDARD_IN_BATCH if data_type == "video" else config.GOLD_STANDARD_IN_BATCH_SEG
+    if num_gold <= 0: return []
+    num_gold_pos = np.random.choice(range(1, num_gold))
+    num_gold_neg = num_gold - num_gold_pos
+    return draw_gold_standards(data_type, num_gold_pos, num_gold_neg)
+
+
+def estimate_row_count(model):
+    """
+    Estimate the number of rows in the table of a model from the statistics of the query planner.
+
+    Parameters
+    ----------
+    model : Video or SegmentationMask
+        The model of the table.
+
+    Returns
+    -------
+    float
+        The estimated number of rows (zero or negative if the table was never analyzed).
+    """
+    table_name = model.__table__.name
+    n = cache_get(table_row_estimate_cache, table_name)
+    if n is None:
+        n = db.session.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = CAST(:t AS regclass)"),
+            {"t": table_name}
+        ).scalar()
+        n = -1 if n is None else float(n)
+        cache_set(table_row_estimate_cache, table_name, n)
+    return n
+
+
+def query_by_tablesample(model, build_query, n):
+    """
+    Query n random rows from a block sample of the table (TABLESAMPLE SYSTEM).
+
+    Only the rows in the sampled blocks are filtered and sorted randomly,
+    ...instead of sorting all the rows that match the filters.
+    The sample size is estimated from the number of rows in the table,
+    ...and it grows when the sample has too few matching rows.
+    Rows in the same block are often inserted together (e.g., videos from the same camera and day),
+    ...so the sample oversamples blocks by config.ADMIN_TABLESAMPLE_OVERSAMPLE to mix the rows.
+
+    Parameters
+    ----------
+    model : Video or SegmentationMask
+        The model of the table.
+    build_query : function
+        A function that takes the (sampled) entity and returns the query with filters.
+    n : int
+        The number of rows to query.
+
+    Returns
+    -------
+    list of Video or SegmentationMask
+        The rows, or None if there are not enough matching rows in the samples,
+        ...or the table is too small for block sampling (the caller should use the exact query then).
+    """
+    num_rows = estimate_row_count(model)
+    if num_rows <= 0: return None
+    percent = 100.0 * n * config.ADMIN_TABLESAMPLE_OVERSAMPLE / num_rows
+    for _ in range(config.ADMIN_TABLESAMPLE_MAX_TRIES):
+        if percent > config.ADMIN_TABLESAMPLE_MAX_PERCENT: return None
+        sampled = aliased(model, tablesample(model.__table__, func.system(percent)))
+        rows = build_query(sampled).order_by(func.random()).limit(n).all()
+        if len(rows) == n: return rows
+        percent *= 4
+    return None
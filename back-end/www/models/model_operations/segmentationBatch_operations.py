@@ -5,15 +5,24 @@ from models.model import SegmentationBatch
 from app.app import app
 
 
-def create_segmentation_batch(num_gold_standard, num_unlabeled, connection_id):
-    """Create a segmentation batch."""
+def create_segmentation_batch(num_gold_standard, num_unlabeled, connection_id, commit=True):
+    """
+    Create a segmentation batch.
+
+    Set commit to False to only flush the segmentation batch (to get its ID),
+    ...so that the objects loaded in the session are not expired before they are serialized.
+    The caller then needs to commit the session.
+    """
     batch = SegmentationBatch(
         num_gold_standard=num_gold_standard,
         num_unlabeled=num_unlabeled,
         connection_id=connection_id
     )
     db.session.add(batch)
-    db.session.commit()
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
     app.logger.info("Create segmentation batch: %r" % batch)
     return batch
 
@@ -1,13 +1,29 @@
 """Functions to operate the segmentattion feedback table."""
 
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import update
+from sqlalchemy import select
+from sqlalchemy import func
 from models.model import db
 from models.model import SegmentationFeedback
 from models.model import SegmentationMask
-from models.model import User
 from models.model import SegmentationBatch
+from models.model import SegmentationLatestFeedback
+from models.model_operations.segmentationMask_operations import add_segmentation_ids_labeled_by_user
+from models.model_operations.user_operations import increment_user_scores
+from models.model_operations.replay_operations import claim_batch
+from models.model_operations.replay_operations import get_batch_score
+from models.model_operations.sampling_operations import invalidate_gold_standards
+from models.model_operations.sampling_operations import update_candidate_pools
+from models.model_operations.sampling_operations import release_items
+from models.model_operations.sampling_operations import is_gold_standard_change
+from models.model_operations.label_state_operations import transition_label_state
+from models.model_operations.gallery_total_operations import invalidate_gallery_totals
 from app.app import app
 from util.util import get_current_time
 from config.config import config
+import models.model as m
 
 
 def create_feedback_label(sid, fc, x_bbox, y_bbox, w_bbox, h_bbox, user_id, batch_id, frame_number):
@@ -29,6 +45,112 @@ def create_feedback_label(sid, fc, x_bbox, y_bbox, w_bbox, h_bbox, user_id, batc
     return feedback
 
 
+def create_feedback_labels(rows):
+    """
+    Create segmentation feedback in bulk with one multi-row INSERT, without committing.
+
+    Parameters
+    ----------
+    rows : list of dict
+        The column values of the SegmentationFeedback rows.
+
+    Returns
+    -------
+    list of int
+        The IDs of the created segmentation feedback (in the same order as the rows).
+    """
+    stmt = insert(SegmentationFeedback).returning(SegmentationFeedback.id, sort_by_parameter_order=True)
+    feedback_ids = db.session.execute(stmt, rows).scalars().all()
+    app.logger.info("Create %d segmentation feedback" % len(feedback_ids))
+    return feedback_ids
+
+
+def upsert_latest_feedback(stmt):
+    """Make an INSERT of the SegmentationLatestFeedback table only replace the rows that have older feedback."""
+    table = SegmentationLatestFeedback.__table__
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.segmentation_id, table.c.feedback_code],
+        set_={"feedback_id": stmt.excluded.feedback_id, "time": stmt.excluded.time},
+        where=tuple_(stmt.excluded.time, stmt.excluded.feedback_id) > tuple_(table.c.time, table.c.feedback_id)
+    )
+
+
+def update_latest_feedback(rows, feedback_ids):
+    """
+    Point the latest researcher feedback of segmentation masks to the new feedback, without committing.
+
+    Parameters
+    ----------
+    rows : list of dict
+        The column values of the new SegmentationFeedback rows.
+    feedback_ids : list of int
+        The IDs of the new segmentation feedback (in the same order as the rows).
+    """
+    latest = {}
+    for row, feedback_id in zip(rows, feedback_ids):
+        if row["feedback_code"] not in m.researcher_feedback_codes_seg: continue
+        # One INSERT cannot update the same row twice, so only keep the last feedback of each mask and code
+        latest[(row["segmentation_id"], row["feedback_code"])] = {
+            "segmentation_id": row["segmentation_id"],
+            "feedback_code": row["feedback_code"],
+            "feedback_id": feedback_id,
+            "time": row["time"]
+        }
+    if len(latest) == 0: return
+    db.session.execute(upsert_latest_feedback(insert(SegmentationLatestFeedback).values(list(latest.values()))))
+
+
+def get_latest_feedback(segmentation_ids, feedback_codes):
+    """
+    Get the latest researcher feedback of segmentation masks with one query.
+
+    Parameters
+    ----------
+    segmentation_ids : list of int
+        The IDs of the segmentation masks.
+    feedback_codes : list of int
+        The researcher feedback codes.
+
+    Returns
+    -------
+    dict
+        The SegmentationFeedback objects, keyed by (segmentation_id, feedback_code).
+    """
+    if len(segmentation_ids) == 0: return {}
+    q = (
+        db.session.query(SegmentationFeedback)
+        .join(SegmentationLatestFeedback, SegmentationLatestFeedback.feedback_id == SegmentationFeedback.id)
+        .filter(SegmentationLatestFeedback.segmentation_id.in_(segmentation_ids))
+        .filter(SegmentationLatestFeedback.feedback_code.in_(feedback_codes))
+    )
+    return {(f.segmentation_id, f.feedback_code): f for f in q.all()}
+
+
+def backfill_latest_feedback():
+    """
+    Fill the SegmentationLatestFeedback table from all existing researcher feedback, and commit.
+
+    Existing rows are only replaced by newer feedback, so it is safe to run this again.
+
+    Returns
+    -------
+    int
+        The number of rows that are added or replaced.
+    """
+    f = SegmentationFeedback
+    latest = (
+        select(f.segmentation_id, f.feedback_code, f.id, f.time)
+        .where(f.feedback_code.in_(m.researcher_feedback_codes_seg))
+        .distinct(f.segmentation_id, f.feedback_code)
+        .order_by(f.segmentation_id, f.feedback_code, f.time.desc(), f.id.desc())
+    )
+    stmt = insert(SegmentationLatestFeedback).from_select(["segmentation_id", "feedback_code", "feedback_id", "time"], latest)
+    result = db.session.execute(upsert_latest_feedback(stmt))
+    db.session.commit()
+    app.logger.info("Backfill %d rows of the latest segmentation feedback" % result.rowcount)
+    return result.rowcount
+
+
 def remove_feedback_label(feedback_id):
     """Remove a segmentation feedback."""
     feedback = SegmentationMask.query.filter_by(id=feedback_id).first()
@@ -39,7 +161,7 @@ def remove_feedback_label(feedback_id):
     db.session.commit()
 
 
-def update_segmentation_labels(labels, user_id, connection_id, batch_id, client_type):
+def update_segmentation_labels(labels, user_id, connection_id, batch_id, client_type, jti=None):
     """
     Update the Segmentation table when a new label is added, return the score of the batch.
 
@@ -96,6 +218,10 @@ def update_segmentation_labels(labels, user_id, connection_id, batch_id, client_
         The segmentation batch id (defined in the batch table).
     client_type : int
         The type of user (defined in the user table).
+    jti : str
+        The unique ID of the batch token (JWT ID), which can only be consumed once.
+        If the batch was already returned, the batch is not processed again,
+        ...and the scores that were given to the batch are returned.
 
     Returns
     -------
@@ -109,35 +235,38 @@ def update_segmentation_labels(labels, user_id, connection_id, batch_id, client_
     segmentation_batch_hashed = {}
     for segmentation in segmentation_batch:
         segmentation_batch_hashed[segmentation.id] = segmentation
-    # Find the user
-    user = User.query.filter(User.id==user_id).first()
-    # Update batch data
+    # Update batch data and user scores
     is_admin_researcher = True if client_type == 0 else False
     batch_score = None
+    user_score = None
+    user_raw_score = None
     if batch_id is not None and connection_id is not None:
-        batch = SegmentationBatch.query.filter(SegmentationBatch.id==batch_id).first()
-        batch.return_time = get_current_time()
-        batch.connection_id = connection_id
+        # Claim the batch first, so that a replayed or concurrent duplicate submission is not processed again
+        if not claim_batch(SegmentationBatch, batch_id, jti, connection_id):
+            db.session.rollback()
+            return get_batch_score(SegmentationBatch, batch_id)
         if not is_admin_researcher: # do not update the score for reseacher
             batch_score = compute_segmentation_batch_score(segmentation_batch_hashed, labels)
-            batch.score = batch_score
-            batch.user_score = user.score
-            batch.user_raw_score = user.raw_score
-        app.logger.info("Update batch: %r" % batch)
+            # Add the scores in the database (the raw score is the number of unlabeled masks in the batch)
+            num_unlabeled = select(SegmentationBatch.num_unlabeled).where(SegmentationBatch.id==batch_id).scalar_subquery()
+            user_score, user_raw_score = increment_user_scores(user_id, batch_score, func.coalesce(num_unlabeled, 0))
+            # The batch keeps the user scores before adding this batch
+            stmt = (update(SegmentationBatch)
+                .where(SegmentationBatch.id==batch_id)
+                .values(score=batch_score, user_score=user_score - batch_score, user_raw_score=user_raw_score - func.coalesce(SegmentationBatch.num_unlabeled, 0))
+                .execution_options(synchronize_session=False))
+            db.session.execute(stmt)
+        app.logger.info("Update segmentation batch %r: score=%r" % (batch_id, batch_score))
     # Add labeling history and update the segmentation label state
     # If the batch score is 0, do not update the label history since this batch is not reliable
-    user_score = None
-    user_raw_score = None
-    if batch_score is not None:
-        user_raw_score = user.raw_score + batch.num_unlabeled
-        user.raw_score = user_raw_score
-        # Update user score
-        if not is_admin_researcher: # do not update the score for reseacher
-            user_score = user.score + batch_score
-            user.score = user_score
-        app.logger.info("Update user: %r" % user)
+    feedback_ids = []
+    gold_standard_changed = False
+    state_changes = []
     if batch_score != 0: # batch_score can be None if from the dashboard when updating labels
-        # Update labels
+        # Compute the feedback in memory and add all of them with one multi-row INSERT
+        # (in the same transaction as the segmentation label states, and with the same time)
+        t = get_current_time()
+        feedback_rows = []
         for s in labels:
             bbox = s["relative_boxes"]
             frame_number = s.get("frame_number", None)
@@ -157,25 +286,65 @@ def update_segmentation_labels(labels, user_id, connection_id, batch_id, client_
                 x_bbox, y_bbox, h_bbox, w_bbox = -3, -3, -3, -3
             else:
                 x_bbox, y_bbox, h_bbox, w_bbox = bbox["x_bbox"], bbox["y_bbox"], bbox["h_bbox"], bbox["w_bbox"]
-            feedback = create_feedback_label(s["id"], fc, x_bbox, y_bbox, w_bbox, h_bbox, user_id, batch_id, frame_number)
-            segmentation = segmentation_batch_hashed[s["id"]]
-            segmentation.label_update_time = feedback.time
+            feedback_rows.append({
+                "segmentation_id": s["id"],
+                "feedback_code": fc,
+                "x_bbox": x_bbox,
+                "y_bbox": y_bbox,
+                "w_bbox": w_bbox,
+                "h_bbox": h_bbox,
+                "frame_number": frame_number,
+                "time": t,
+                "user_id": user_id,
+                "batch_id": batch_id,
+                "client_type": client_type
+            })
+        # Move the label states with conditional updates, so that concurrent batches do not overwrite each other
+        # (in the order of the segmentation IDs to prevent deadlocks)
+        feedback_rows.sort(key=lambda row: row["segmentation_id"])
+        for row in feedback_rows:
+            segmentation = segmentation_batch_hashed[row["segmentation_id"]]
             if is_admin_researcher: # admin researcher
-                next_s = label_state_machine(segmentation.label_state_admin, fc, client_type)
+                # Researchers should not override the labels provided by normal users
+                # Because we need to compare the reliability of the labels provided by normal users
+                column_name, s = "label_state_admin", segmentation.label_state_admin
             else: # normal user
-                next_s = label_state_machine(segmentation.label_state, fc, client_type)
-            if next_s is not None:
-                if is_admin_researcher: # admin researcher
-                    # Researchers should not override the labels provided by normal users
-                    # Because we need to compare the reliability of the labels provided by normal users
-                    segmentation.label_state_admin = next_s
-                else: # normal user
-                    segmentation.label_state = next_s
-                app.logger.info("Update segmentation: %r" % segmentation)
+                column_name, s = "label_state", segmentation.label_state
+            version, change = transition_label_state(SegmentationMask, segmentation.id, column_name, s, segmentation.label_version,
+                lambda s: label_state_machine(s, row["feedback_code"], client_type), t)
+            # The feedback is the event log of the label states, so keep the version to replay them in order
+            row["version"] = version
+            if change is not None:
+                if is_admin_researcher and is_gold_standard_change("segmentation", change[0][1], change[1][1]):
+                    gold_standard_changed = True
+                state_changes.append((segmentation.id, change[0], change[1], segmentation.priority))
+                app.logger.info("Update segmentation %r from state %r to %r" % (segmentation.id, change[0], change[1]))
             else:
+                segmentation.label_update_time = t
                 app.logger.warning("No next state for segmentation: %r" % segmentation)
-    # Update database
+        # Add all feedback with one multi-row INSERT, in the same transaction as the segmentation label states
+        feedback_ids = create_feedback_labels(feedback_rows)
+        if is_admin_researcher:
+            update_latest_feedback(feedback_rows, feedback_ids)
+    # Release the reservations of the segmentation masks in this batch, so that other citizens can label them
+    if not is_admin_researcher:
+        release_items("segmentation", [s["id"] for s in labels])
+    # Update database (this is the only commit for the batch)
     db.session.commit()
+    # Move the segmentation masks to the correct candidate pools for sampling
+    for segmentation_id, old_state, new_state, priority in state_changes:
+        update_candidate_pools("segmentation", segmentation_id, old_state, new_state, priority)
+    # Reload the gold standards at the next draw if the researcher added or removed some
+    if gold_standard_changed:
+        invalidate_gold_standards("segmentation")
+    # Remember the segmentation masks labeled by the user for batch selection
+    if len(feedback_ids) > 0:
+        add_segmentation_ids_labeled_by_user(user_id, [s["id"] for s in labels])
+    # Count the gallery totals again if the label states or the feedback of the user have changed
+    if len(state_changes) > 0:
+        invalidate_gallery_totals("segmentation")
+    elif len(feedback_ids) > 0:
+        invalidate_gallery_totals("segmentation", user_id=user_id)
     return {"batch": batch_score, "user": user_score, "raw": user_raw_score}
 
 
@@ -249,6 +418,9 @@ def compute_segmentation_batch_score(segmentation_batch_hashed, labels, threshol
     """
     score = 0
     correct_labeled_gold_standards = 0
+    # Get the gold standard feedback of the edited gold standards with one query (instead of scanning all their feedback)
+    edited_gold_standard_ids = [s.id for s in segmentation_batch_hashed.values() if s.label_state_admin == 17]
+    latest_feedback = get_latest_feedback(edited_gold_standard_ids, [17])
     for v in labels:
         seg = segmentation_batch_hashed[v["id"]]
         label_state_admin = seg.label_state_admin
@@ -295,7 +467,7 @@ def compute_segmentation_batch_score(segmentation_batch_hashed, labels, threshol
                         "h_bbox": seg.h_bbox
                     }
                     # Next, get the gold standard feedback.
-                    f = get_latest_feedback_by_code(seg.feedback, label_state_admin)
+                    f = get_gold_standard_feedback(latest_feedback, seg)
                     gold_standard_b = {
                         "x_bbox": f.x_bbox,
                         "y_bbox": f.y_bbox,
@@ -311,7 +483,7 @@ def compute_segmentation_batch_score(segmentation_batch_hashed, labels, threshol
                     # This means that the user edited the box.
                     if frame_number_feedback == frame_number:
                         # First, we need to get the gold standard feedback.
-                        f = get_latest_feedback_by_code(seg.feedback, label_state_admin)
+                        f = get_gold_standard_feedback(latest_feedback, seg)
                         gold_standard_b = {
                             "x_bbox": f.x_bbox,
                             "y_bbox": f.y_bbox,
@@ -357,6 +529,20 @@ def compute_segmentation_batch_score(segmentation_batch_hashed, labels, threshol
         return score
 
 
+def get_gold_standard_feedback(latest_feedback, seg):
+    """
+    Get the researcher feedback that made a segmentation mask a gold standard.
+
+    The feedback is read from the SegmentationLatestFeedback table (see the get_latest_feedback function).
+    If the table does not have it (e.g., feedback that was added without the update_segmentation_labels function),
+    ...scan all feedback of the mask instead.
+    """
+    f = latest_feedback.get((seg.id, seg.label_state_admin))
+    if f is None:
+        f = get_latest_feedback_by_code(seg.feedback, seg.label_state_admin)
+    return f
+
+
 def get_latest_feedback_by_code(feedback_list, feedback_code):
     """
     Given a list of SegmentationFeedback objects and a feedback code,
@@ -380,6 +566,7 @@ def get_latest_feedback_by_code(feedback_list, feedback_code):
     If the gold standard segmentation mask has a lot of feedback,
     ...this function can have performance issues.
     The reason is because we also create feedback records for gold standard masks.
+    Use the get_latest_feedback function for the researcher feedback instead.
     """
     latest_feedback = None
     for f in feedback_list:
@@ -1,20 +1,44 @@
 """Functions to operate the segmentation table."""
 
-import numpy as np
 from sqlalchemy import func
 from sqlalchemy import and_
 from sqlalchemy import or_
-from sqlalchemy import desc
+from sqlalchemy import exists
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.orm import selectinload
 from random import shuffle
 from models.model import db
 from models.model import SegmentationMask
 from models.model import SegmentationFeedback
+from models.model import SegmentationLatestFeedback
 from models.model import Video
+from models.model_operations.sampling_operations import draw_batch_gold_standards
+from models.model_operations.sampling_operations import draw_candidate_batch
+from models.model_operations.sampling_operations import query_by_tablesample
+from models.model_operations.sampling_operations import admin_candidate_clause
+from models.model_operations.sampling_operations import reserve_items
+from models.model_operations.sampling_operations import not_reserved
+from models.model_operations.gallery_total_operations import get_gallery_total
+from models.model_operations.gallery_total_operations import get_labels_total_key
+from models.model_operations.gallery_total_operations import get_user_total_key
 from app.app import app
 from config.config import config
+from util.util import get_current_time
+from util.cache import create_cache
+from util.cache import cache_get
+from util.cache import cache_set
+from util.keyset import keyset_paginate
+from util.keyset import order_by_update_time
+from util.id_set import create_id_set
+from util.id_set import id_set_union
 import models.model as m
 
 
+# Cache the IDs of the segmentation masks labeled by each user (in this worker process)
+# Each item is a dictionary with the sorted segmentation IDs and the largest feedback ID that was read
+labeled_segmentation_id_cache = create_cache(config.LABELED_ID_CACHE_SIZE)
+
+
 def create_segmentation(mask_fn, img_fn, x_bbox, y_bbox, w_bbox, h_bbox, img_w, img_h, f_nbr, v_id, pr, fp, ft):
     """Create a segmentation mask."""
     segment = SegmentationMask(
@@ -55,11 +79,93 @@ def get_all_segmentations():
 
 def get_segmentation_ids_labeled_by_user(user_id):
     """Get a list of segmentation IDs labeled by the user before."""
-    labels = SegmentationFeedback.query.filter(SegmentationFeedback.user_id==user_id).all()
-    s_ids = set()
-    for label in labels:
-        s_ids.add(label.segmentation_id)
-    return list(s_ids)
+    return get_segmentation_id_set_labeled_by_user(user_id).tolist()
+
+
+def get_segmentation_id_set_labeled_by_user(user_id):
+    """
+    Get the set of segmentation IDs labeled by the user before.
+
+    Works in the same way as the get_video_id_set_labeled_by_user function in `video_operations.py`.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+        None means no user (an empty set is returned).
+
+    Returns
+    -------
+    numpy.ndarray
+        The sorted segmentation IDs (see the create_id_set function in `id_set.py`).
+    """
+    if user_id is None: return create_id_set()
+    item = cache_get(labeled_segmentation_id_cache, user_id)
+    q = (
+        db.session.query(SegmentationFeedback.segmentation_id, SegmentationFeedback.id)
+        .filter(SegmentationFeedback.user_id==user_id)
+    )
+    if item is None:
+        rows = q.all()
+        item = {"ids": create_id_set([r[0] for r in rows]), "max_feedback_id": max([r[1] for r in rows], default=0)}
+        cache_set(labeled_segmentation_id_cache, user_id, item)
+    else:
+        rows = q.filter(SegmentationFeedback.id > item["max_feedback_id"]).all()
+        if len(rows) > 0:
+            add_segmentation_ids_labeled_by_user(user_id, [r[0] for r in rows], max(r[1] for r in rows))
+            item = cache_get(labeled_segmentation_id_cache, user_id, item)
+    return item["ids"]
+
+
+def add_segmentation_ids_labeled_by_user(user_id, segmentation_ids, max_feedback_id=None):
+    """
+    Add segmentation IDs to the cached set of a user after writing or reading feedback.
+
+    Nothing happens if the user is not in the cache (the set will be loaded when needed).
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    segmentation_ids : list of int
+        The IDs of the segmentation masks that just got feedback.
+    max_feedback_id : int
+        The largest feedback ID that was read from the database.
+        None means that the feedback was just written (see the add_video_ids_labeled_by_user function in `video_operations.py`).
+    """
+    item = cache_get(labeled_segmentation_id_cache, user_id)
+    if item is None: return
+    if max_feedback_id is not None:
+        max_feedback_id = max(item["max_feedback_id"], max_feedback_id)
+    else:
+        max_feedback_id = item["max_feedback_id"]
+    cache_set(labeled_segmentation_id_cache, user_id, {
+        "ids": id_set_union(item["ids"], segmentation_ids),
+        "max_feedback_id": max_feedback_id
+    })
+
+
+def segmentation_labeled_by_user(user_id, segmentation=SegmentationMask):
+    """
+    Get the SQL clause that checks if a segmentation mask was labeled by the user.
+
+    See the labeled_by_user function in `video_operations.py` for details.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    segmentation : SegmentationMask or sqlalchemy.orm.util.AliasedClass
+        The segmentation entity in the outer query (e.g., an alias of a sampled segmentation table).
+
+    Returns
+    -------
+    sqlalchemy.sql.expression.Exists
+        The EXISTS clause that can be used in the filter function of a query.
+    """
+    return exists().where(and_(
+        SegmentationFeedback.segmentation_id==segmentation.id,
+        SegmentationFeedback.user_id==user_id))
 
 
 def query_segmentation_batch(user_id, use_admin_label_state=False):
@@ -70,6 +176,7 @@ def query_segmentation_batch(user_id, use_admin_label_state=False):
     ----------
     user_id : int
         The ID in the User table.
+        None means that no segmentations are excluded for a specific user (e.g., for pre-assembling batches).
     use_admin_label_state : bool
         Whether the returned segmentations should contain labeling information or not.
 
@@ -78,76 +185,118 @@ def query_segmentation_batch(user_id, use_admin_label_state=False):
     list of Segmentations
         The regementation object is defined in the Video model.
     """
-    # Get the segmentation IDs labeled by the user before
-    labeled_segmentation_ids = get_segmentation_ids_labeled_by_user(user_id)
     if use_admin_label_state:
         # For admin researcher, do not add gold standards
         # Exclude the segmentations that were labeled by the same user
-        q = SegmentationMask.query.filter(
+        # Load the videos of the segmentations in the same query (see the load_items function in `sampling_operations.py`)
+        # The inner join skips the segmentations without videos
+        def admin_query(s):
+            return db.session.query(s).join(s.video).options(contains_eager(s.video)).filter(
                 and_(
-                    SegmentationMask.label_state_admin==-1,
-                    SegmentationMask.id.notin_(labeled_segmentation_ids)
+                    admin_candidate_clause("segmentation", s),
+                    ~segmentation_labeled_by_user(user_id, s)
                 )
             )
-        segmentations = q.order_by(func.random()).limit(config.BATCH_SIZE_SEG).all()
+        segmentations = None
+        if config.ADMIN_SAMPLING_MODE == "tablesample":
+            # Sort only the rows in a block sample of the table (fall back to sorting all rows if there are not enough)
+            segmentations = query_by_tablesample(SegmentationMask, admin_query, config.BATCH_SIZE_SEG)
+        if segmentations is None:
+            segmentations = admin_query(SegmentationMask).order_by(func.random()).limit(config.BATCH_SIZE_SEG).all()
+    elif config.SEGMENTATION_SAMPLING_MODE in ["pool", "weighted"]:
+        # Get the segmentation IDs labeled by the user before and draw from the candidate pools
+        weighted = config.SEGMENTATION_SAMPLING_MODE == "weighted"
+        segmentations = query_segmentation_batch_from_pools(get_segmentation_id_set_labeled_by_user(user_id), weighted=weighted, reserve=user_id is not None)
+        if segmentations is None:
+            return None
     else:
-        if config.GOLD_STANDARD_IN_BATCH_SEG > 0:
-            # Select gold standards (at least one bbox that needs editing and anothe one that should be removed to prevent spamming)
-            # Spamming patterns include ignoring or selecting all segmentations
-            num_gold_pos = np.random.choice(range(1, config.GOLD_STANDARD_IN_BATCH_SEG))
-            num_gold_neg = config.GOLD_STANDARD_IN_BATCH_SEG - num_gold_pos
-            gold_pos = SegmentationMask.query.filter(SegmentationMask.label_state_admin.in_([16,17])).order_by(func.random()).limit(num_gold_pos).all()
-            gold_neg = SegmentationMask.query.filter(SegmentationMask.label_state_admin==18).order_by(func.random()).limit(num_gold_neg).all()
-            if (len(gold_pos + gold_neg) != config.GOLD_STANDARD_IN_BATCH_SEG):
-                # This means that there are not enough or no gold standard segmentations
-                return None
-        else:
-            gold_pos = []
-            gold_neg = []
+        # The gold standards are drawn from the in-memory registry (not sorted randomly in the database)
+        gold = draw_batch_gold_standards("segmentation")
+        if gold is None:
+            # This means that there are not enough or no gold standard segmentations
+            return None
         # Exclude segmentations labeled by the same user, also the gold standards and other terminal states of reseacher labels
         # (We do not want citizens to do the double work to confirm reseacher labeled segmentations)
+        # The exclusions are done in the database (anti-join), so no segmentation IDs are sent back and forth
         excluded_labels = m.gold_labels_seg + m.pos_labels_seg + m.neg_labels_seg + m.bad_labels_seg
-        excluded_s_ids = SegmentationMask.query.filter(SegmentationMask.label_state_admin.in_(excluded_labels)).with_entities(SegmentationMask.id).all()
-        excluded_s_ids = [s[0] for s in excluded_s_ids]
-        q = SegmentationMask.query.filter(SegmentationMask.id.notin_(labeled_segmentation_ids + excluded_s_ids))
+        q = SegmentationMask.query.join(SegmentationMask.video).options(contains_eager(SegmentationMask.video)).filter(
+                and_(
+                    SegmentationMask.label_state_admin.notin_(excluded_labels),
+                    ~segmentation_labeled_by_user(user_id)
+                )
+            )
         # Try to include some partially labeled segmentations in this batch
         num_unlabeled = config.BATCH_SIZE_SEG - config.GOLD_STANDARD_IN_BATCH_SEG
         num_partially_labeled = int(num_unlabeled*config.PARTIAL_LABEL_RATIO)
-        partially_labeled = q.filter(SegmentationMask.label_state.in_(m.partial_labels_seg)).order_by(func.random()).limit(num_partially_labeled).all()
+        # Skip the ones reserved by other citizens, and reserve the selected ones for this user
+        partially_labeled = q.filter(and_(SegmentationMask.label_state.in_(m.partial_labels_seg), not_reserved(SegmentationMask, get_current_time()))).order_by(func.random()).limit(num_partially_labeled).all()
+        if user_id is not None:
+            reserved = reserve_items("segmentation", [s.id for s in partially_labeled])
+            partially_labeled = [s for s in partially_labeled if s.id in reserved]
         not_labeled = q.filter(SegmentationMask.label_state==-1).order_by(func.random()).limit(num_unlabeled - len(partially_labeled)).all()
         # Assemble the segmentation masks
-        segmentations = gold_pos + gold_neg + not_labeled + partially_labeled
+        segmentations = gold + not_labeled + partially_labeled
         shuffle(segmentations)
 
-    # Join the video table to get video data
-    return segmentatio_mask_join_video_table(segmentations)
+    # The videos are already loaded with the segmentations, so no extra query is needed for the video data
+    return segmentations
 
 
-def segmentatio_mask_join_video_table(segmentations):
+def query_segmentation_batch_from_pools(labeled_segmentation_id_set, weighted=False, reserve=False):
     """
-    Join the segmentation records with the video table.
+    Query a batch of segmentation masks for citizens from the in-memory candidate pools.
+
+    See the query_video_batch_from_pools function in `video_operations.py` for details.
 
     Parameters
     ----------
-    segmentations : SegmentationMask
-        The SegmentationMask records.
+    labeled_segmentation_id_set : numpy.ndarray
+        The IDs of the segmentation masks that were labeled by the user before.
+        See the get_segmentation_id_set_labeled_by_user function.
+    weighted : bool
+        Draw segmentation masks with higher priority more often (see the draw_candidate_batch function).
+    reserve : bool
+        Reserve the partially labeled items for the user (see the reserve_items function in `sampling_operations.py`).
 
     Returns
     -------
-    SegmentationMask
-        SegmentationMask records with the video field.
+    list of SegmentationMask
+        The segmentation object is defined in the SegmentationMask model.
+    """
+    # The gold standards are drawn from the in-memory registry (not sorted randomly in the database)
+    gold = draw_batch_gold_standards("segmentation")
+    if gold is None:
+        # This means that there are not enough or no gold standard segmentations
+        return None
+    num_unlabeled = config.BATCH_SIZE_SEG - config.GOLD_STANDARD_IN_BATCH_SEG
+    num_partially_labeled = int(num_unlabeled*config.PARTIAL_LABEL_RATIO)
+    selected = draw_candidate_batch("segmentation", num_partially_labeled, num_unlabeled, labeled_segmentation_id_set, weighted=weighted, reserve=reserve)
+    # Assemble the segmentation masks
+    segmentations = gold + selected["unlabeled"] + selected["partial"]
+    shuffle(segmentations)
+    return segmentations
+
+
+def gallery_load_options(with_latest_feedback=False):
     """
-    seg_ids = [s.id for s in segmentations]
-    joined_tuple = (
-            db.session.query(SegmentationMask, Video)
-            .filter(SegmentationMask.id.in_(seg_ids))
-            .join(Video, SegmentationMask.video_id == Video.id)
-        ).all()
-    seg_with_video = []
-    for seg_mask, video in joined_tuple:
-        seg_mask.video = video
-        seg_with_video.append(seg_mask)
-    return seg_with_video
+    Get the loader options of the gallery queries.
+
+    The feedback and videos of all segmentation masks in a page are loaded with one SELECT ... IN query each,
+    ...so that the only_latest_researcher_feedback and filter_feedback_by_user_id functions
+    ...and the schemas for jsonify do not run one query for each mask.
+
+    Parameters
+    ----------
+    with_latest_feedback : bool
+        Load the latest researcher feedback for the only_latest_researcher_feedback function, instead of all feedback.
+        The only_latest_researcher_feedback function then queries the feedback of citizens for the whole page.
+    """
+    if with_latest_feedback:
+        return (
+            selectinload(SegmentationMask.video),
+            selectinload(SegmentationMask.latest_feedback).joinedload(SegmentationLatestFeedback.feedback)
+        )
+    return (selectinload(SegmentationMask.feedback), selectinload(SegmentationMask.video))
 
 
 def filter_feedback_by_user_id(segmentations, user_id):
@@ -194,30 +343,44 @@ def only_latest_researcher_feedback(segmentations):
 
     Notes
     ----------
-    If the gold standard segmentation mask has a lot of feedback,
-    ...this function can have performance issues.
-    The reason is because we also create feedback records for gold standard masks.
+    The researcher feedback is read from the SegmentationLatestFeedback table (the latest one for each feedback code),
+    ...so gold standard masks with a lot of feedback do not need to scan all their researcher feedback.
+    The feedback of citizens for all masks is read with one query (not from the feedback field of the masks).
+    Masks that have no rows in the SegmentationLatestFeedback table fall back to scanning their researcher feedback.
+    Load the segmentation masks with the gallery_load_options function to get them in a few queries.
     """
+    if len(segmentations) == 0: return segmentations
+    researcher_codes = m.researcher_feedback_codes_seg
+    fallback_ids = [s.id for s in segmentations if len(s.latest_feedback) == 0]
+    feedback_codes_clause = SegmentationFeedback.feedback_code.notin_(researcher_codes)
+    if len(fallback_ids) > 0:
+        feedback_codes_clause = or_(feedback_codes_clause, SegmentationFeedback.segmentation_id.in_(fallback_ids))
+    feedback = (
+        SegmentationFeedback.query
+        .filter(and_(SegmentationFeedback.segmentation_id.in_([s.id for s in segmentations]), feedback_codes_clause))
+        .order_by(SegmentationFeedback.id)
+    ).all()
+    citizen_feedback = {s.id: [] for s in segmentations}
+    researcher_feedback = {s.id: [] for s in segmentations}
+    for f in feedback:
+        if f.feedback_code in researcher_codes:
+            researcher_feedback[f.segmentation_id].append(f)
+        else:
+            citizen_feedback[f.segmentation_id].append(f)
     for s in segmentations:
-        feedback_filtered = []
-        latest_reseacher_feedback = None
-        for f in s.feedback:
-            if f.feedback_code in [3, 4, 5, 16, 17, 18, -1, -2]:
-                # This means the feedback is provided by researchers
-                if latest_reseacher_feedback is None:
-                    latest_reseacher_feedback = f
-                else:
-                    if f.time > latest_reseacher_feedback.time:
-                        latest_reseacher_feedback = f
-            else:
-                feedback_filtered.append(f)
+        feedback_filtered = citizen_feedback[s.id]
+        # The latest researcher feedback is the latest one among all researcher feedback codes
+        if len(s.latest_feedback) > 0:
+            latest_reseacher_feedback = max(s.latest_feedback, key=lambda lf: (lf.time, lf.feedback_id)).feedback
+        else:
+            latest_reseacher_feedback = max(researcher_feedback[s.id], key=lambda f: (f.time, f.id), default=None)
         if latest_reseacher_feedback is not None and latest_reseacher_feedback.feedback_code not in [-1, -2]:
             feedback_filtered.append(latest_reseacher_feedback)
         s.feedback_filtered = feedback_filtered
     return segmentations
 
 
-def get_segmentation_query(labels, page_number, page_size, use_admin_label_state=False):
+def get_segmentation_query(labels, page_number, page_size, use_admin_label_state=False, cursor=None):
     """
     Get SegmentationMask query from the database by the type of labels.
 
@@ -236,13 +399,22 @@ def get_segmentation_query(labels, page_number, page_size, use_admin_label_state
         One is for the normal user (label_state).
         And another one is for the researcher (label_state_admin).
         See the definition of the "label_state_admin" column in the segmentation table.
+    cursor : str
+        The cursor of the keyset pagination (see the keyset_paginate function in `keyset.py`).
+        If not None, the page starts after the cursor (an empty string means the first page),
+        ...and the page number is ignored.
 
     Returns
     -------
     The query object of the SegmentationMask table.
+    (a KeysetPage if the cursor is not None, see the keyset_paginate function in `keyset.py`)
     """
     page_size = config.MAX_PAGE_SIZE if page_size > config.MAX_PAGE_SIZE else page_size
-    q = SegmentationMask.query.join(Video, SegmentationMask.video_id == Video.id)
+    q = (
+        SegmentationMask.query
+        .join(Video, SegmentationMask.video_id == Video.id)
+        .options(*gallery_load_options(with_latest_feedback=True))
+    )
 
     if type(labels) == list:
         if len(labels) > 1:
@@ -264,32 +436,29 @@ def get_segmentation_query(labels, page_number, page_size, use_admin_label_state
     elif type(labels) == str:
         # Aggregate citizen and researcher labels
         # Researcher labels override citizen labels
+        # The clauses match the partial indexes on the segmentation table
         if labels == "pos":
             # Exclude gold standards and bad labels for normal request
-            q = q.filter(and_(
-                SegmentationMask.label_state_admin.notin_(m.bad_labels_seg + m.gold_labels_seg),
-                or_(
-                    SegmentationMask.label_state_admin.in_(m.pos_labels_seg),
-                    and_(
-                        SegmentationMask.label_state_admin.notin_(m.pos_labels_seg + m.neg_labels_seg),
-                        SegmentationMask.label_state.in_(m.pos_labels_seg)))))
+            q = q.filter(m.aggregated_label_clause(SegmentationMask.label_state, SegmentationMask.label_state_admin,
+                m.pos_labels_seg, m.pos_labels_seg + m.neg_labels_seg, m.bad_labels_seg + m.gold_labels_seg))
         elif labels == "neg":
             # Exclude gold standards and bad labels for normal request
-            q = q.filter(and_(
-                SegmentationMask.label_state_admin.notin_(m.bad_labels_seg + m.gold_labels_seg),
-                or_(
-                    SegmentationMask.label_state_admin.in_(m.neg_labels_seg),
-                    and_(
-                        SegmentationMask.label_state_admin.notin_(m.pos_labels_seg + m.neg_labels_seg),
-                        SegmentationMask.label_state.in_(m.neg_labels_seg)))))
-
-    q = q.order_by(desc(SegmentationMask.label_update_time))
+            q = q.filter(m.aggregated_label_clause(SegmentationMask.label_state, SegmentationMask.label_state_admin,
+                m.neg_labels_seg, m.pos_labels_seg + m.neg_labels_seg, m.bad_labels_seg + m.gold_labels_seg))
+
+    if cursor is not None:
+        return keyset_paginate(q, SegmentationMask, cursor, min(page_size, 100))
+    q = order_by_update_time(q, SegmentationMask)
     if page_number is not None and page_size is not None:
-        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100)
+        # The total is cached, so only count the items when the cache does not have it
+        key = get_labels_total_key(labels, use_admin_label_state)
+        total = get_gallery_total("segmentation", key, q)
+        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100, count=False)
+        q.total = total
     return q
 
 
-def get_pos_segmentation_query_by_user_id(user_id, page_number, page_size, is_researcher):
+def get_pos_segmentation_query_by_user_id(user_id, page_number, page_size, is_researcher, cursor=None):
     """
     Get SegmentationMask query (with positive labels) from the database by user id (exclude gold standards).
 
@@ -306,10 +475,15 @@ def get_pos_segmentation_query_by_user_id(user_id, page_number, page_size, is_re
         The page size that the front-end requested.
     is_researcher : bool
         If the client type is researcher or not.
+    cursor : str
+        The cursor of the keyset pagination (see the keyset_paginate function in `keyset.py`).
+        If not None, the page starts after the cursor (an empty string means the first page),
+        ...and the page number is ignored.
 
     Returns
     -------
     The query object of the SegmentationMask table.
+    (a KeysetPage if the cursor is not None, see the keyset_paginate function in `keyset.py`)
     """
     page_size = config.MAX_PAGE_SIZE if page_size > config.MAX_PAGE_SIZE else page_size
     if is_researcher: # researcher
@@ -325,12 +499,18 @@ def get_pos_segmentation_query_by_user_id(user_id, page_number, page_size, is_re
         SegmentationMask.query
         .join(Video, SegmentationMask.video_id == Video.id)
         .join(q, SegmentationMask.id == q.c.segmentation_id)
+        .options(*gallery_load_options())
         .distinct()
         .filter(SegmentationMask.label_state_admin.notin_(m.gold_labels_seg))
-        .order_by(desc(SegmentationMask.label_update_time))
     )
+    if cursor is not None:
+        return keyset_paginate(q, SegmentationMask, cursor, min(page_size, 100))
+    q = order_by_update_time(q, SegmentationMask)
     if page_number is not None and page_size is not None:
-        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100)
+        # The total is cached, so only count the items when the cache does not have it
+        total = get_gallery_total("segmentation", get_user_total_key(user_id, is_researcher), q)
+        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100, count=False)
+        q.total = total
     return q
 
 
@@ -2,22 +2,10 @@
 
 from models.model import db
 from models.model import SegmentationView
+from models.model_operations.view_buffer_operations import record_views
 from app.app import app
 
 
-def create_segmentation_view(connection_id, segmentation_id, query_type):
-    """Create a segmentation view."""
-    segmentation_view = SegmentationView(
-        connection_id=connection_id,
-        segmentation_id=segmentation_id,
-        query_type=query_type
-    )
-    db.session.add(segmentation_view)
-    db.session.commit()
-    app.logger.info("Create segmentation view: %r" % segmentation_view)
-    return segmentation_view
-
-
 def remove_segmentation_view(segmentation_view_id):
     """Remove a segmentation view."""
     segmentation_view = SegmentationView.query.filter_by(id=segmentation_view_id).first()
@@ -43,8 +31,10 @@ def create_segmentation_views_from_segmentation_batch(segmentations, user_jwt, q
         See the view table for definition.
     """
     if query_type is None: return
-    for s in segmentations:
-        # Connection_id -1 means that the connection is from other app, not the current app.
-        # If connections comes from another app, we do not want to add them to the view table.
-        if user_jwt is not None and user_jwt["connection_id"] != -1:
-            create_segmentation_view(user_jwt["connection_id"], s.id, query_type)
+    # Connection_id -1 means that the connection is from other app, not the current app.
+    # If connections comes from another app, we do not want to add them to the view table.
+    if user_jwt is not None and user_jwt["connection_id"] != -1:
+        # If config.VIEW_BUFFER_ENABLED is True, the views are buffered and written in bulk later,
+        # ...otherwise they are written now with one INSERT and a commit, which expires the loaded objects
+        # ...(so the caller should serialize the segmentation masks before recording the views)
+        record_views("segmentation", user_jwt["connection_id"], [s.id for s in segmentations], query_type)
@@ -0,0 +1,55 @@
+"""Functions to operate the video uncertainty table."""
+
+from sqlalchemy.dialects.postgresql import insert
+from models.model import db
+from models.model import Video
+from models.model import VideoUncertainty
+from app.app import app
+from util.util import get_current_time
+
+
+def upsert_video_uncertainty(scores, chunk_size=10000):
+    """
+    Insert or update the uncertainty scores of videos in bulk.
+
+    Parameters
+    ----------
+    scores : dict
+        The uncertainty scores keyed by video ID.
+    chunk_size : int
+        The number of rows to write in each statement.
+
+    Returns
+    -------
+    int
+        The number of rows that are inserted or updated.
+    """
+    t = get_current_time()
+    rows = [{"video_id": k, "score": float(v), "update_time": t} for k, v in scores.items()]
+    for i in range(0, len(rows), chunk_size):
+        stmt = insert(VideoUncertainty).values(rows[i:i+chunk_size])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[VideoUncertainty.video_id],
+            set_={"score": stmt.excluded.score, "update_time": stmt.excluded.update_time}
+        )
+        db.session.execute(stmt)
+    db.session.commit()
+    app.logger.info("Upsert %d video uncertainty scores" % len(rows))
+    return len(rows)
+
+
+def get_video_ids_by_file_names(file_names):
+    """Get a dictionary that maps video file names to video IDs (in one query)."""
+    rows = db.session.query(Video.file_name, Video.id).filter(Video.file_name.in_(file_names)).all()
+    return {r[0]: r[1] for r in rows}
+
+
+def remove_video_uncertainty(video_ids=None):
+    """Remove the uncertainty scores of the videos (or all scores if video_ids is None)."""
+    q = VideoUncertainty.query
+    if video_ids is not None:
+        q = q.filter(VideoUncertainty.video_id.in_(video_ids))
+    num_removed = q.delete(synchronize_session=False)
+    db.session.commit()
+    app.logger.info("Remove %d video uncertainty scores" % num_removed)
+    return num_removed
@@ -1,5 +1,6 @@
 """Functions to operate the user table."""
 
+from sqlalchemy import update
 from models.model import db
 from models.model import User
 from app.app import app
@@ -40,6 +41,39 @@ def update_client_type_by_user_id(user_id, client_type):
     return user
 
 
+def increment_user_scores(user_id, score, raw_score):
+    """
+    Add to the score and raw score of a user with one atomic UPDATE (without committing).
+
+    The scores are added in the database instead of in Python,
+    ...so that concurrent batches of the same user do not overwrite each other.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    score : int or SQL expression
+        The number to add to the score.
+    raw_score : int or SQL expression
+        The number to add to the raw score.
+
+    Returns
+    -------
+    tuple of int
+        The score and raw score of the user after adding the numbers.
+    """
+    stmt = (update(User)
+        .where(User.id==user_id)
+        .values(score=User.score + score, raw_score=User.raw_score + raw_score)
+        .returning(User.score, User.raw_score)
+        .execution_options(synchronize_session=False))
+    row = db.session.execute(stmt).first()
+    if row is None:
+        raise Exception("No user found in the database to update.")
+    app.logger.info("Update user %r: score=%r raw_score=%r" % (user_id, row[0], row[1]))
+    return tuple(row)
+
+
 def remove_user(user_id):
     """Remove a user."""
     user = get_user_by_id(user_id)
@@ -5,17 +5,42 @@ from sqlalchemy import func
 from sqlalchemy import and_
 from sqlalchemy import or_
 from sqlalchemy import desc
+from sqlalchemy import exists
 from sqlalchemy.orm import load_only
 from sqlalchemy.exc import IntegrityError
 from random import shuffle
 from models.model import db
 from models.model import Video
 from models.model import Label
+from models.model import VideoUncertainty
+from models.model_operations.sampling_operations import draw_candidate_batch
+from models.model_operations.sampling_operations import reserve_items
+from models.model_operations.sampling_operations import not_reserved
+from models.model_operations.sampling_operations import draw_batch_gold_standards
+from models.model_operations.sampling_operations import candidate_types
+from models.model_operations.sampling_operations import query_by_tablesample
+from models.model_operations.sampling_operations import admin_candidate_clause
+from models.model_operations.gallery_total_operations import get_gallery_total
+from models.model_operations.gallery_total_operations import get_labels_total_key
+from models.model_operations.gallery_total_operations import get_user_total_key
 from app.app import app
 from config.config import config
+from util.util import get_current_time
+from util.cache import create_cache
+from util.cache import cache_get
+from util.cache import cache_set
+from util.keyset import keyset_paginate
+from util.keyset import order_by_update_time
+from util.id_set import create_id_set
+from util.id_set import id_set_union
 import models.model as m
 
 
+# Cache the IDs of the videos labeled by each user (in this worker process)
+# Each item is a dictionary with the sorted video IDs and the largest label ID that was read
+labeled_video_id_cache = create_cache(config.LABELED_ID_CACHE_SIZE)
+
+
 def create_video(fn, st, et, up, vid, cid):
     """Create a video."""
     try:
@@ -54,11 +79,94 @@ def get_all_videos():
 
 def get_video_ids_labeled_by_user(user_id):
     """Get a list of video IDs labeled by the user before."""
-    labels = Label.query.filter(Label.user_id==user_id).all()
-    v_ids = set()
-    for label in labels:
-        v_ids.add(label.video_id)
-    return list(v_ids)
+    return get_video_id_set_labeled_by_user(user_id).tolist()
+
+
+def get_video_id_set_labeled_by_user(user_id):
+    """
+    Get the set of video IDs labeled by the user before.
+
+    The set is cached for each user.
+    On a cache miss, only the video IDs are loaded from the database (not the Label rows).
+    On a cache hit, only the labels added after the cached ones are loaded,
+    ...which are usually zero or a few rows, and it covers the labels written by other worker processes.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+        None means no user (an empty set is returned).
+
+    Returns
+    -------
+    numpy.ndarray
+        The sorted video IDs (see the create_id_set function in `id_set.py`).
+    """
+    if user_id is None: return create_id_set()
+    item = cache_get(labeled_video_id_cache, user_id)
+    q = db.session.query(Label.video_id, Label.id).filter(Label.user_id==user_id)
+    if item is None:
+        rows = q.all()
+        item = {"ids": create_id_set([r[0] for r in rows]), "max_label_id": max([r[1] for r in rows], default=0)}
+        cache_set(labeled_video_id_cache, user_id, item)
+    else:
+        rows = q.filter(Label.id > item["max_label_id"]).all()
+        if len(rows) > 0:
+            add_video_ids_labeled_by_user(user_id, [r[0] for r in rows], max(r[1] for r in rows))
+            item = cache_get(labeled_video_id_cache, user_id, item)
+    return item["ids"]
+
+
+def add_video_ids_labeled_by_user(user_id, video_ids, max_label_id=None):
+    """
+    Add video IDs to the cached set of a user after writing or reading labels.
+
+    Nothing happens if the user is not in the cache (the set will be loaded when needed).
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    video_ids : list of int
+        The IDs of the newly labeled videos.
+    max_label_id : int
+        The largest label ID that was read from the database (all labels of the user up to this ID are in the set).
+        None means that the labels were just written, which keeps the largest label ID that was read,
+        ...because other worker processes may have written labels of the user with smaller IDs in between.
+        The next read then still gets those labels.
+    """
+    item = cache_get(labeled_video_id_cache, user_id)
+    if item is None: return
+    if max_label_id is not None:
+        max_label_id = max(item["max_label_id"], max_label_id)
+    else:
+        max_label_id = item["max_label_id"]
+    cache_set(labeled_video_id_cache, user_id, {
+        "ids": id_set_union(item["ids"], video_ids),
+        "max_label_id": max_label_id
+    })
+
+
+def labeled_by_user(user_id, video=Video):
+    """
+    Get the SQL clause that checks if a video was labeled by the user.
+
+    Use the negation (~labeled_by_user(user_id)) to exclude the labeled videos with NOT EXISTS,
+    ...which the database runs as an anti-join by using the index on the label table.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+    video : Video or sqlalchemy.orm.util.AliasedClass
+        The video entity in the outer query (e.g., an alias of a sampled video table).
+
+    Returns
+    -------
+    sqlalchemy.sql.expression.Exists
+        The EXISTS clause that can be used in the filter function of a query.
+    """
+    return exists().where(and_(Label.video_id==video.id, Label.user_id==user_id))
 
 
 def query_video_batch(user_id, use_admin_label_state=False):
@@ -69,6 +177,7 @@ def query_video_batch(user_id, use_admin_label_state=False):
     ----------
     user_id : int
         The ID in the User table.
+        None means that no videos are excluded for a specific user (e.g., for pre-assembling batches).
     use_admin_label_state : bool
         Whether the returned videos should contain labeling information or not.
 
@@ -77,50 +186,158 @@ def query_video_batch(user_id, use_admin_label_state=False):
     list of Video
         The video object is defined in the Video model.
     """
-    # Get the video IDs labeled by the user before
-    labeled_video_ids = get_video_ids_labeled_by_user(user_id)
+    if config.VIDEO_SAMPLING_MODE in ["pool", "weighted"] and not use_admin_label_state:
+        # Get the video IDs labeled by the user before and draw from the candidate pools
+        weighted = config.VIDEO_SAMPLING_MODE == "weighted"
+        return query_video_batch_from_pools(get_video_id_set_labeled_by_user(user_id), weighted=weighted, reserve=user_id is not None)
+    if config.VIDEO_SAMPLING_MODE == "uncertainty" and not use_admin_label_state:
+        # Give the videos that the model is most uncertain about (active learning)
+        return query_video_batch_by_uncertainty(user_id)
     if use_admin_label_state:
         # For admin researcher, do not add gold standards
         # Exclude the videos that were labeled by the same user
-        q = Video.query.filter(
+        def admin_query(v):
+            return db.session.query(v).filter(
                 and_(
-                    Video.label_state_admin.in_((-1, 0b11, 0b100, 0b101)),
-                    Video.id.notin_(labeled_video_ids)
+                    admin_candidate_clause("video", v),
+                    ~labeled_by_user(user_id, v)
                 )
             )
-        return q.order_by(func.random()).limit(config.BATCH_SIZE).all()
+        if config.ADMIN_SAMPLING_MODE == "tablesample":
+            # Sort only the rows in a block sample of the table (fall back to sorting all rows if there are not enough)
+            videos = query_by_tablesample(Video, admin_query, config.BATCH_SIZE)
+            if videos is not None: return videos
+        return admin_query(Video).order_by(func.random()).limit(config.BATCH_SIZE).all()
     else:
-        if config.GOLD_STANDARD_IN_BATCH > 0:
-            # Select gold standards (at least one pos and neg to prevent spamming)
-            # Spamming patterns include ignoring or selecting all videos
-            num_gold_pos = np.random.choice(range(1, config.GOLD_STANDARD_IN_BATCH))
-            num_gold_neg = config.GOLD_STANDARD_IN_BATCH - num_gold_pos
-            gold_pos = Video.query.filter(Video.label_state_admin==0b101111).order_by(func.random()).limit(num_gold_pos).all()
-            gold_neg = Video.query.filter(Video.label_state_admin==0b100000).order_by(func.random()).limit(num_gold_neg).all()
-            if (len(gold_pos + gold_neg) != config.GOLD_STANDARD_IN_BATCH):
-                # This means that there are not enough or no gold standard videos
-                return None
-        else:
-            gold_pos = []
-            gold_neg = []
+        # The gold standards are drawn from the in-memory registry (not sorted randomly in the database)
+        gold = draw_batch_gold_standards("video")
+        if gold is None:
+            # This means that there are not enough or no gold standard videos
+            return None
         # Exclude videos labeled by the same user, also the gold standards and other terminal states of reseacher labels
         # (We do not want citizens to do the double work to confirm reseacher labeled videos)
+        # The exclusions are done in the database (anti-join), so no video IDs are sent back and forth
         excluded_labels = (0b101111, 0b100000, 0b10111, 0b10000, 0b10011, 0b10100, 0b1111, 0b1100, -2)
-        excluded_v_ids = Video.query.filter(Video.label_state_admin.in_(excluded_labels)).with_entities(Video.id).all()
-        excluded_v_ids = [v[0] for v in excluded_v_ids]
-        q = Video.query.filter(Video.id.notin_(labeled_video_ids + excluded_v_ids))
+        q = Video.query.filter(
+                and_(
+                    Video.label_state_admin.notin_(excluded_labels),
+                    ~labeled_by_user(user_id)
+                )
+            )
         # Try to include some partially labeled videos in this batch
         num_unlabeled = config.BATCH_SIZE - config.GOLD_STANDARD_IN_BATCH
         num_partially_labeled = int(num_unlabeled*config.PARTIAL_LABEL_RATIO)
-        partially_labeled = q.filter(Video.label_state.in_((0b11, 0b100, 0b101))).order_by(func.random()).limit(num_partially_labeled).all()
+        # Skip the ones reserved by other citizens, and reserve the selected ones for this user
+        partially_labeled = q.filter(and_(Video.label_state.in_((0b11, 0b100, 0b101)), not_reserved(Video, get_current_time()))).order_by(func.random()).limit(num_partially_labeled).all()
+        if user_id is not None:
+            reserved = reserve_items("video", [v.id for v in partially_labeled])
+            partially_labeled = [v for v in partially_labeled if v.id in reserved]
         not_labeled = q.filter(Video.label_state==-1).order_by(func.random()).limit(num_unlabeled - len(partially_labeled)).all()
         # Assemble the videos
-        videos = gold_pos + gold_neg + not_labeled + partially_labeled
+        videos = gold + not_labeled + partially_labeled
         shuffle(videos)
         return videos
 
 
-def get_video_query(labels, page_number, page_size, use_admin_label_state=False):
+def query_video_batch_from_pools(labeled_video_id_set, weighted=False, reserve=False):
+    """
+    Query a batch of videos for citizens from the in-memory candidate pools.
+
+    This gives the same batch composition as the query_video_batch function,
+    ...but it does not need to sort the video table randomly for each request.
+
+    Parameters
+    ----------
+    labeled_video_id_set : numpy.ndarray
+        The IDs of the videos that were labeled by the user before.
+        See the get_video_id_set_labeled_by_user function.
+    weighted : bool
+        Draw videos with higher priority more often (see the draw_candidate_batch function).
+    reserve : bool
+        Reserve the partially labeled items for the user (see the reserve_items function in `sampling_operations.py`).
+
+    Returns
+    -------
+    list of Video
+        The video object is defined in the Video model.
+    """
+    # The gold standards are drawn from the in-memory registry (not sorted randomly in the database)
+    gold = draw_batch_gold_standards("video")
+    if gold is None:
+        # This means that there are not enough or no gold standard videos
+        return None
+    num_unlabeled = config.BATCH_SIZE - config.GOLD_STANDARD_IN_BATCH
+    num_partially_labeled = int(num_unlabeled*config.PARTIAL_LABEL_RATIO)
+    selected = draw_candidate_batch("video", num_partially_labeled, num_unlabeled, labeled_video_id_set, weighted=weighted, reserve=reserve)
+    # Assemble the videos
+    videos = gold + selected["unlabeled"] + selected["partial"]
+    shuffle(videos)
+    return videos
+
+
+def query_video_batch_by_uncertainty(user_id):
+    """
+    Query a batch of videos for citizens by the model uncertainty (active learning).
+
+    The most uncertain candidates (config.UNCERTAINTY_CANDIDATE_FACTOR times the number of videos needed)
+    ...are read in the order of the score index, so the video table is not sorted.
+    The videos are then chosen randomly from the candidates, so that concurrent users get different videos.
+    Videos without uncertainty scores fill the rest of the batch from the candidate pools.
+
+    Parameters
+    ----------
+    user_id : int
+        The ID in the User table.
+        None means that no videos are excluded for a specific user (e.g., for pre-assembling batches).
+
+    Returns
+    -------
+    list of Video
+        The video object is defined in the Video model.
+    """
+    # The gold standards are drawn from the in-memory registry (not sorted randomly in the database)
+    gold = draw_batch_gold_standards("video")
+    if gold is None:
+        # This means that there are not enough or no gold standard videos
+        return None
+    num_unlabeled = config.BATCH_SIZE - config.GOLD_STANDARD_IN_BATCH
+    terminal_labels = candidate_types["video"]["terminal"]
+    partial_labels = candidate_types["video"]["partial"]
+    # Exclude the videos labeled by the same user and the partially labeled ones reserved by other citizens
+    candidates = (
+        Video.query.join(VideoUncertainty, VideoUncertainty.video_id==Video.id)
+        .filter(
+            and_(
+                Video.label_state_admin.notin_(terminal_labels),
+                or_(
+                    Video.label_state==-1,
+                    and_(Video.label_state.in_(partial_labels), not_reserved(Video, get_current_time()))
+                ),
+                ~labeled_by_user(user_id)
+            )
+        )
+        .order_by(desc(VideoUncertainty.score))
+        .limit(config.UNCERTAINTY_CANDIDATE_FACTOR*num_unlabeled)
+    ).all()
+    idx = np.random.choice(len(candidates), min(num_unlabeled, len(candidates)), replace=False)
+    videos = [candidates[i] for i in idx]
+    if user_id is not None:
+        # Reserve the partially labeled videos for this user
+        reserved = reserve_items("video", [v.id for v in videos if v.label_state in partial_labels])
+        videos = [v for v in videos if v.label_state not in partial_labels or v.id in reserved]
+    num_short = num_unlabeled - len(videos)
+    if num_short > 0:
+        excluded = id_set_union(get_video_id_set_labeled_by_user(user_id), [v.id for v in videos])
+        num_partially_labeled = int(num_short*config.PARTIAL_LABEL_RATIO)
+        selected = draw_candidate_batch("video", num_partially_labeled, num_short, excluded, reserve=user_id is not None)
+        videos += selected["unlabeled"] + selected["partial"]
+    # Assemble the videos
+    videos = gold + videos
+    shuffle(videos)
+    return videos
+
+
+def get_video_query(labels, page_number, page_size, use_admin_label_state=False, cursor=None):
     """
     Get video query from the database by the type of labels.
 
@@ -139,10 +356,15 @@ def get_video_query(labels, page_number, page_size, use_admin_label_state=False)
         One is for the normal user (label_state).
         And another one is for the researcher (label_state_admin).
         See the definition of the "label_state_admin" column in the video table.
+    cursor : str
+        The cursor of the keyset pagination (see the keyset_paginate function in `keyset.py`).
+        If not None, the page starts after the cursor (an empty string means the first page),
+        ...and the page number is ignored.
 
     Returns
     -------
     The query object of the video table.
+    (a KeysetPage if the cursor is not None, see the keyset_paginate function in `keyset.py`)
     """
     page_size = config.MAX_PAGE_SIZE if page_size > config.MAX_PAGE_SIZE else page_size
     q = None
@@ -166,31 +388,28 @@ def get_video_query(labels, page_number, page_size, use_admin_label_state=False)
     elif type(labels) == str:
         # Aggregate citizen and researcher labels
         # Researcher labels override citizen labels
+        # The clauses match the partial indexes on the video table
         if labels == "pos":
             # Exclude gold standards and bad labels for normal request
-            q = Video.query.filter(and_(
-                Video.label_state_admin.notin_(m.gold_labels + m.bad_labels),
-                or_(
-                    Video.label_state_admin.in_(m.pos_labels),
-                    and_(
-                        Video.label_state_admin.notin_(m.pos_labels + m.neg_labels),
-                        Video.label_state.in_(m.pos_labels)))))
+            q = Video.query.filter(m.aggregated_label_clause(Video.label_state, Video.label_state_admin,
+                m.pos_labels, m.pos_labels + m.neg_labels, m.gold_labels + m.bad_labels))
         elif labels == "neg":
             # Exclude gold standards and bad labels for normal request
-            q = Video.query.filter(and_(
-                Video.label_state_admin.notin_(m.gold_labels + m.bad_labels),
-                or_(
-                    Video.label_state_admin.in_(m.neg_labels),
-                    and_(
-                        Video.label_state_admin.notin_(m.pos_labels + m.neg_labels),
-                        Video.label_state.in_(m.neg_labels)))))
-    q = q.order_by(desc(Video.label_update_time))
+            q = Video.query.filter(m.aggregated_label_clause(Video.label_state, Video.label_state_admin,
+                m.neg_labels, m.pos_labels + m.neg_labels, m.gold_labels + m.bad_labels))
+    if cursor is not None:
+        return keyset_paginate(q, Video, cursor, min(page_size, 100))
+    q = order_by_update_time(q, Video)
     if page_number is not None and page_size is not None:
-        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100)
+        # The total is cached, so only count the items when the cache does not have it
+        key = get_labels_total_key(labels, use_admin_label_state)
+        total = get_gallery_total("video", key, q)
+        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100, count=False)
+        q.total = total
     return q
 
 
-def get_pos_video_query_by_user_id(user_id, page_number, page_size, is_researcher):
+def get_pos_video_query_by_user_id(user_id, page_number, page_size, is_researcher, cursor=None):
     """
     Get video query (with positive labels) from the database by user id (exclude gold standards).
 
@@ -207,10 +426,15 @@ def get_pos_video_query_by_user_id(user_id, page_number, page_size, is_researche
         The page size that the front-end requested.
     is_researcher : bool
         If the client type is researcher or not.
+    cursor : str
+        The cursor of the keyset pagination (see the keyset_paginate function in `keyset.py`).
+        If not None, the page starts after the cursor (an empty string means the first page),
+        ...and the page number is ignored.
 
     Returns
     -------
     The query object of the video table.
+    (a KeysetPage if the cursor is not None, see the keyset_paginate function in `keyset.py`)
     """
     page_size = config.MAX_PAGE_SIZE if page_size > config.MAX_PAGE_SIZE else page_size
     if is_researcher: # researcher
@@ -223,10 +447,15 @@ def get_pos_video_query_by_user_id(user_id, page_number, page_size, is_researche
         .join(q, Video.id == q.c.video_id)
         .distinct()
         .filter(Video.label_state_admin != 0b101111)
-        .order_by(desc(Video.label_update_time))
     )
+    if cursor is not None:
+        return keyset_paginate(q, Video, cursor, min(page_size, 100))
+    q = order_by_update_time(q, Video)
     if page_number is not None and page_size is not None:
-        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100)
+        # The total is cached, so only count the items when the cache does not have it
+        total = get_gallery_total("video", get_user_total_key(user_id, is_researcher), q)
+        q = q.paginate(page=page_number, per_page=page_size, max_per_page=100, count=False)
+        q.total = total
     return q
 
 
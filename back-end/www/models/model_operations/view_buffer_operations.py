@@ -0,0 +1,130 @@
+"""Functions to buffer the views of videos and segmentation masks in memory and write them in bulk."""
+
+import atexit
+import threading
+from sqlalchemy import insert
+from models.model import db
+from models.model import View
+from models.model import SegmentationView
+from models.model import ViewCount
+from models.model import SegmentationViewCount
+from models.model_operations.view_count_operations import increment_view_counts
+from util.util import get_current_time
+from app.app import app
+from config.config import config
+
+
+# The types of views, which map to the model, the column of the viewed item, and the model of the counters
+view_types = {
+    "video": (View, "video_id", ViewCount),
+    "segmentation": (SegmentationView, "segmentation_id", SegmentationViewCount)
+}
+
+# The views that are not written to the database yet in this worker process (keyed by view type)
+# Each view is a dictionary of the column values of a row
+view_buffers = {view_type: [] for view_type in view_types}
+view_buffers_lock = threading.Lock()
+
+# The background thread that flushes the buffers, and the event to wake it up
+view_flush_worker = {"thread": None}
+view_flush_worker_lock = threading.Lock()
+flush_event = threading.Event()
+
+
+def record_views(view_type, connection_id, item_ids, query_type):
+    """
+    Record the views of items without writing them to the database in the request.
+
+    The views are buffered in memory and written in bulk by a background thread
+    ...when the buffer has config.VIEW_BUFFER_SIZE views, or every config.VIEW_FLUSH_INTERVAL seconds.
+    If config.VIEW_BUFFER_ENABLED is False, the views are written immediately (still with one INSERT).
+
+    Parameters
+    ----------
+    view_type : str
+        The type of view ("video" or "segmentation").
+    connection_id : int
+        The connection ID in the Connection table.
+    item_ids : list of int
+        The IDs of the viewed videos or segmentation masks.
+    query_type : int
+        The type of query that the front-end used to get the items (see the View table).
+    """
+    if len(item_ids) == 0: return
+    _, id_column, _ = view_types[view_type]
+    t = get_current_time()
+    rows = [{"connection_id": connection_id, id_column: i, "query_type": query_type, "time": t} for i in item_ids]
+    if not config.VIEW_BUFFER_ENABLED:
+        write_views(view_type, rows)
+        return
+    start_view_flush_worker()
+    with view_buffers_lock:
+        view_buffers[view_type].extend(rows)
+        num_buffered = sum(len(b) for b in view_buffers.values())
+    if num_buffered >= config.VIEW_BUFFER_SIZE:
+        flush_event.set()
+
+
+def write_views(view_type, rows):
+    """
+    Write views to the database and commit.
+
+    If config.VIEW_RECORDING_MODE is "aggregated", add the views to the counters (see the ViewCount table).
+    Otherwise, add a row for each view with one multi-row INSERT.
+    """
+    model, id_column, count_model = view_types[view_type]
+    if config.VIEW_RECORDING_MODE == "aggregated":
+        increment_view_counts(count_model, id_column, rows)
+        return
+    db.session.execute(insert(model), rows)
+    db.session.commit()
+    app.logger.info("Create %d views in the %s table" % (len(rows), model.__tablename__))
+
+
+def flush_views():
+    """Write all the buffered views of this worker process to the database."""
+    with view_buffers_lock:
+        buffers = {view_type: view_buffers[view_type] for view_type in view_types}
+        for view_type in view_types:
+            view_buffers[view_type] = []
+    for view_type, rows in buffers.items():
+        if len(rows) == 0: continue
+        try:
+            write_views(view_type, rows)
+        except Exception as ex:
+            # The views are only for analytics, so drop them instead of retrying forever
+            db.session.rollback()
+            app.logger.error("Error when writing %d buffered %s views: %r" % (len(rows), view_type, ex))
+
+
+def start_view_flush_worker():
+    """Start the background thread that flushes the view buffers (if it is not running yet)."""
+    t = view_flush_worker["thread"]
+    if t is not None and t.is_alive(): return
+    with view_flush_worker_lock:
+        t = view_flush_worker["thread"]
+        if t is not None and t.is_alive(): return
+        t = threading.Thread(target=run_view_flush_worker, name="view-flush", daemon=True)
+        t.start()
+        view_flush_worker["thread"] = t
+    app.logger.info("Start the view flush worker")
+
+
+def run_view_flush_worker():
+    """Flush the view buffers when they are full, or every config.VIEW_FLUSH_INTERVAL seconds."""
+    with app.app_context():
+        while True:
+            flush_event.wait(timeout=config.VIEW_FLUSH_INTERVAL)
+            flush_event.clear()
+            try:
+                flush_views()
+            finally:
+                db.session.remove()
+
+
+@atexit.register
+def flush_views_at_exit():
+    """Write the buffered views when the worker process exits normally."""
+    if all(len(b) == 0 for b in view_buffers.values()): return
+    with app.app_context():
+        flush_views()
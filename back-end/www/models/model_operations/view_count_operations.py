@@ -0,0 +1,99 @@
+"""Functions to operate the view count tables (for the aggregated view recording mode)."""
+
+from collections import Counter
+from sqlalchemy import select
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from models.model import db
+from app.app import app
+
+
+# The number of seconds in a day (the counters are kept per day in UTC)
+DAY_SECONDS = 86400
+
+
+def to_day(t):
+    """Get the epochtime (in seconds) at the start of the day (in UTC) of the epochtime."""
+    return t - t % DAY_SECONDS
+
+
+def upsert_increment(count_model, id_column, counts):
+    """
+    Add to the view counters with one multi-row INSERT ... ON CONFLICT DO UPDATE (without committing).
+
+    Parameters
+    ----------
+    count_model : ViewCount or SegmentationViewCount
+        The model of the counter table.
+    id_column : str
+        The column of the viewed item ("video_id" or "segmentation_id").
+    counts : dict
+        The number of views keyed by (item_id, query_type, day).
+    """
+    if len(counts) == 0: return
+    # Sort the keys so that concurrent upserts lock the rows in the same order
+    rows = [{id_column: k[0], "query_type": k[1], "day": k[2], "count": counts[k]} for k in sorted(counts)]
+    stmt = insert(count_model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[id_column, "query_type", "day"],
+        set_={"count": count_model.count + stmt.excluded.count}
+    )
+    db.session.execute(stmt)
+
+
+def increment_view_counts(count_model, id_column, rows):
+    """
+    Add views to the counters and commit.
+
+    Parameters
+    ----------
+    count_model : ViewCount or SegmentationViewCount
+        The model of the counter table.
+    id_column : str
+        The column of the viewed item ("video_id" or "segmentation_id").
+    rows : list of dict
+        The views, with the same keys as the columns in the View or SegmentationView table.
+    """
+    # Each counter can only be updated once in an INSERT statement, so count the views first
+    counts = Counter((r[id_column], r["query_type"], to_day(r["time"])) for r in rows)
+    upsert_increment(count_model, id_column, counts)
+    db.session.commit()
+    app.logger.info("Add %d views to %d counters in the %s table" % (len(rows), len(counts), count_model.__tablename__))
+
+
+def rollup_views(model, count_model, id_column, before_time):
+    """
+    Compact the views that were added before a time into the counters, and remove them (in one transaction).
+
+    Parameters
+    ----------
+    model : View or SegmentationView
+        The model of the view table.
+    count_model : ViewCount or SegmentationViewCount
+        The model of the counter table.
+    id_column : str
+        The column of the viewed item ("video_id" or "segmentation_id").
+    before_time : int
+        The epochtime (in seconds), where only the views before this time are compacted.
+
+    Returns
+    -------
+    int
+        The number of views that are compacted.
+    """
+    item_id = getattr(model, id_column)
+    day = model.time - model.time % DAY_SECONDS
+    q = (select(item_id, model.query_type, day, func.count())
+        .where(model.time < before_time)
+        .group_by(item_id, model.query_type, day))
+    stmt = insert(count_model).from_select([id_column, "query_type", "day", "count"], q)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[id_column, "query_type", "day"],
+        set_={"count": count_model.count + stmt.excluded.count}
+    )
+    db.session.execute(stmt)
+    num_removed = db.session.execute(delete(model).where(model.time < before_time)).rowcount
+    db.session.commit()
+    app.logger.info("Compact %d views in the %s table" % (num_removed, model.__tablename__))
+    return num_removed
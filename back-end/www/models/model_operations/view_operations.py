@@ -2,22 +2,10 @@
 
 from models.model import db
 from models.model import View
+from models.model_operations.view_buffer_operations import record_views
 from app.app import app
 
 
-def create_view(connection_id, video_id, query_type):
-    """Create a view."""
-    view = View(
-        connection_id=connection_id,
-        video_id=video_id,
-        query_type=query_type
-    )
-    db.session.add(view)
-    db.session.commit()
-    app.logger.info("Create view: %r" % view)
-    return view
-
-
 def remove_view(view_id):
     """Remove a view."""
     view = View.query.filter_by(id=view_id).first()
@@ -43,8 +31,10 @@ def create_views_from_video_batch(videos, user_jwt, query_type=None):
         See the view table for definition.
     """
     if query_type is None: return
-    for v in videos:
-        # Connection_id -1 means that the connection is from other app, not the current app.
-        # If connections comes from another app, we do not want to add them to the view table.
-        if user_jwt is not None and user_jwt["connection_id"] != -1:
-            create_view(user_jwt["connection_id"], v.id, query_type)
+    # Connection_id -1 means that the connection is from other app, not the current app.
+    # If connections comes from another app, we do not want to add them to the view table.
+    if user_jwt is not None and user_jwt["connection_id"] != -1:
+        # If config.VIEW_BUFFER_ENABLED is True, the views are buffered and written in bulk later,
+        # ...otherwise they are written now with one INSERT and a commit, which expires the loaded objects
+        # ...(so the caller should serialize the videos before recording the views)
+        record_views("video", user_jwt["connection_id"], [v.id for v in videos], query_type)
@@ -0,0 +1,30 @@
+from models.model_operations.projection_operations import project_new_events
+from models.model_operations.projection_operations import rebuild_label_states
+from models.model_operations.projection_operations import projection_types
+import sys
+from app.app import app
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] in projection_types and argv[2] in ["incremental", "rebuild", "audit"]:
+        data_type, mode = argv[1], argv[2]
+        with app.app_context():
+            if mode == "incremental":
+                n = project_new_events(data_type)
+                print("Repair the label states of %d %s items from the new label events" % (n, data_type))
+            elif mode == "rebuild":
+                n = rebuild_label_states(data_type, apply=True)
+                print("Rebuild the label states of %d %s items from all label events" % (n, data_type))
+            else:
+                n = rebuild_label_states(data_type, apply=False)
+                print("Found %d %s items whose label states differ from the label events" % (n, data_type))
+    else:
+        print("Usage: python project_label_states.py [video|segmentation] [incremental|rebuild|audit]")
+        print("incremental => replay the items with label events after the checkpoint and repair their label states")
+        print("rebuild => replay all label events and rewrite the label states that differ")
+        print("audit => replay all label events and count the label states that differ (without writing)")
+        print("Example: python project_label_states.py video audit")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,28 @@
+from models.model_operations.view_count_operations import rollup_views
+from models.model_operations.view_count_operations import DAY_SECONDS
+from models.model_operations.view_buffer_operations import view_types
+import sys
+from app.app import app
+from util.util import get_current_time
+from config.config import config
+
+
+def main(argv):
+    retention_days = config.VIEW_RAW_RETENTION_DAYS
+    if len(argv) > 2:
+        retention_days = int(argv[2])
+    if len(argv) > 1 and argv[1] == "confirm" and retention_days is not None:
+        before_time = get_current_time() - retention_days*DAY_SECONDS
+        with app.app_context():
+            for view_type, (model, id_column, count_model) in view_types.items():
+                n = rollup_views(model, count_model, id_column, before_time)
+                print("Compact %d %s views older than %d days" % (n, view_type, retention_days))
+    else:
+        print("Usage: python rollup_views.py confirm [retention_days]")
+        print("Compact the views older than the retention days into the view count tables (and delete the raw views)")
+        print("The default retention days is config.VIEW_RAW_RETENTION_DAYS (currently %r, and None means keeping all views)" % config.VIEW_RAW_RETENTION_DAYS)
+        print("Example: python rollup_views.py confirm 90")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,85 @@
+"""
+Benchmark the sampling modes for the admin researcher batches (ADMIN_SAMPLING_MODE in config.py).
+
+This script fills the testing database with fake videos, so never run it with other databases.
+All tables in the testing database are dropped at the end.
+
+Usage: python admin_sampling_benchmark.py [number_of_rows ...]
+Example: python admin_sampling_benchmark.py 100000 1000000
+"""
+
+# Bring other packages onto the path
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import numpy as np
+from flask import Flask
+from sqlalchemy import insert
+from sqlalchemy import text
+from models.model import db
+from models.model import Video
+from models.model import User
+from models.model_operations.video_operations import query_video_batch
+from models.model_operations import sampling_operations
+from util.cache import cache_clear
+from config.config import config
+
+
+def create_videos(num_rows, chunk_size=50000):
+    """Insert fake videos, where about 20% of them still need researcher labels."""
+    admin_label_states = np.random.choice([-1, 0b10111, 0b10000, -2], size=num_rows, p=[0.2, 0.4, 0.3, 0.1])
+    for i in range(0, num_rows, chunk_size):
+        rows = [{
+            "file_name": "benchmark_%d.mp4" % j,
+            "start_time": j,
+            "url_part": "benchmark_%d" % j,
+            "label_state_admin": int(admin_label_states[j])
+        } for j in range(i, min(i + chunk_size, num_rows))]
+        db.session.execute(insert(Video), rows)
+    db.session.commit()
+    db.session.execute(text("ANALYZE video"))
+    db.session.commit()
+
+
+def time_sampling(mode, user_id, num_runs):
+    """Return the median time (in milliseconds) to query an admin batch with the sampling mode."""
+    config.ADMIN_SAMPLING_MODE = mode
+    times = []
+    for _ in range(num_runs):
+        t = time.perf_counter()
+        videos = query_video_batch(user_id, use_admin_label_state=True)
+        times.append((time.perf_counter() - t) * 1000)
+        assert len(videos) == config.BATCH_SIZE
+        db.session.rollback()
+    return np.median(times)
+
+
+def main(argv):
+    row_counts = [int(n) for n in argv[1:]] if len(argv) > 1 else [100000, 1000000]
+    app = Flask(__name__)
+    app.config.from_object("config.config.TestingConfig")
+    db.init_app(app)
+    admin_sampling_mode = config.ADMIN_SAMPLING_MODE
+    with app.app_context():
+        try:
+            for num_rows in row_counts:
+                db.drop_all()
+                db.create_all()
+                cache_clear(sampling_operations.table_row_estimate_cache)
+                create_videos(num_rows)
+                user = User(client_id="benchmark", client_type=0)
+                db.session.add(user)
+                db.session.commit()
+                for mode in ["random", "tablesample"]:
+                    t = time_sampling(mode, user.id, 20)
+                    print("rows=%d mode=%s median=%.1fms" % (num_rows, mode, t))
+        finally:
+            config.ADMIN_SAMPLING_MODE = admin_sampling_mode
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
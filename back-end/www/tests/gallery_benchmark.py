@@ -0,0 +1,136 @@
+"""
+Check the query plans of the gallery queries with a realistic number of rows.
+
+Unlike gallery_tests.py, sequential scans are not disabled, so this shows the plans that the database really picks.
+This script fills the testing database with fake videos and segmentation masks, so never run it with other databases.
+All tables in the testing database are dropped at the end.
+
+Usage: python gallery_benchmark.py [number_of_rows ...]
+Example: python gallery_benchmark.py 50000 500000
+"""
+
+# Bring other packages onto the path
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import numpy as np
+from flask import Flask
+from sqlalchemy import insert
+from sqlalchemy import text
+from models.model import db
+from models.model import Video
+from models.model import SegmentationMask
+from models.model_operations.video_operations import get_video_query
+from models.model_operations.segmentationMask_operations import get_segmentation_query
+
+
+def random_states(choices, p, num_rows):
+    return np.random.choice(choices, size=num_rows, p=p).tolist()
+
+
+def create_videos(num_rows, chunk_size=50000):
+    """Insert fake videos, where most of them are not labeled or labeled as negative."""
+    label_state = random_states([-1, 0b10111, 0b10000, 0b101, 0b11], [0.3, 0.2, 0.3, 0.1, 0.1], num_rows)
+    label_state_admin = random_states([-1, 0b10111, 0b10000, 0b101111, -2], [0.6, 0.1, 0.25, 0.01, 0.04], num_rows)
+    label_update_time = np.random.randint(0, 10**8, size=num_rows).tolist()
+    for i in range(0, num_rows, chunk_size):
+        rows = [{
+            "file_name": "benchmark_%d.mp4" % j,
+            "start_time": j,
+            "url_part": "benchmark_%d" % j,
+            "label_state": label_state[j],
+            "label_state_admin": label_state_admin[j],
+            "label_update_time": label_update_time[j]
+        } for j in range(i, min(i + chunk_size, num_rows))]
+        db.session.execute(insert(Video), rows)
+    db.session.commit()
+    db.session.execute(text("ANALYZE video"))
+    db.session.commit()
+
+
+def create_segmentations(num_rows, chunk_size=50000):
+    """Insert fake segmentation masks of one video, where most of them are not labeled or labeled as negative."""
+    video = Video(file_name="benchmark.mp4", start_time=0, end_time=1, url_part="benchmark", view_id=0, camera_id=0)
+    db.session.add(video)
+    db.session.commit()
+    label_state = random_states([-1, 3, 5, 0, 7], [0.3, 0.2, 0.3, 0.1, 0.1], num_rows)
+    label_state_admin = random_states([-1, 4, 12, 16, -2], [0.6, 0.1, 0.25, 0.01, 0.04], num_rows)
+    label_update_time = np.random.randint(0, 10**8, size=num_rows).tolist()
+    for i in range(0, num_rows, chunk_size):
+        rows = [{
+            "mask_file_name": "m%d.png" % j,
+            "image_file_name": "i%d.png" % j,
+            "file_path": "p%d" % j,
+            "x_bbox": 0,
+            "y_bbox": 0,
+            "w_bbox": 10,
+            "h_bbox": 10,
+            "w_image": 100,
+            "h_image": 100,
+            "video_id": video.id,
+            "label_state": label_state[j],
+            "label_state_admin": label_state_admin[j],
+            "label_update_time": label_update_time[j]
+        } for j in range(i, min(i + chunk_size, num_rows))]
+        db.session.execute(insert(SegmentationMask), rows)
+    db.session.commit()
+    db.session.execute(text("ANALYZE segmentation_mask"))
+    db.session.commit()
+
+
+def explain(q):
+    """Return the query plan of the first page of a gallery query, and the time (in milliseconds) to run it."""
+    sql = q.limit(16).statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+    t = time.perf_counter()
+    plan = "\n".join(db.session.execute(text("EXPLAIN ANALYZE %s" % sql)).scalars().all())
+    t = (time.perf_counter() - t) * 1000
+    db.session.rollback()
+    return plan, t
+
+
+def check_plans(num_rows):
+    """Print if each gallery query uses its partial index, and return the number of queries that do not."""
+    queries = [
+        ("video pos", lambda: get_video_query("pos", None, 16), "ix_video_pos_label_update_time"),
+        ("video neg", lambda: get_video_query("neg", None, 16), "ix_video_neg_label_update_time"),
+        ("video label state", lambda: get_video_query([0b101], None, 16), "ix_video_label_state_label_update_time"),
+        ("segmentation pos", lambda: get_segmentation_query("pos", None, 16), "ix_segmentation_mask_pos_label_update_time"),
+        ("segmentation neg", lambda: get_segmentation_query("neg", None, 16), "ix_segmentation_mask_neg_label_update_time")
+    ]
+    num_failed = 0
+    for name, get_query, index_name in queries:
+        plan, t = explain(get_query())
+        uses_index = index_name in plan
+        print("rows=%d query=%s index=%s uses_index=%s time=%.1fms" % (num_rows, name, index_name, uses_index, t))
+        if not uses_index:
+            num_failed += 1
+            print(plan)
+    return num_failed
+
+
+def main(argv):
+    row_counts = [int(n) for n in argv[1:]] if len(argv) > 1 else [50000]
+    app = Flask(__name__)
+    app.config.from_object("config.config.TestingConfig")
+    db.init_app(app)
+    num_failed = 0
+    with app.app_context():
+        try:
+            for num_rows in row_counts:
+                np.random.seed(0)
+                db.drop_all()
+                db.create_all()
+                create_videos(num_rows)
+                create_segmentations(num_rows)
+                num_failed += check_plans(num_rows)
+        finally:
+            db.session.remove()
+            db.drop_all()
+    if num_failed > 0:
+        sys.exit("%d gallery queries do not use their indexes" % num_failed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
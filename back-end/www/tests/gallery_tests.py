@@ -0,0 +1,88 @@
+from basic_tests import BasicTest
+from models.model_operations import video_operations
+from models.model_operations.video_operations import get_video_query
+from models.model_operations.segmentationMask_operations import get_segmentation_query
+from models.model import db
+from models.model import Video
+from models.model import SegmentationMask
+from sqlalchemy import insert
+from sqlalchemy import text
+import numpy as np
+import unittest
+
+
+class GalleryTest(BasicTest):
+    """Test case for the gallery queries."""
+    num_rows = 1000
+
+    def setUp(self):
+        db.create_all()
+
+    def explain(self, q):
+        """
+        Return the query plan of the first page of a gallery query.
+
+        The table is small in the tests, so sequential scans are disabled to check which indexes the query can use.
+        See gallery_benchmark.py for the plans with a realistic number of rows (without disabling sequential scans).
+        """
+        sql = q.limit(16).statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = "\n".join(db.session.execute(text("EXPLAIN %s" % sql)).scalars().all())
+        db.session.rollback()
+        return plan
+
+    def random_states(self, choices, p):
+        return np.random.choice(choices, size=self.num_rows, p=p).tolist()
+
+    def test_video_gallery_queries_use_indexes(self):
+        np.random.seed(0)
+        label_state = self.random_states([-1, 0b10111, 0b10000, 0b101, 0b11], [0.3, 0.2, 0.3, 0.1, 0.1])
+        label_state_admin = self.random_states([-1, 0b10111, 0b10000, 0b101111, -2], [0.6, 0.1, 0.25, 0.01, 0.04])
+        label_update_time = np.random.randint(0, 10**8, size=self.num_rows).tolist()
+        rows = [{
+            "file_name": "v%d.mp4" % i,
+            "start_time": i,
+            "url_part": "v%d" % i,
+            "label_state": label_state[i],
+            "label_state_admin": label_state_admin[i],
+            "label_update_time": label_update_time[i]
+        } for i in range(self.num_rows)]
+        db.session.execute(insert(Video), rows)
+        db.session.commit()
+        db.session.execute(text("ANALYZE video"))
+        db.session.commit()
+        assert "ix_video_pos_label_update_time" in self.explain(get_video_query("pos", None, 16))
+        assert "ix_video_neg_label_update_time" in self.explain(get_video_query("neg", None, 16))
+        assert "ix_video_label_state_label_update_time" in self.explain(get_video_query([0b101], None, 16))
+
+    def test_segmentation_gallery_queries_use_indexes(self):
+        np.random.seed(0)
+        video = video_operations.create_video("v.mp4", 0, 1, "v", 0, 0)
+        label_state = self.random_states([-1, 3, 5, 0, 7], [0.3, 0.2, 0.3, 0.1, 0.1])
+        label_state_admin = self.random_states([-1, 4, 12, 16, -2], [0.6, 0.1, 0.25, 0.01, 0.04])
+        label_update_time = np.random.randint(0, 10**8, size=self.num_rows).tolist()
+        rows = [{
+            "mask_file_name": "m%d.png" % i,
+            "image_file_name": "i%d.png" % i,
+            "file_path": "p%d" % i,
+            "x_bbox": 0,
+            "y_bbox": 0,
+            "w_bbox": 10,
+            "h_bbox": 10,
+            "w_image": 100,
+            "h_image": 100,
+            "video_id": video.id,
+            "label_state": label_state[i],
+            "label_state_admin": label_state_admin[i],
+            "label_update_time": label_update_time[i]
+        } for i in range(self.num_rows)]
+        db.session.execute(insert(SegmentationMask), rows)
+        db.session.commit()
+        db.session.execute(text("ANALYZE segmentation_mask"))
+        db.session.commit()
+        assert "ix_segmentation_mask_pos_label_update_time" in self.explain(get_segmentation_query("pos", None, 16))
+        assert "ix_segmentation_mask_neg_label_update_time" in self.explain(get_segmentation_query("neg", None, 16))
+
+
+if __name__ == "__main__":
+    unittest.main()
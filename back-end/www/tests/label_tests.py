@@ -0,0 +1,300 @@
+from basic_tests import BasicTest
+from controllers import api_v1_controller
+from controllers.api_v1_controller import create_user_token
+from controllers.api_v1_controller import encode_video_jwt
+from models.model_operations import user_operations
+from models.model_operations import video_operations
+from models.model_operations import batch_operations
+from models.model_operations import sampling_operations
+from models.model_operations import replay_operations
+from models.model_operations import connection_operations
+from models.model_operations import gallery_total_operations
+from models.model_operations.label_operations import update_labels
+from models.model_operations.projection_operations import rebuild_label_states
+from models.model_operations.relabel_operations import create_relabel_job
+from models.model_operations.relabel_operations import run_relabel_job
+from models.model_operations.relabel_operations import retry_relabel_job
+from models.model import db
+from models.model import Label
+from models.model import Video
+from models.model import User
+from models.model import Batch
+from models.model import RelabelJob
+from sqlalchemy import event
+from util.util import decode_jwt
+from util.util import get_current_time
+from util.cache import cache_clear
+from config.config import config
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unittest
+
+
+class LabelTest(BasicTest):
+    """Test case for video labels."""
+    def create_app(self):
+        app = super().create_app()
+        app.register_blueprint(api_v1_controller.bp, url_prefix="/api/v1/")
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.batch_queue_enabled = config.BATCH_QUEUE_ENABLED
+        self.admin_relabel_chunk_size = config.ADMIN_RELABEL_CHUNK_SIZE
+        self.admin_relabel_stale_timeout = config.ADMIN_RELABEL_STALE_TIMEOUT
+        config.BATCH_QUEUE_ENABLED = False
+        # The caches of this process may have IDs from other tests
+        sampling_operations.reset_candidate_pools("video")
+        sampling_operations.invalidate_gold_standards("video")
+        cache_clear(video_operations.labeled_video_id_cache)
+        cache_clear(connection_operations.recent_connection_cache)
+        gallery_total_operations.invalidate_gallery_totals("video")
+        self.gold_pos = []
+        self.gold_neg = []
+        self.unlabeled = []
+        for i in range(16):
+            v = video_operations.create_video("v%d.mp4" % i, i, i + 1, "v%d" % i, 0, 0)
+            if i < 2:
+                v.label_state_admin = 0b101111 # gold standard positive
+                self.gold_pos.append(v.id)
+            elif i < 4:
+                v.label_state_admin = 0b100000 # gold standard negative
+                self.gold_neg.append(v.id)
+            else:
+                self.unlabeled.append(v.id)
+        db.session.commit()
+
+    def tearDown(self):
+        config.BATCH_QUEUE_ENABLED = self.batch_queue_enabled
+        config.ADMIN_RELABEL_CHUNK_SIZE = self.admin_relabel_chunk_size
+        config.ADMIN_RELABEL_STALE_TIMEOUT = self.admin_relabel_stale_timeout
+        super().tearDown()
+
+    def count_commits(self, f):
+        """Run the function and return the number of transactions that it committed."""
+        commits = []
+        def commit(conn):
+            commits.append(conn)
+        event.listen(db.engine, "commit", commit)
+        try:
+            f()
+        finally:
+            event.remove(db.engine, "commit", commit)
+        return len(commits)
+
+    def create_labeled_batch(self):
+        """Create a user and a batch, and return the request to send the batch with labels that pass the gold standards."""
+        user = user_operations.create_user("123")
+        user_token, _ = create_user_token(user)
+        connection_id = decode_jwt(user_token, config.JWT_PRIVATE_KEY)["connection_id"]
+        batch = batch_operations.create_batch(4, 12, connection_id)
+        video_ids = self.gold_pos + self.gold_neg + self.unlabeled
+        # Set the issued time to the past so that the token is already valid
+        video_token = encode_video_jwt(video_id_list=video_ids, batch_id=batch.id, user_id=user.id, iat=get_current_time()-3600)
+        data = [{"video_id": i, "label": 0 if i in self.gold_neg else 1} for i in video_ids]
+        return user, batch, {"data": data, "user_token": user_token, "video_token": video_token}
+
+    def test_send_batch_commit_count(self):
+        user, batch, request_json = self.create_labeled_batch()
+        video_ids = [v["video_id"] for v in request_json["data"]]
+        def send_batch():
+            response = self.client.post("/api/v1/send_batch", json=request_json)
+            assert response.status_code == 200
+            # The new scores are returned from the database when adding the scores
+            assert response.json["data"]["score"] == {"batch": 12, "user": 12, "raw": 12}
+        # All labels and video label states need to be written in one transaction
+        assert self.count_commits(send_batch) == 1
+        db.session.expire_all()
+        user = User.query.filter(User.id==user.id).first()
+        assert (user.score, user.raw_score) == (12, 12)
+        # The batch keeps the user scores before adding this batch
+        batch = Batch.query.filter(Batch.id==batch.id).first()
+        assert (batch.score, batch.user_score, batch.user_raw_score) == (12, 0, 0)
+        labels = Label.query.filter(Label.batch_id==batch.id).all()
+        assert len(labels) == len(video_ids)
+        assert len(set(label.time for label in labels)) == 1
+
+    def test_labeled_video_ids_include_labels_of_other_processes(self):
+        user, batch, request_json = self.create_labeled_batch()
+        video_ids = [v["video_id"] for v in request_json["data"]]
+        other = video_operations.create_video("other.mp4", 100, 101, "other", 0, 0)
+        # Load the labeled videos of the user into the cache of this process
+        assert len(video_operations.get_video_id_set_labeled_by_user(user.id)) == 0
+        # Another worker process adds a label of the user, and then this process adds labels with larger IDs
+        db.session.add(Label(video_id=other.id, label=1, user_id=user.id))
+        db.session.commit()
+        response = self.client.post("/api/v1/send_batch", json=request_json)
+        assert response.status_code == 200
+        labeled = video_operations.get_video_id_set_labeled_by_user(user.id).tolist()
+        assert sorted(labeled) == sorted(video_ids + [other.id])
+
+    def test_replayed_batch_is_not_processed_again(self):
+        user, batch, request_json = self.create_labeled_batch()
+        expected_score = {"batch": 12, "user": 12, "raw": 12}
+        for i in range(3):
+            if i == 2:
+                # Replays that are not remembered in this process are detected by the batch table
+                cache_clear(replay_operations.consumed_token_cache)
+            response = self.client.post("/api/v1/send_batch", json=request_json)
+            assert response.status_code == 200
+            assert response.json["data"]["score"] == expected_score
+        db.session.expire_all()
+        assert Label.query.filter(Label.batch_id==batch.id).count() == len(request_json["data"])
+        user = User.query.filter(User.id==user.id).first()
+        assert (user.score, user.raw_score) == (12, 12)
+
+    def test_concurrent_labels_do_not_lose_state_transitions(self):
+        num_users = 4
+        user_ids = [user_operations.create_user("user%d" % i).id for i in range(num_users)]
+        data = [{"video_id": i, "label": 1} for i in self.unlabeled]
+        barrier = threading.Barrier(num_users)
+        def send_labels(user_id):
+            with self.app.app_context():
+                try:
+                    # Start all submissions at the same time to make them race on the same videos
+                    barrier.wait()
+                    update_labels(data, user_id, None, None, 3)
+                finally:
+                    db.session.remove()
+        with ThreadPoolExecutor(max_workers=num_users) as executor:
+            for f in [executor.submit(send_labels, user_id) for user_id in user_ids]:
+                f.result()
+        # Two positive labels from citizens move each video to the strong positive state (a terminal state)
+        # A lost update would leave some videos at the maybe positive state
+        db.session.expire_all()
+        videos = Video.query.filter(Video.id.in_(self.unlabeled)).all()
+        assert all(v.label_state == 0b10111 for v in videos), [v.label_state for v in videos]
+        assert Label.query.count() == num_users * len(self.unlabeled)
+        # Replaying the labels in version order gives the same states as the concurrent transitions
+        assert rebuild_label_states("video", apply=False) == 0
+
+    def test_rebuild_label_states_from_labels(self):
+        user_ids = [user_operations.create_user("user%d" % i).id for i in range(2)]
+        update_labels([{"video_id": i, "label": 1} for i in self.unlabeled], user_ids[0], None, None, 3)
+        update_labels([{"video_id": i, "label": 0} for i in self.unlabeled], user_ids[1], None, None, 3)
+        update_labels([{"video_id": self.unlabeled[0], "label": 1}], user_ids[1], None, None, 0)
+        # Corrupt the label states, which are only a projection of the labels
+        Video.query.filter(Video.id.in_(self.unlabeled)).update({"label_state": -1}, synchronize_session=False)
+        db.session.commit()
+        assert rebuild_label_states("video", apply=False) == len(self.unlabeled)
+        assert rebuild_label_states("video") == len(self.unlabeled)
+        db.session.expire_all()
+        videos = Video.query.filter(Video.id.in_(self.unlabeled)).order_by(Video.id).all()
+        assert all(v.label_state == 0b11 for v in videos)
+        assert videos[0].label_state_admin == 0b10111
+        assert rebuild_label_states("video", apply=False) == 0
+
+    def test_relabel_job_commits_each_chunk_with_progress(self):
+        user = user_operations.create_user("admin")
+        data = [{"video_id": i, "label": 1} for i in self.unlabeled]
+        # Jobs with videos that do not exist are rejected when they are created
+        with self.assertRaises(Exception):
+            create_relabel_job("video", user.id, data + [{"video_id": max(self.unlabeled) + 1000, "label": 1}])
+        assert RelabelJob.query.count() == 0
+        # The last label has a video that is deleted after the job is created, so the job fails in the last chunk
+        video = video_operations.create_video("deleted.mp4", 0, 1, "deleted", 0, 0)
+        data.append({"video_id": video.id, "label": 1})
+        config.ADMIN_RELABEL_CHUNK_SIZE = 5
+        job = create_relabel_job("video", user.id, data)
+        db.session.delete(video)
+        db.session.commit()
+        num_commits = self.count_commits(lambda: run_relabel_job(job.id))
+        # One commit to start the job, one for each of the two full chunks, and one to mark the job as failed
+        assert num_commits == 4
+        db.session.expire_all()
+        job = RelabelJob.query.filter(RelabelJob.id==job.id).first()
+        assert (job.status, job.num_total, job.num_done) == ("failed", 13, 10)
+        assert Label.query.count() == 10
+        # Retrying the job with fixed labels continues from the failed chunk
+        job = retry_relabel_job(job.id, data[10:-1] + [{"video_id": self.gold_pos[0], "label": 1}])
+        assert (job.status, job.num_total, job.num_done) == ("queued", 13, 10)
+        run_relabel_job(job.id)
+        db.session.expire_all()
+        job = RelabelJob.query.filter(RelabelJob.id==job.id).first()
+        assert (job.status, job.num_done) == ("done", 13)
+        assert Label.query.count() == 13
+        videos = Video.query.filter(Video.id.in_(self.unlabeled)).all()
+        assert all(v.label_state_admin == 0b10111 for v in videos)
+        # Only failed jobs can be retried
+        with self.assertRaises(Exception):
+            retry_relabel_job(job.id)
+
+    def test_retry_takes_over_stale_running_job(self):
+        user = user_operations.create_user("admin")
+        data = [{"video_id": i, "label": 1} for i in self.unlabeled]
+        job = create_relabel_job("video", user.id, data)
+        # The worker process was restarted after the first chunk, so the job is left running
+        update_labels(data[:5], user.id, None, None, 0)
+        now = get_current_time()
+        config.ADMIN_RELABEL_STALE_TIMEOUT = 600
+        RelabelJob.query.filter(RelabelJob.id==job.id).update({"status": "running", "num_done": 5, "update_time": now - 60})
+        db.session.commit()
+        # A running job that still updates its progress cannot be retried
+        with self.assertRaises(Exception):
+            retry_relabel_job(job.id)
+        RelabelJob.query.filter(RelabelJob.id==job.id).update({"update_time": now - 601})
+        db.session.commit()
+        # The retry takes over the stale job, which continues from the labels that were done
+        job = retry_relabel_job(job.id)
+        assert (job.status, job.num_done) == ("queued", 5)
+        run_relabel_job(job.id)
+        db.session.expire_all()
+        job = RelabelJob.query.filter(RelabelJob.id==job.id).first()
+        assert (job.status, job.num_done) == ("done", len(data))
+        assert Label.query.count() == len(data)
+        # The new labels also have to be known videos
+        job.status = "failed"
+        db.session.commit()
+        with self.assertRaises(Exception):
+            retry_relabel_job(job.id, [{"video_id": max(self.unlabeled) + 1000, "label": 1}])
+
+    def test_get_pos_labels_with_cursor(self):
+        # Some videos have the same label update time, so the ID breaks the ties
+        for i, video_id in enumerate(self.unlabeled):
+            Video.query.filter(Video.id==video_id).update({"label_state": 0b10111, "label_update_time": i // 3})
+        db.session.commit()
+        video_ids = []
+        cursor = ""
+        while True:
+            response = self.client.get("/api/v1/get_pos_labels?pageSize=5&cursor=%s" % cursor)
+            assert response.status_code == 200
+            assert "total" not in response.json
+            video_ids += [v["id"] for v in response.json["data"]]
+            if "next_cursor" not in response.json: break
+            cursor = response.json["next_cursor"]
+        expected = [v.id for v in Video.query.filter(Video.id.in_(self.unlabeled))
+            .order_by(Video.label_update_time.desc(), Video.id.desc()).all()]
+        assert video_ids == expected
+        # The page number API still works
+        response = self.client.get("/api/v1/get_pos_labels?pageSize=5&pageNumber=1")
+        assert response.json["total"] == len(self.unlabeled)
+        response = self.client.get("/api/v1/get_pos_labels?cursor=invalid")
+        assert response.status_code == 400
+
+    def test_gallery_total_is_cached_until_labels_change(self):
+        Video.query.filter(Video.id.in_(self.unlabeled[:4])).update({"label_state": 0b10111}, synchronize_session=False)
+        db.session.commit()
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        def get_total():
+            statements.clear()
+            response = self.client.get("/api/v1/get_pos_labels?pageSize=2&pageNumber=1")
+            assert response.status_code == 200
+            num_counts = len([s for s in statements if "count(" in s.lower()])
+            return response.json["total"], num_counts
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            assert get_total() == (4, 1)
+            # The next pages do not count the videos again
+            assert get_total() == (4, 0)
+            # Adding labels that change the label states removes the cached totals
+            user = user_operations.create_user("admin")
+            update_labels([{"video_id": i, "label": 1} for i in self.unlabeled[4:6]], user.id, None, None, 0)
+            assert get_total() == (6, 1)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,10 @@
 import unittest
 from user_tests import UserTest
+from segmentation_tests import SegmentationTest
+from label_tests import LabelTest
+from view_tests import ViewTest
+from gallery_tests import GalleryTest
+from sampling_tests import SamplingTest
 
 
 if __name__ == "__main__":
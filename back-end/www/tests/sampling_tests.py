@@ -0,0 +1,146 @@
+from basic_tests import BasicTest
+from models.model_operations import video_operations
+from models.model_operations import sampling_operations
+from models.model import db
+from models.model import Video
+from sqlalchemy import update
+from util.candidate_pool import create_pool
+from util.candidate_pool import pool_size
+from util.candidate_pool import pool_contains
+from util.candidate_pool import pool_add
+from util.candidate_pool import pool_remove
+from util.candidate_pool import pool_draw
+from util.candidate_pool import pool_draw_weighted
+from util.id_set import create_id_set
+from util.id_set import id_set_union
+from util.id_set import id_set_contains
+from util.util import get_current_time
+import numpy as np
+import unittest
+
+
+class SamplingTest(BasicTest):
+    """Test case for sampling videos from the candidate pools."""
+    def setUp(self):
+        db.create_all()
+        np.random.seed(0)
+        # The caches of this process may have IDs from other tests
+        sampling_operations.reset_candidate_pools("video")
+        self.partial = []
+        self.unlabeled = []
+        for i in range(20):
+            v = video_operations.create_video("v%d.mp4" % i, i, i + 1, "v%d" % i, 0, 0)
+            if i < 8:
+                v.label_state = 0b101 # maybe positive
+                self.partial.append(v.id)
+            else:
+                self.unlabeled.append(v.id)
+        db.session.commit()
+
+    def assert_pool_is_valid(self, pool):
+        """Check that the index of the pool matches the positions of the IDs."""
+        assert len(pool["index"]) == pool_size(pool)
+        assert all(pool["index"][v] == i for i, v in enumerate(pool["ids"]))
+        assert 0 <= pool["cursor"] < max(pool_size(pool), 1)
+
+    def test_pool_add_remove_draw(self):
+        pool = create_pool(range(100))
+        self.assert_pool_is_valid(pool)
+        assert sorted(pool["ids"]) == list(range(100))
+        # Adding an existing ID or removing a missing ID does nothing
+        pool_add(pool, 5)
+        pool_remove(pool, 1000)
+        assert pool_size(pool) == 100
+        for v in range(0, 100, 3):
+            pool_remove(pool, v)
+        for v in range(100, 120):
+            pool_add(pool, v)
+        self.assert_pool_is_valid(pool)
+        expected = set(v for v in range(120) if v >= 100 or v % 3 != 0)
+        assert set(pool["ids"]) == expected
+        assert not pool_contains(pool, 3) and pool_contains(pool, 110)
+        # Consecutive draws give distinct IDs until the pool is exhausted, and the drawn IDs stay in the pool
+        drawn = []
+        while len(drawn) + 10 <= pool_size(pool):
+            d = pool_draw(pool, 10)
+            assert len(d) == 10
+            drawn += d
+        assert len(set(drawn)) == len(drawn) and set(drawn) <= expected
+        assert pool_size(pool) == len(expected)
+        # Drawing more IDs than the pool has gives all IDs once
+        assert sorted(pool_draw(pool, 1000)) == sorted(expected)
+        assert pool_draw(create_pool([]), 10) == []
+
+    def test_pool_draw_skips_excluded_ids(self):
+        excluded = create_id_set([7, 3, 3, 50, 11])
+        assert excluded.tolist() == [3, 7, 11, 50]
+        assert id_set_contains(excluded, [3, 4, 50, 51]).tolist() == [True, False, True, False]
+        assert id_set_contains(create_id_set(), [1]).tolist() == [False]
+        excluded = id_set_union(excluded, range(20, 40))
+        pool = create_pool(range(60))
+        for _ in range(10):
+            d = pool_draw(pool, 8, excluded)
+            assert len(d) == 8
+            assert not id_set_contains(excluded, d).any()
+        assert sorted(pool_draw(pool, 100, excluded)) == [v for v in range(60) if v not in excluded]
+
+    def test_weighted_draw_is_proportional_to_priority(self):
+        pools = {1: create_pool(range(1000)), 2: create_pool(range(1000, 2000))}
+        exponent = 2
+        weights = sampling_operations.priority_weights(pools, exponent)
+        assert weights == {1: 1000.0, 2: 4000.0}
+        # Each candidate with priority 2 should be drawn 2**exponent times as often as one with priority 1
+        counts = {1: 0, 2: 0}
+        for _ in range(2000):
+            drawn = pool_draw_weighted(pools, weights, 10)
+            assert sum(map(len, drawn.values())) == 10
+            for p in drawn:
+                counts[p] += len(drawn[p])
+        assert abs(counts[2] / (counts[1] + counts[2]) - 0.8) < 0.02, counts
+        # Exponent 0 means uniform sampling over all candidates
+        assert sampling_operations.priority_weights(pools, 0) == {1: 1000.0, 2: 1000.0}
+        # Pools that run out of candidates are dropped and the rest are drawn from other pools
+        pools = {1: create_pool(range(100)), 5: create_pool(range(100, 103))}
+        drawn = pool_draw_weighted(pools, sampling_operations.priority_weights(pools, exponent), 50)
+        assert sorted(drawn[5]) == [100, 101, 102] and len(drawn[1]) == 47
+
+    def test_draw_candidate_batch_excludes_labeled_ids(self):
+        labeled = create_id_set(self.partial[:4] + self.unlabeled[:6])
+        for _ in range(5):
+            selected = sampling_operations.draw_candidate_batch("video", 4, 8, labeled)
+            assert sorted(v.id for v in selected["partial"]) == sorted(self.partial[4:])
+            assert len(selected["unlabeled"]) == 4
+            ids = [v.id for b in selected for v in selected[b]]
+            assert len(set(ids)) == len(ids)
+            assert not id_set_contains(labeled, ids).any()
+
+    def test_reservation_expiry(self):
+        ids = self.partial[:4]
+        assert sorted(sampling_operations.reserve_items("video", ids)) == sorted(ids)
+        db.session.commit()
+        # Reserved items are not given to other citizens
+        assert sampling_operations.reserve_items("video", ids) == []
+        selected = sampling_operations.draw_candidate_batch("video", 8, 8, create_id_set(), reserve=True)
+        assert sorted(v.id for v in selected["partial"]) == sorted(self.partial[4:])
+        db.session.commit()
+        # The reservations of the first two items expire
+        now = get_current_time()
+        db.session.execute(update(Video).where(Video.id.in_(ids[:2])).values(reserved_until=now - 1))
+        db.session.commit()
+        assert sorted(sampling_operations.reserve_items("video", ids)) == sorted(ids[:2])
+        db.session.commit()
+        db.session.execute(update(Video).where(Video.id.in_(self.partial)).values(reserved_until=now - 1))
+        db.session.commit()
+        sampling_operations.sweep_expired_reservations()
+        assert Video.query.filter(Video.reserved_until != None).count() == 0
+        # The sweep runs in its own thread, which does not depend on the batch queues
+        assert sampling_operations.reservation_sweep_worker["thread"].is_alive()
+        # Labeled items are released immediately
+        assert sorted(sampling_operations.reserve_items("video", ids)) == sorted(ids)
+        sampling_operations.release_items("video", ids)
+        db.session.commit()
+        assert sorted(sampling_operations.reserve_items("video", ids)) == sorted(ids)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+from basic_tests import BasicTest
+from controllers import api_v1_controller
+from controllers.api_v1_controller import create_user_token
+from controllers.api_v1_controller import encode_video_jwt
+from models.model_operations import user_operations
+from models.model_operations import video_operations
+from models.model_operations import segmentationMask_operations
+from models.model_operations import sampling_operations
+from models.model_operations import segmentationBatch_operations
+from models.model_operations import connection_operations
+from models.model_operations import gallery_total_operations
+from models.model_operations import segmentationFeedback_operations
+from models.model import db
+from models.model import SegmentationMask
+from models.model import SegmentationFeedback
+from models.model import SegmentationLatestFeedback
+from sqlalchemy import event
+from sqlalchemy import insert
+from util.util import decode_jwt
+from util.util import get_current_time
+from util.cache import cache_clear
+from config.config import config
+import unittest
+
+
+class SegmentationTest(BasicTest):
+    """Test case for segmentation masks."""
+    def create_app(self):
+        app = super().create_app()
+        app.register_blueprint(api_v1_controller.bp, url_prefix="/api/v1/")
+        return app
+
+    def setUp(self):
+        db.create_all()
+        # Do all the sampling work in the request (not in the background thread)
+        self.batch_queue_enabled = config.BATCH_QUEUE_ENABLED
+        self.segmentation_sampling_mode = config.SEGMENTATION_SAMPLING_MODE
+        self.view_buffer_enabled = config.VIEW_BUFFER_ENABLED
+        config.BATCH_QUEUE_ENABLED = False
+        config.VIEW_BUFFER_ENABLED = False
+        # The caches of this process may have IDs from other tests
+        sampling_operations.reset_candidate_pools("segmentation")
+        sampling_operations.invalidate_gold_standards("segmentation")
+        cache_clear(segmentationMask_operations.labeled_segmentation_id_cache)
+        cache_clear(connection_operations.recent_connection_cache)
+        video = video_operations.create_video("v.mp4", 0, 1, "v", 0, 0)
+        for i in range(12):
+            s = segmentationMask_operations.create_segmentation(
+                "m%d.png" % i, "i%d.png" % i, 0, 0, 10, 10, 100, 100, i + 1, video.id, 1, "p%d" % i, None)
+            if i in [0, 1]:
+                s.label_state_admin = 16 # gold standard (the box is good)
+            elif i in [2, 3]:
+                s.label_state_admin = 18 # gold standard (the box should be removed)
+        db.session.commit()
+
+    def tearDown(self):
+        config.BATCH_QUEUE_ENABLED = self.batch_queue_enabled
+        config.SEGMENTATION_SAMPLING_MODE = self.segmentation_sampling_mode
+        config.VIEW_BUFFER_ENABLED = self.view_buffer_enabled
+        super().tearDown()
+
+    def count_statements(self, f):
+        """Run the function and return the SQL statements that it sent to the database."""
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            f()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        return statements
+
+    def test_get_segment_batch_statement_count(self):
+        # Draw the segmentation masks from the candidate pools
+        config.SEGMENTATION_SAMPLING_MODE = "pool"
+        user = user_operations.create_user("123")
+        user_token, _ = create_user_token(user)
+        def get_segment_batch():
+            response = self.client.post("/api/v1/get_segment_batch", json={"user_token": user_token})
+            assert response.status_code == 200
+            data = response.json["data"]
+            assert len(data) == config.BATCH_SIZE_SEG
+            assert all(d["video"]["file_name"] == "v.mp4" for d in data)
+        # The first request loads the candidate pools and gold standards of this process
+        get_segment_batch()
+        # Then each request needs one query for the labeled IDs, one for the gold standards,
+        # ...one for the other masks (with their videos), and one to insert the batch
+        statements = self.count_statements(get_segment_batch)
+        assert len(statements) <= 4, statements
+
+    def test_send_segmentation_batch_writes_feedback_in_bulk(self):
+        user = user_operations.create_user("123")
+        user_token, _ = create_user_token(user)
+        connection_id = decode_jwt(user_token, config.JWT_PRIVATE_KEY)["connection_id"]
+        masks = SegmentationMask.query.order_by(SegmentationMask.id).all()
+        batch = segmentationBatch_operations.create_segmentation_batch(4, len(masks) - 4, connection_id)
+        # Set the issued time to the past so that the token is already valid
+        video_token = encode_video_jwt(video_id_list=[s.id for s in masks], batch_id=batch.id, user_id=user.id, iat=get_current_time()-3600)
+        # Remove the boxes of the gold standards that should be removed, and accept all other boxes
+        data = [{"id": s.id, "relative_boxes": False if s.label_state_admin == 18 else None, "frame_number": s.frame_number} for s in masks]
+        commits = []
+        def commit(conn):
+            commits.append(conn)
+        def send_segmentation_batch():
+            event.listen(db.engine, "commit", commit)
+            try:
+                response = self.client.post("/api/v1/send_segmentation_batch", json={
+                    "data": data, "user_token": user_token, "video_token": video_token})
+            finally:
+                event.remove(db.engine, "commit", commit)
+            assert response.status_code == 200
+            assert response.json["data"]["score"]["batch"] == len(masks) - 4
+        statements = self.count_statements(send_segmentation_batch)
+        # All feedback is added with one INSERT, and the batch is committed once
+        inserts = [s for s in statements if s.startswith("INSERT INTO segmentation_feedback")]
+        assert len(inserts) == 1, inserts
+        assert len(commits) == 1
+        feedback = SegmentationFeedback.query.filter(SegmentationFeedback.batch_id==batch.id).all()
+        assert len(feedback) == len(masks)
+        assert len(set(f.time for f in feedback)) == 1
+
+    def test_gallery_loads_feedback_of_all_masks_at_once(self):
+        users = [user_operations.create_user("user%d" % i) for i in range(2)]
+        masks = SegmentationMask.query.filter(SegmentationMask.label_state_admin==-1).all()
+        rows = []
+        for s in masks:
+            s.label_state = 3 # positive
+            # One citizen feedback from each user, and two researcher feedback (only the latest one is returned)
+            rows += [{"segmentation_id": s.id, "feedback_code": 0, "time": 1, "user_id": u.id} for u in users]
+            rows += [{"segmentation_id": s.id, "feedback_code": c, "time": t, "user_id": users[0].id} for c, t in [(5, 2), (4, 3)]]
+        db.session.execute(insert(SegmentationFeedback), rows)
+        db.session.commit()
+        def get_pos_labels_seg(page_size, user_id=None, user_token=None):
+            url = "/api/v1/get_pos_labels_seg?pageSize=%d" % page_size
+            if user_id is not None:
+                url += "&user_id=%d" % user_id
+            data = None if user_token is None else "user_token=%s" % user_token
+            response = self.client.get(url, data=data)
+            assert response.status_code == 200
+            return response.json["data"]
+        # The researcher feedback is added directly, so the masks do not have the latest feedback rows
+        # ...and the gallery falls back to scanning their researcher feedback
+        data = get_pos_labels_seg(len(masks))
+        assert all(sorted(f["feedback_code"] for f in d["feedback_filtered"]) == [0, 0, 4] for d in data)
+        # Fill the latest feedback table like for existing data
+        assert segmentationFeedback_operations.backfill_latest_feedback() == 2 * len(masks)
+        # The number of queries does not depend on the number of masks in the page
+        # (one for the masks, one for counting them, one for the citizen feedback, one for the videos,
+        # ...and one for the latest researcher feedback)
+        for page_size in [2, len(masks)]:
+            gallery_total_operations.invalidate_gallery_totals("segmentation")
+            data = []
+            statements = self.count_statements(lambda: data.extend(get_pos_labels_seg(page_size)))
+            assert len(data) == page_size
+            assert len(statements) <= 5, statements
+            assert all(d["video"]["file_name"] == "v.mp4" for d in data)
+            assert all(sorted(f["feedback_code"] for f in d["feedback_filtered"]) == [0, 0, 4] for d in data)
+        gallery_total_operations.invalidate_gallery_totals("segmentation")
+        data = []
+        statements = self.count_statements(lambda: data.extend(get_pos_labels_seg(len(masks), user_id=users[1].id)))
+        assert len(data) == len(masks)
+        assert len(statements) <= 4, statements
+        assert all([f["feedback_code"] for f in d["feedback_filtered"]] == [0] for d in data)
+        # The views of a logged-in citizen are written after the masks are serialized,
+        # ...so the commit does not make the masks and their feedback load again
+        user_token, _ = create_user_token(users[1])
+        for page_size in [2, len(masks)]:
+            gallery_total_operations.invalidate_gallery_totals("segmentation")
+            data = []
+            statements = self.count_statements(lambda: data.extend(get_pos_labels_seg(page_size, user_token=user_token)))
+            assert len(data) == page_size
+            inserts = [s for s in statements if s.startswith("INSERT INTO segmentation_view")]
+            assert len(inserts) == 1, inserts
+            assert len(statements) <= 6, statements
+            assert all(sorted(f["feedback_code"] for f in d["feedback_filtered"]) == [0, 0, 4] for d in data)
+
+    def test_latest_feedback_is_updated_by_researcher_labels(self):
+        user = user_operations.create_user("123")
+        masks = SegmentationMask.query.filter(SegmentationMask.label_state_admin==-1).order_by(SegmentationMask.id).all()
+        ids = [s.id for s in masks[:3]]
+        def get_latest_feedback():
+            latest = segmentationFeedback_operations.get_latest_feedback(ids, [3, 5])
+            return {k: f.id for k, f in latest.items()}
+        # Remove the boxes, and then accept the boxes of the first two masks (codes 5 and then 3)
+        segmentationFeedback_operations.update_segmentation_labels(
+            [{"id": i, "relative_boxes": False} for i in ids], user.id, None, None, 0)
+        segmentationFeedback_operations.update_segmentation_labels(
+            [{"id": i, "relative_boxes": None} for i in ids[:2]], user.id, None, None, 0)
+        latest = get_latest_feedback()
+        assert sorted(latest.keys()) == sorted([(i, 5) for i in ids] + [(i, 3) for i in ids[:2]])
+        for (segmentation_id, feedback_code), feedback_id in latest.items():
+            f = SegmentationFeedback.query.filter(SegmentationFeedback.segmentation_id==segmentation_id,
+                SegmentationFeedback.feedback_code==feedback_code).order_by(SegmentationFeedback.time.desc(), SegmentationFeedback.id.desc()).first()
+            assert f.id == feedback_id
+        # The gallery shows the latest researcher feedback of each mask
+        masks = segmentationMask_operations.only_latest_researcher_feedback(masks[:3])
+        assert [[f.feedback_code for f in s.feedback_filtered] for s in masks] == [[3], [3], [5]]
+        # The backfill gets the same rows from the feedback table, and does not replace newer feedback
+        SegmentationLatestFeedback.query.delete()
+        db.session.commit()
+        assert segmentationFeedback_operations.backfill_latest_feedback() == len(latest)
+        assert get_latest_feedback() == latest
+        assert segmentationFeedback_operations.backfill_latest_feedback() == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
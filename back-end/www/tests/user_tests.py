@@ -1,6 +1,10 @@
 from basic_tests import BasicTest
 from models.model_operations import user_operations
+from models.model_operations import connection_operations
 from models.model import db
+from models.model import Connection
+from util.cache import cache_clear
+from config.config import config
 import unittest
 
 
@@ -8,6 +12,13 @@ class UserTest(BasicTest):
     """Test case for users."""
     def setUp(self):
         db.create_all()
+        # The cache of this process may have connection IDs from other tests
+        cache_clear(connection_operations.recent_connection_cache)
+        self.connection_reuse_window = config.CONNECTION_REUSE_WINDOW
+
+    def tearDown(self):
+        config.CONNECTION_REUSE_WINDOW = self.connection_reuse_window
+        super().tearDown()
 
     def test_create_user(self):
         user = user_operations.create_user("123")
@@ -34,6 +45,20 @@ class UserTest(BasicTest):
         user_operations.remove_user(user.id)
         assert user not in db.session
 
+    def test_get_or_create_connection(self):
+        user = user_operations.create_user("123")
+        cid, _ = connection_operations.get_or_create_connection(user.id, user.client_type)
+        assert connection_operations.get_or_create_connection(user.id, user.client_type)[0] == cid
+        # Workers that do not have the connection in the cache find it in the database
+        cache_clear(connection_operations.recent_connection_cache)
+        assert connection_operations.get_or_create_connection(user.id, user.client_type)[0] == cid
+        # Changing the client type starts another connection
+        assert connection_operations.get_or_create_connection(user.id, 0)[0] != cid
+        assert Connection.query.count() == 2
+        config.CONNECTION_REUSE_WINDOW = 0
+        assert connection_operations.get_or_create_connection(user.id, user.client_type)[0] != cid
+        assert Connection.query.count() == 3
+
 
 if __name__ == "__main__":
     unittest.main()
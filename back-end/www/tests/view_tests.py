@@ -0,0 +1,79 @@
+from basic_tests import BasicTest
+from models.model_operations import user_operations
+from models.model_operations import video_operations
+from models.model_operations import view_buffer_operations
+from models.model_operations.connection_operations import create_connection
+from models.model_operations.view_operations import create_views_from_video_batch
+from models.model_operations.view_count_operations import rollup_views
+from models.model import db
+from models.model import View
+from models.model import ViewCount
+from sqlalchemy import event
+from util.util import get_current_time
+from config.config import config
+import unittest
+
+
+class ViewTest(BasicTest):
+    """Test case for views."""
+    def setUp(self):
+        db.create_all()
+        self.view_buffer_enabled = config.VIEW_BUFFER_ENABLED
+        config.VIEW_BUFFER_ENABLED = True
+        view_buffer_operations.flush_views()
+        user = user_operations.create_user("123")
+        self.connection = create_connection(user.id, user.client_type)
+        self.videos = [video_operations.create_video("v%d.mp4" % i, i, i + 1, "v%d" % i, 0, 0) for i in range(20)]
+
+    def tearDown(self):
+        config.VIEW_BUFFER_ENABLED = self.view_buffer_enabled
+        super().tearDown()
+
+    def test_views_are_written_in_bulk(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            # Recording the views of a gallery page does not write to the database
+            create_views_from_video_batch(self.videos, {"connection_id": self.connection.id}, query_type=0)
+            assert len(statements) == 0, statements
+            # Flushing the buffer writes all views with one INSERT
+            view_buffer_operations.flush_views()
+            inserts = [s for s in statements if s.startswith("INSERT INTO view")]
+            assert len(inserts) == 1, inserts
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        assert View.query.count() == len(self.videos)
+
+    def test_views_are_written_in_the_request_without_buffer(self):
+        config.VIEW_BUFFER_ENABLED = False
+        create_views_from_video_batch(self.videos, {"connection_id": self.connection.id}, query_type=0)
+        assert View.query.count() == len(self.videos)
+        assert all(len(b) == 0 for b in view_buffer_operations.view_buffers.values())
+
+    def test_aggregated_views_and_rollup(self):
+        view_recording_mode = config.VIEW_RECORDING_MODE
+        try:
+            config.VIEW_RECORDING_MODE = "aggregated"
+            for _ in range(2):
+                create_views_from_video_batch(self.videos, {"connection_id": self.connection.id}, query_type=0)
+            view_buffer_operations.flush_views()
+        finally:
+            config.VIEW_RECORDING_MODE = view_recording_mode
+        assert View.query.count() == 0
+        assert all(c.count == 2 for c in ViewCount.query.all())
+        # Compact the raw views that were added on the same day into the same counters
+        for v in self.videos:
+            db.session.add(View(connection_id=self.connection.id, video_id=v.id, query_type=0, time=get_current_time()))
+        db.session.commit()
+        n = rollup_views(View, ViewCount, "video_id", get_current_time() + 1)
+        assert n == len(self.videos)
+        assert View.query.count() == 0
+        counts = ViewCount.query.all()
+        assert len(counts) == len(self.videos)
+        assert all(c.count == 3 for c in counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""A small in-memory cache with a max size and an optional time-to-live."""
+
+import threading
+from collections import OrderedDict
+from util.util import get_current_time
+
+
+def create_cache(max_size, ttl=None):
+    """
+    Create an in-memory cache that drops the least recently used items when it is full.
+
+    The cache belongs to the worker process that creates it.
+    Other worker processes have their own caches.
+
+    Parameters
+    ----------
+    max_size : int
+        The max number of items in the cache.
+    ttl : int
+        The time-to-live (in seconds) of each item.
+        None means that the items never expire.
+
+    Returns
+    -------
+    dict
+        The cache object for the other cache functions in this file.
+    """
+    return {"data": OrderedDict(), "max_size": max_size, "ttl": ttl, "lock": threading.Lock()}
+
+
+def cache_get(cache, key, default=None):
+    """Get an item from the cache (return the default value if missing or expired)."""
+    with cache["lock"]:
+        item = cache["data"].get(key)
+        if item is None: return default
+        value, t = item
+        if cache["ttl"] is not None and get_current_time() - t > cache["ttl"]:
+            del cache["data"][key]
+            return default
+        cache["data"].move_to_end(key)
+        return value
+
+
+def cache_set(cache, key, value):
+    """Put an item into the cache, and drop the least recently used items if the cache is full."""
+    with cache["lock"]:
+        cache["data"][key] = (value, get_current_time())
+        cache["data"].move_to_end(key)
+        while len(cache["data"]) > cache["max_size"]:
+            cache["data"].popitem(last=False)
+
+
+def cache_delete(cache, key):
+    """Remove an item from the cache."""
+    with cache["lock"]:
+        cache["data"].pop(key, None)
+
+
+def cache_clear(cache):
+    """Remove all items from the cache."""
+    with cache["lock"]:
+        cache["data"].clear()
@@ -0,0 +1,191 @@
+"""Pre-shuffled candidate pools for drawing random samples without sorting the database table."""
+
+import numpy as np
+from util.id_set import create_id_set
+from util.id_set import id_set_contains
+from util.id_set import id_set_union
+
+
+def create_pool(ids):
+    """
+    Create a candidate pool from a list of IDs.
+
+    The IDs are shuffled once when creating the pool.
+    Drawing from the pool later only walks through the shuffled IDs from a cursor,
+    ...which means that drawing n IDs costs O(n), no matter how large the pool is.
+
+    Parameters
+    ----------
+    ids : list of int
+        The IDs of the candidates.
+
+    Returns
+    -------
+    dict
+        The candidate pool with the following keys:
+        - "ids" : list of int, the shuffled IDs.
+        - "index" : dict, the position of each ID in the "ids" list.
+        - "cursor" : int, the position to start the next draw.
+    """
+    shuffled = np.random.permutation(np.array(ids, dtype=np.int64)).tolist()
+    return {
+        "ids": shuffled,
+        "index": {v: i for i, v in enumerate(shuffled)},
+        "cursor": 0
+    }
+
+
+def pool_size(pool):
+    """Return the number of IDs in the pool."""
+    return len(pool["ids"])
+
+
+def pool_contains(pool, v):
+    """Check if the pool contains the ID."""
+    return v in pool["index"]
+
+
+def pool_add(pool, v):
+    """
+    Add an ID to a random position of the pool in O(1) time.
+
+    The pool is changed in place.
+    Nothing happens if the pool already contains the ID.
+
+    Parameters
+    ----------
+    pool : dict
+        The candidate pool (see the create_pool function).
+    v : int
+        The ID to add.
+    """
+    if v in pool["index"]: return
+    ids = pool["ids"]
+    ids.append(v)
+    i = len(ids) - 1
+    pool["index"][v] = i
+    # Swap with a random position to keep the pool shuffled
+    j = np.random.randint(len(ids))
+    if j != i:
+        ids[i], ids[j] = ids[j], ids[i]
+        pool["index"][ids[i]] = i
+        pool["index"][ids[j]] = j
+
+
+def pool_remove(pool, v):
+    """
+    Remove an ID from the pool in O(1) time.
+
+    The pool is changed in place.
+    Nothing happens if the pool does not contain the ID.
+
+    Parameters
+    ----------
+    pool : dict
+        The candidate pool (see the create_pool function).
+    v : int
+        The ID to remove.
+    """
+    i = pool["index"].pop(v, None)
+    if i is None: return
+    ids = pool["ids"]
+    last = ids.pop()
+    if i < len(ids):
+        # Move the last ID to the empty position
+        ids[i] = last
+        pool["index"][last] = i
+    if pool["cursor"] >= len(ids):
+        pool["cursor"] = 0
+
+
+def pool_draw(pool, n, excluded=None):
+    """
+    Draw at most n distinct IDs from the pool, starting from the cursor.
+
+    The cursor moves forward after drawing (and wraps around at the end),
+    ...so that consecutive draws give different IDs until the pool is exhausted.
+    The drawn IDs stay in the pool.
+
+    Parameters
+    ----------
+    pool : dict
+        The candidate pool (see the create_pool function).
+    n : int
+        The number of IDs to draw.
+    excluded : numpy.ndarray
+        An ID set (see `id_set.py`) of IDs that should be skipped (e.g., the ones labeled by the user).
+
+    Returns
+    -------
+    list of int
+        The drawn IDs (can be fewer than n if the pool does not have enough candidates).
+    """
+    ids = pool["ids"]
+    size = len(ids)
+    if size == 0 or n <= 0: return []
+    has_excluded = excluded is not None and len(excluded) > 0
+    drawn = []
+    start = pool["cursor"]
+    scanned = 0
+    while len(drawn) < n and scanned < size:
+        # Scan a chunk that is a bit larger than needed, to skip the excluded IDs
+        k = min(size - scanned, max(2*(n - len(drawn)), 16))
+        a = (start + scanned) % size
+        b = a + k
+        chunk = ids[a:b] if b <= size else ids[a:] + ids[:b-size]
+        scanned += k
+        if has_excluded:
+            chunk = np.array(chunk, dtype=np.int64)
+            chunk = chunk[~id_set_contains(excluded, chunk)].tolist()
+        drawn += chunk[:n - len(drawn)]
+    if len(drawn) == n:
+        # Start the next draw right after the last drawn ID
+        pool["cursor"] = (pool["index"][drawn[-1]] + 1) % size
+    else:
+        pool["cursor"] = start
+    return drawn
+
+
+def pool_draw_weighted(pools, weights, n, excluded=None):
+    """
+    Draw at most n distinct IDs from a group of pools, choosing a pool for each ID by its weight.
+
+    The pools are chosen by searching uniform random numbers in the cumulative weight array,
+    ...so the cost depends on the number of pools and n, but not on the number of IDs.
+    Pools that run out of candidates are dropped and the rest of the IDs are drawn again from other pools.
+
+    Parameters
+    ----------
+    pools : dict
+        The candidate pools (see the create_pool function) keyed by any hashable value.
+    weights : dict
+        The non-negative weight of each pool (with the same keys as the pools).
+    n : int
+        The number of IDs to draw.
+    excluded : numpy.ndarray
+        An ID set (see `id_set.py`) of IDs that should be skipped (e.g., the ones labeled by the user).
+
+    Returns
+    -------
+    dict
+        The drawn IDs of each pool (the total can be fewer than n if there are not enough candidates).
+    """
+    keys = [k for k in pools if pool_size(pools[k]) > 0 and weights.get(k, 0) > 0]
+    w = np.array([weights[k] for k in keys], dtype=np.float64)
+    drawn = {k: [] for k in keys}
+    num_drawn = 0
+    while num_drawn < n and len(keys) > 0 and w.sum() > 0:
+        cum = np.cumsum(w)
+        picks = np.searchsorted(cum, np.random.random(n - num_drawn) * cum[-1], side="right")
+        counts = np.bincount(picks, minlength=len(keys))
+        for i in np.flatnonzero(counts):
+            k = keys[i]
+            # Skip the IDs drawn in earlier rounds, in case the cursor wraps around
+            skip = id_set_union(excluded if excluded is not None else create_id_set(), drawn[k])
+            d = pool_draw(pools[k], int(counts[i]), skip)
+            drawn[k] += d
+            num_drawn += len(d)
+            if len(d) < counts[i]:
+                # This pool has no more candidates
+                w[i] = 0
+    return {k: drawn[k] for k in drawn if len(drawn[k]) > 0}
@@ -0,0 +1,48 @@
+"""Compact sets of integer IDs, stored as sorted numpy arrays."""
+
+import numpy as np
+
+
+def create_id_set(ids=()):
+    """
+    Create a compact ID set.
+
+    Parameters
+    ----------
+    ids : list of int
+        The IDs (can have duplicates and can be unsorted).
+
+    Returns
+    -------
+    numpy.ndarray
+        A sorted array of unique IDs (8 bytes per ID).
+    """
+    return np.unique(np.array(ids, dtype=np.int64))
+
+
+def id_set_union(id_set, ids):
+    """Return a new ID set with the IDs added (the input set is not changed)."""
+    if len(ids) == 0: return id_set
+    return np.union1d(id_set, np.array(ids, dtype=np.int64))
+
+
+def id_set_contains(id_set, ids):
+    """
+    Check if the IDs are in the ID set by using binary search.
+
+    Parameters
+    ----------
+    id_set : numpy.ndarray
+        The ID set (see the create_id_set function).
+    ids : numpy.ndarray or list of int
+        The IDs to check.
+
+    Returns
+    -------
+    numpy.ndarray
+        An array of booleans, with the same length as the input IDs.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(id_set) == 0: return np.zeros(len(ids), dtype=bool)
+    idx = np.minimum(np.searchsorted(id_set, ids), len(id_set) - 1)
+    return id_set[idx] == ids
@@ -0,0 +1,91 @@
+"""Keyset (cursor) pagination on the label update time and the ID, for the gallery queries."""
+
+import json
+import base64
+from collections import namedtuple
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy import tuple_
+
+
+# A page of a keyset query, which has the same "items" and "total" fields as the paginate function of Flask-SQLAlchemy
+# The total is always None, because counting all rows is what the keyset pagination avoids
+KeysetPage = namedtuple("KeysetPage", ["items", "total", "next_cursor"])
+
+
+def encode_cursor(update_time, item_id):
+    """Encode the position after an item (its label update time and ID) into an opaque cursor string."""
+    # Remove the padding so that the cursor can be put in a URL without escaping
+    return base64.urlsafe_b64encode(json.dumps([update_time, item_id]).encode("utf8")).decode("utf8").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor string into the label update time and the ID of the last item of the previous page.
+
+    An empty cursor means the first page, which returns None.
+
+    Raises
+    ------
+    exception : Exception
+        When the cursor is not valid.
+    """
+    if cursor is None or cursor == "": return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        update_time, item_id = json.loads(base64.urlsafe_b64decode((cursor + padding).encode("utf8")))
+    except Exception:
+        raise Exception("Invalid cursor")
+    if not (update_time is None or type(update_time) == int) or type(item_id) != int:
+        raise Exception("Invalid cursor")
+    return (update_time, item_id)
+
+
+def order_by_update_time(q, model):
+    """
+    Order a gallery query by (label_update_time DESC NULLS LAST, id DESC).
+
+    The ID breaks the ties, so that the pages do not skip or repeat items,
+    ...and the order matches the indexes on the label update time (see the Video and SegmentationMask tables).
+    """
+    return q.order_by(model.label_update_time.desc().nulls_last(), model.id.desc())
+
+
+def keyset_paginate(q, model, cursor, page_size):
+    """
+    Get one page of a query in the order of (label_update_time DESC, id DESC), starting after the cursor.
+
+    The page starts with an index seek on (label_update_time, id) instead of skipping rows with OFFSET,
+    ...so deep pages are as fast as the first page, and no COUNT query is needed.
+    Items without the label update time are put at the end.
+
+    Parameters
+    ----------
+    q : flask_sqlalchemy.query.Query
+        The query of the model without the ORDER BY clause.
+    model : Video or SegmentationMask
+        The model that has the label_update_time and id columns.
+    cursor : str
+        The next_cursor of the previous page (an empty string means the first page).
+    page_size : int
+        The max number of items in the page.
+
+    Returns
+    -------
+    KeysetPage
+        The items in the page, and the cursor of the next page (None if this is the last page).
+    """
+    t, i = model.label_update_time, model.id
+    position = decode_cursor(cursor)
+    if position is not None:
+        if position[0] is None:
+            q = q.filter(and_(t.is_(None), i < position[1]))
+        else:
+            q = q.filter(or_(tuple_(t, i) < tuple_(position[0], position[1]), t.is_(None)))
+    # Get one more item to know if there is a next page
+    items = order_by_update_time(q, model).limit(page_size + 1).all()
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1].label_update_time, items[-1].id)
+    return KeysetPage(items=items, total=None, next_cursor=next_cursor)
@@ -0,0 +1,116 @@
+"""Replay label events through a label state machine for many items at once."""
+
+import numpy as np
+
+
+def reachable_states(machine, initial_state, inputs, client_types):
+    """
+    Find all the states that a label state machine can reach from the initial state.
+
+    Parameters
+    ----------
+    machine : function
+        The label state machine, which maps (state, input, client_type) to the next state (or None).
+    initial_state : int
+        The initial state of the items.
+    inputs : list of int
+        The inputs (labels or feedback codes) of the events.
+    client_types : list of int
+        The client types of the events.
+
+    Returns
+    -------
+    list of int
+        The reachable states, starting with the initial state.
+    """
+    states = [initial_state]
+    seen = {initial_state}
+    i = 0
+    while i < len(states):
+        s = states[i]
+        i += 1
+        for ct in client_types:
+            for x in inputs:
+                next_s = machine(s, x, ct)
+                if next_s is not None and next_s not in seen:
+                    seen.add(next_s)
+                    states.append(next_s)
+    return states
+
+
+def build_transition_table(machine, states, inputs, client_type):
+    """
+    Tabulate a label state machine for one client type.
+
+    Returns
+    -------
+    numpy.ndarray
+        The table T, where T[i, j] is the index (in the states list) of the next state
+        ...when the item is at states[i] and gets inputs[j].
+        If there is no next state, the event is ignored, so T[i, j] is i.
+    """
+    index = {s: i for i, s in enumerate(states)}
+    table = np.repeat(np.arange(len(states))[:, None], len(inputs), axis=1)
+    for i, s in enumerate(states):
+        for j, x in enumerate(inputs):
+            next_s = machine(s, x, client_type)
+            if next_s is not None:
+                table[i, j] = index[next_s]
+    return table
+
+
+def replay_states(machine, items, client_types, inputs, initial_state=-1):
+    """
+    Replay the label events of many items from the initial state in one vectorized pass.
+
+    The state machine is tabulated once, and the k-th events of all items are applied together with numpy,
+    ...so the number of Python steps is the max number of events of an item, not the number of events.
+    Events from the admin researcher (client type 0) move label_state_admin, and other events move label_state.
+
+    Parameters
+    ----------
+    machine : function
+        The label state machine, which maps (state, input, client_type) to the next state (or None).
+    items : numpy.ndarray
+        The item ID of each event, sorted in ascending order.
+        The events of the same item need to be in the order to replay them.
+    client_types : numpy.ndarray
+        The client type of each event.
+    inputs : numpy.ndarray
+        The input (label or feedback code) of each event.
+    initial_state : int
+        The initial state of label_state and label_state_admin.
+
+    Returns
+    -------
+    item_ids : numpy.ndarray
+        The unique item IDs in ascending order.
+    label_state : numpy.ndarray
+        The replayed label_state of each item.
+    label_state_admin : numpy.ndarray
+        The replayed label_state_admin of each item.
+    """
+    items = np.asarray(items, dtype=np.int64)
+    if len(items) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    input_values, input_index = np.unique(np.asarray(inputs, dtype=np.int64), return_inverse=True)
+    ct_values, ct_index = np.unique(np.asarray(client_types, dtype=np.int64), return_inverse=True)
+    input_values, ct_values = input_values.tolist(), ct_values.tolist()
+    states = reachable_states(machine, initial_state, input_values, ct_values)
+    tables = np.stack([build_transition_table(machine, states, input_values, ct) for ct in ct_values])
+    # Find the position of each event among the events of its item
+    item_ids, item_index, counts = np.unique(items, return_inverse=True, return_counts=True)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(len(items)) - starts[item_index]
+    order = np.argsort(rank, kind="stable")
+    bounds = np.searchsorted(rank[order], np.arange(rank.max() + 2))
+    # Row 0 is label_state and row 1 is label_state_admin (both are indices in the states list)
+    column = (np.asarray(client_types) == 0).astype(np.int64)
+    state = np.zeros((2, len(item_ids)), dtype=np.int64)
+    for k in range(len(bounds) - 1):
+        e = order[bounds[k]:bounds[k+1]]
+        c, i = column[e], item_index[e]
+        state[c, i] = tables[ct_index[e], state[c, i], input_index[e]]
+    states = np.array(states, dtype=np.int64)
+    return item_ids, states[state[0]], states[state[1]]